@@ -3,7 +3,7 @@ import os
 from typing import List
 
 import sqlalchemy as sqla
-from sqlalchemy import ForeignKey, Index, JSON, BigInteger
+from sqlalchemy import ForeignKey, Index, JSON, BigInteger, SmallInteger
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -16,6 +16,7 @@ from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from decimal import Decimal
 import datetime
+import enum
 from fractions import Fraction
 from math import ceil, floor
 from typing import Optional, List
@@ -24,6 +25,11 @@ import ipdb
 
 
 DATABASE_URI = os.environ.get("DATABASE_URI", "sqlite+pysqlite:///db.sqlite")
+# Postgres only: range-partition the UTxO table by created_slot into partitions of
+# this many slots, so that old partitions can be dropped. 0 keeps a plain table.
+# Only takes effect when the table is created.
+UTXO_PARTITION_SLOTS = int(os.environ.get("UTXO_PARTITION_SLOTS", 0))
+UTXO_PARTITIONED = UTXO_PARTITION_SLOTS > 0 and DATABASE_URI.startswith("postgresql")
 if DATABASE_URI.startswith("sqlite"):
 
     @event.listens_for(Engine, "connect")
@@ -50,25 +56,51 @@ class Base(DeclarativeBase):
     pass
 
 
+class AddressRole(enum.IntEnum):
+    """
+    Role of the address owning a UTxO, stored in UTxO.role
+    """
+
+    WALLET = 0
+    POOL_CONTRACT = 1
+    PROFIT_ADDRESS = 2
+    ORDER_CONTRACT = 3
+
+
 class UTxO(Base):
     """
     Unspent UTxOs. These are stored so that we can calculate the batcher profits.
     """
 
     __tablename__ = "UTxO"
+    __table_args__ = (
+        # pruning and rollbacks look up spent UTxOs by slot, most UTxOs are unspent
+        Index(
+            "ix_UTxO_spent_slot",
+            "spent_slot",
+            postgresql_where=sqla.text("spent_slot IS NOT NULL"),
+            sqlite_where=sqla.text("spent_slot IS NOT NULL"),
+        ),
+        {"postgresql_partition_by": "RANGE (created_slot)"} if UTXO_PARTITIONED else {},
+    )
 
     id: Mapped[str] = mapped_column(primary_key=True, index=True)  # Txhash#output_idx
 
     owner: Mapped[str]  # Address that owns this UTxO
     value: Mapped[dict] = mapped_column(JSON)  # Dictionary of assets
 
-    created_slot: Mapped[int] = mapped_column(BigInteger)
+    # the primary key of a partitioned table must contain the partition key
+    created_slot: Mapped[int] = mapped_column(BigInteger, primary_key=UTXO_PARTITIONED)
     spent_slot: Mapped[int] = mapped_column(BigInteger, nullable=True)
 
     block_hash: Mapped[str] = mapped_column(
         index=True
     )  # Used to sync ogmios. Corresponds to block containining transaction that creates UTxO
 
+    role: Mapped[int] = mapped_column(
+        SmallInteger, nullable=True
+    )  # AddressRole of the owner, NULL for rows stored before it was classified
+
     def __repr__(self) -> str:
         return self.id
 
@@ -79,6 +111,8 @@ class Batcher(Base):
     """
 
     __tablename__ = "Batcher"
+    # ids of merged batchers must not be reused by SQLite, see querier/batchers.py
+    __table_args__ = {"sqlite_autoincrement": True}
 
     # TODO maybe add some stats here
 
@@ -99,6 +133,21 @@ class BatcherAddress(Base):
     batcher = relationship("Batcher", back_populates="addresses")
 
 
+class BatcherChange(Base):
+    """
+    Batcher changes of recent blocks that cannot be reverted by slot (new batchers,
+    addresses and merges), written by the querier together with their block.
+    Rollbacks revert them in reverse order, see querier/batchers.py.
+    Removed with the spent UTxOs once they are older than the stability window.
+    """
+
+    __tablename__ = "BatcherChange"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # order of the changes
+    slot: Mapped[int] = mapped_column(BigInteger, index=True)
+    change: Mapped[list] = mapped_column(JSON)  # as in querier.journal.BlockUndo.batchers
+
+
 class Order(Base):
     """
     Represents an order. Includes info from the UTxO and datum
@@ -125,6 +174,12 @@ class Transaction(Base):
     """
 
     __tablename__ = "Transaction"
+    # transactions of a batcher in (slot, id) order, see server/crud.py
+    # rolled back transactions and rollups are found by slot, see querier/rollback.py
+    __table_args__ = (
+        Index("ix_Transaction_batcher_id_slot", "batcher_id", "slot", "id"),
+        Index("ix_Transaction_slot", "slot"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     orders: Mapped[List[Order]] = relationship(back_populates="transaction")
@@ -142,23 +197,117 @@ class Transaction(Base):
     tx_hash: Mapped[str]
 
 
+# periods of the BatcherRollup buckets in seconds
+ROLLUP_HOUR = 3600
+ROLLUP_DAY = 86400
+ROLLUP_PERIODS = (ROLLUP_HOUR, ROLLUP_DAY)
+
+
+class BatcherRollup(Base):
+    """
+    Aggregates of the profit (ada_profit + equivalent_ada) of the transactions of a
+    batcher per hour and day, maintained by the querier (see querier/rollups.py)
+    """
+
+    __tablename__ = "BatcherRollup"
+    # the buckets of all batchers in a time window, see server/crud.py
+    __table_args__ = (Index("ix_BatcherRollup_period_bucket", "period", "bucket_start"),)
+
+    batcher_id: Mapped[int] = mapped_column(ForeignKey("Batcher.id"), primary_key=True)
+    period: Mapped[int] = mapped_column(primary_key=True)  # ROLLUP_HOUR or ROLLUP_DAY
+    bucket_start: Mapped[int] = mapped_column(
+        BigInteger, primary_key=True
+    )  # Unix timestamp, a multiple of the period
+    count: Mapped[int] = mapped_column(BigInteger)
+    sum: Mapped[int] = mapped_column(BigInteger)
+    min: Mapped[int] = mapped_column(BigInteger)
+    max: Mapped[int] = mapped_column(BigInteger)
+
+
+class BlockHeader(Base):
+    """
+    Headers of the most recent blocks (about the last k), used to find
+    rollback and intersection points. Older headers are removed on each commit.
+    """
+
+    __tablename__ = "BlockHeader"
+
+    slot: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    hash: Mapped[str]
+    height: Mapped[int] = mapped_column(BigInteger, index=True)
+
+
+class ChainCursor(Base):
+    """
+    The latest completely processed block, written in the same transaction as its rows
+    """
+
+    __tablename__ = "ChainCursor"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # always 1
+    slot: Mapped[int] = mapped_column(BigInteger)
+    hash: Mapped[str]
+    height: Mapped[int] = mapped_column(BigInteger, nullable=True)
+
+
+class PruneProgress(Base):
+    """
+    Progress of the background pruning of a table (see querier/cleanup.py)
+    """
+
+    __tablename__ = "PruneProgress"
+
+    table: Mapped[str] = mapped_column(primary_key=True)
+    cutoff_slot: Mapped[int] = mapped_column(
+        BigInteger
+    )  # Rows spent before this slot are (being) removed
+    deleted_rows: Mapped[int] = mapped_column(BigInteger)  # Removed in the current run
+    total_deleted_rows: Mapped[int] = mapped_column(BigInteger)
+    finished: Mapped[bool]  # Whether the current run is complete
+    updated_at: Mapped[datetime.datetime]
+
+
+if UTXO_PARTITIONED:
+    # catches rows outside of the partitions created by the pruner
+    event.listen(
+        UTxO.__table__,
+        "after_create",
+        sqla.DDL('CREATE TABLE "UTxO_default" PARTITION OF "UTxO" DEFAULT'),
+    )
+
+
 ########################################################################################
 #                      Helpers to get (and potentially create) Rows                    #
 ########################################################################################
 
 
+def get_chain_cursor() -> Optional[ChainCursor]:
+    """
+    Return the cursor of the latest committed block, None for databases written
+    before the cursor existed.
+    """
+    with Session(_ENGINE, expire_on_commit=False) as session:
+        return session.get(ChainCursor, 1)
+
+
 def get_max_slot_block_and_index() -> tuple:
     """
-    Return the largest slot-number and tx-index with an order
-    in the database.
+    Return the slot and hash of the latest processed block.
+    Databases written before BlockHeader existed fall back to the
+    latest block that created a UTxO.
     """
-    stmt = (
-        sqla.select(UTxO.created_slot, UTxO.block_hash)
-        .order_by(UTxO.created_slot.desc(), UTxO.block_hash.desc())
-        .limit(1)
-    )
     with Session(_ENGINE) as session:
-        res = session.execute(stmt).first()
+        res = session.execute(
+            sqla.select(BlockHeader.slot, BlockHeader.hash)
+            .order_by(BlockHeader.slot.desc())
+            .limit(1)
+        ).first()
+        if not res:
+            res = session.execute(
+                sqla.select(UTxO.created_slot, UTxO.block_hash)
+                .order_by(UTxO.created_slot.desc(), UTxO.block_hash.desc())
+                .limit(1)
+            ).first()
         session.rollback()
     if not res:
         return 0, ""
@@ -166,3 +315,11 @@ def get_max_slot_block_and_index() -> tuple:
 
 
 Base.metadata.create_all(_ENGINE)
+# create_all skips existing tables, indexes added to them later are created here
+for index in [*Transaction.__table__.indexes, *UTxO.__table__.indexes]:
+    index.create(_ENGINE, checkfirst=True)
+# columns added to existing tables later
+if "role" not in {c["name"] for c in sqla.inspect(_ENGINE).get_columns("UTxO")}:
+    with _ENGINE.begin() as connection:
+        role_type = UTxO.__table__.c.role.type.compile(dialect=_ENGINE.dialect)
+        connection.execute(sqla.text(f'ALTER TABLE "UTxO" ADD COLUMN role {role_type}'))
@@ -1,53 +1,34 @@
 import argparse
+import asyncio
 import logging
-import queue
+import signal
 import sys
 import threading
 import ipdb
-import time
 
 import querier.config as config
+import querier.metrics as metrics
 import common.db as db
 from querier.block_parser import BlockParser
+from querier.buffer import SynchronizedIterator
+from querier.chainsync import ChainSyncClient
+from querier.decode import DatumDecoder
 from querier.ogmios import OgmiosIterator
+from querier.profiler import PROFILER
+from querier.resolver import make_resolver
 from querier.rollback import RollbackHandler
 
 _LOGGER = logging.getLogger(__name__)
 
 
-class SynchronizedIterator:
-    def __init__(self):
-        self.queue = []  # or we could use queue.Queue()
-        self.lock = threading.Lock()
-        self.has_updated = threading.Condition()
-        self.should_exit = False
-
-    def submit_block(self, block):
-        with self.lock:
-            if len(self.queue) > 3000:
-                # _LOGGER.info(f"QUERIER IS LAGGING BEHIND! {len(self.queue)}")
-                return False
-            self.queue.append(block)
-        with self.has_updated:
-            self.has_updated.notify()
-        return True
-
-    def iterate_blocks(self):
-        while not self.should_exit:
-            with self.lock:
-                n = len(self.queue)
-            if n == 0:
-                with self.has_updated:
-                    self.has_updated.wait(timeout=10)
-            else:
-                for _ in range(n):
-                    with self.lock:
-                        block = self.queue.pop(0)
-                    yield block
-
-
 def prepare_database():
-    # On start, we always rollback by one block, since it may have
+    # The chain cursor is committed together with the rows of its block,
+    # so we can resume right after it
+    cursor = db.get_chain_cursor()
+    if cursor is not None:
+        return cursor.slot, cursor.hash
+
+    # Databases without a cursor are rolled back by one block, since it may have
     # been incompletely processed when the server last exited
     start_slot_no, start_block_hash = db.get_max_slot_block_and_index()
     if start_slot_no > 0:
@@ -82,10 +63,13 @@ def prepare_database():
 #         raise ex
 
 
-def _run_analytics_async(iterator: SynchronizedIterator):
+def _run_analytics_async(iterator: SynchronizedIterator, datum_decoder: DatumDecoder):
+    PROFILER.watch_thread("parser")
     try:
         block_parser = BlockParser(
             iterator=iterator,
+            input_resolver=make_resolver(config.INPUT_RESOLVER),
+            datum_decoder=datum_decoder,
         )
         block_parser.run()
     except Exception:
@@ -95,15 +79,16 @@ def _run_analytics_async(iterator: SynchronizedIterator):
 
 
 def _run_ogmios_async(start_slot_no, start_block_hash, iterator: SynchronizedIterator):
+    PROFILER.watch_thread("chain sync")
     try:
-        ogmios = OgmiosIterator()
+        if config.CHAIN_SYNC_CLIENT == "ogmios":
+            ogmios = OgmiosIterator()
+        else:
+            ogmios = ChainSyncClient()
         block_generator = ogmios.iterate_blocks(start_slot_no, start_block_hash)
         for block in block_generator:
-            while not iterator.submit_block(block):
-                if iterator.should_exit:
-                    break
-                time.sleep(5)
-            if iterator.should_exit:
+            # blocks while the buffer is full, returns False on shutdown
+            if not iterator.submit_block(block):
                 break
     except Exception as ex:
         iterator.should_exit = True
@@ -111,12 +96,13 @@ def _run_ogmios_async(start_slot_no, start_block_hash, iterator: SynchronizedIte
     iterator.should_exit = True
 
 
-def run_as_multiple_threads():
+def run_as_multiple_threads(datum_workers: int):
     start_slot_no, start_block_hash = prepare_database()
 
     iterator = SynchronizedIterator()
+    datum_decoder = DatumDecoder(workers=datum_workers)
 
-    t1 = threading.Thread(target=_run_analytics_async, args=(iterator,))
+    t1 = threading.Thread(target=_run_analytics_async, args=(iterator, datum_decoder))
     t2 = threading.Thread(
         target=_run_ogmios_async, args=(start_slot_no, start_block_hash, iterator)
     )
@@ -125,6 +111,15 @@ def run_as_multiple_threads():
     t2.start()
     t1.join()
     t2.join()
+    datum_decoder.close()
+
+
+def run_with_asyncio(datum_workers: int):
+    from querier.aio import run_async
+
+    start_slot_no, start_block_hash = prepare_database()
+    PROFILER.watch_thread("asyncio")
+    asyncio.run(run_async(start_slot_no, start_block_hash, datum_workers))
 
 
 if __name__ == "__main__":
@@ -132,8 +127,37 @@ if __name__ == "__main__":
     argp.add_argument(
         "--singlethreaded", action="store_true", default=False
     )  # experimental
+    argp.add_argument(
+        "--datum-workers",
+        type=int,
+        default=config.DATUM_WORKERS,
+        help="Number of processes decoding order datums, 0 decodes inline",
+    )
+    argp.add_argument(
+        "--runtime",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Two threads with blocking I/O, or one asyncio event loop (see querier/aio.py)",
+    )
+    argp.add_argument(
+        "--profile",
+        action="store_true",
+        help="Start the sampling profiler (see querier/profiler.py), SIGUSR2 toggles it",
+    )
+    argp.add_argument(
+        "--metrics-port",
+        type=int,
+        default=config.METRICS_PORT,
+        help="Port of the Prometheus /metrics endpoint, 0 disables it",
+    )
     args = argp.parse_args()
+    metrics.serve(args.metrics_port, config.METRICS_ADDR)
+    signal.signal(signal.SIGUSR2, PROFILER.toggle)
+    if args.profile:
+        PROFILER.start()
     if args.singlethreaded:
         pass
+    elif args.runtime == "asyncio":
+        run_with_asyncio(datum_workers=args.datum_workers)
     else:
-        run_as_multiple_threads()
+        run_as_multiple_threads(datum_workers=args.datum_workers)
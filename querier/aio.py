@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import orm
+
+from common.classes import LOVELACE
+from common.util import parse_assets_to_list
+from .block_parser import BlockParser
+from .chainsync import AsyncChainSyncClient, BlockView
+from .decode import DatumDecoder
+from .ogmios import ChainRollback
+from .prices import AsyncHttpPriceProvider, make_price_provider
+from .profiler import PROFILER
+from .resolver import make_resolver
+from .config import (
+    INPUT_RESOLVER,
+    MUESLI_ADDR_TO_VERSION,
+    PREFETCH_BLOCKS,
+    PRICE_BACKEND,
+    QUEUE_MAX_BLOCKS,
+    WRITE_PATH,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# number of order outputs remembered by the prefetch stage
+_RECENT_ORDERS = 100000
+
+
+class AsyncRuntime:
+    """
+    Runs the querier on one event loop instead of two threads, in three tasks
+    connected by bounded queues:
+
+    - chain sync: receives blocks over an async websocket
+    - prefetch: fetches the prices a block will probably need, concurrently for
+      up to `prefetch_blocks` blocks ahead of the parser
+    - parser: hands each block to the BlockParser on its own thread, so that its
+      blocking work (queries, commits, missing prices, Blockfrost lookups and
+      datum decoding) never stalls the websocket, its keepalives or the prefetch
+
+    `stop` (SIGINT/SIGTERM) cancels chain sync, lets the parser finish its block
+    and commits. Blocks are never cancelled halfway.
+    """
+
+    def __init__(
+        self,
+        parser: BlockParser,
+        client: AsyncChainSyncClient,
+        max_blocks: int = QUEUE_MAX_BLOCKS,
+        prefetch_blocks: int = PREFETCH_BLOCKS,
+    ):
+        self.parser = parser
+        # the parser logs the buffer statistics of its iterator
+        self.parser.iterator = self
+        self.client = client
+        # the parser state is only ever touched by this one thread
+        self.executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="parser",
+            initializer=PROFILER.watch_thread,
+            initargs=("parser",),
+        )
+        self.blocks = asyncio.Queue(maxsize=max_blocks)
+        self.ready = asyncio.Queue(maxsize=prefetch_blocks)
+        self.stopping = False
+        self.idle = False
+        self.tasks = {}
+        # order outputs seen by the prefetch stage, which runs ahead of the parser
+        self.recent_orders = set()
+        self.recent_orders_fifo = deque()
+
+        # statistics
+        self.prefetch_time = 0.0
+        self.parser_time = 0.0
+
+    def stop(self):
+        _LOGGER.warning("Stopping")
+        self.stopping = True
+        self.tasks["chain sync"].cancel()
+        self.tasks["prefetch"].cancel()
+        if self.idle:
+            self.tasks["parser"].cancel()
+
+    async def _produce(self, start_slot_no: int, start_block_hash: str):
+        async for item in self.client.iterate_blocks(start_slot_no, start_block_hash):
+            await self.blocks.put(item)
+        await self.blocks.put(None)
+
+    def _tokens(self, block: BlockView) -> set:
+        """
+        Non-ADA tokens in the outputs of transactions that may close orders.
+        """
+        tokens = set()
+        open_orders = self.parser.open_orders
+        batcher_index = self.parser.batcher_index
+        for tx in block.transactions:
+            for idx, output in enumerate(tx["outputs"]):
+                if output["address"] in MUESLI_ADDR_TO_VERSION:
+                    self.recent_orders.add(f"{tx['id']}#{idx}")
+                    self.recent_orders_fifo.append(f"{tx['id']}#{idx}")
+            spends_order = any(
+                input_id in open_orders or input_id in self.recent_orders
+                for input_id in (f"{d['transaction']['id']}#{d['index']}" for d in tx["inputs"])
+            )
+            if not spends_order and not any(
+                output["address"] in batcher_index for output in tx["outputs"]
+            ):
+                continue
+            for output in tx["outputs"]:
+                for asset in parse_assets_to_list(output["value"]):
+                    if asset.token != LOVELACE:
+                        tokens.add(asset.token)
+        # the parser knows the orders older than the blocks in the queues
+        while len(self.recent_orders_fifo) > _RECENT_ORDERS:
+            self.recent_orders.discard(self.recent_orders_fifo.popleft())
+        return tokens
+
+    async def _prefetch(self, block: BlockView):
+        start = time.monotonic()
+        try:
+            await self.parser.price_provider.prefetch(self._tokens(block))
+        except Exception:
+            # only warms the cache, the parser fetches missing prices itself
+            _LOGGER.exception(f"Exception while prefetching block {block.slot}")
+        self.prefetch_time += time.monotonic() - start
+
+    async def _prefetch_stage(self):
+        can_prefetch = isinstance(self.parser.price_provider, AsyncHttpPriceProvider)
+        while True:
+            item = await self.blocks.get()
+            task = None
+            if can_prefetch and isinstance(item, BlockView):
+                task = asyncio.create_task(self._prefetch(item))
+            await self.ready.put((item, task))
+            if item is None:
+                return
+
+    async def _in_parser_thread(self, fn, *args):
+        start = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.parser_time += time.monotonic() - start
+
+    def _process_block(self, session: orm.Session, block: BlockView):
+        try:
+            self.parser.process_block(block, session)
+        except Exception:
+            # as in BlockParser.run, the batch is not committed
+            _LOGGER.exception(f"Exception while processing block {block.slot}")
+            session.rollback()
+            session.close()
+            raise
+        self.parser.pending_blocks += 1
+
+    async def _commit(self, session: orm.Session):
+        await self._in_parser_thread(self.parser.commit, session)
+
+    async def _handle(
+        self, item, prefetched: asyncio.Task, session: orm.Session, i: int
+    ) -> orm.Session:
+        """
+        Processes one block or rollback, returns the session of the current batch.
+        """
+        if prefetched is not None:
+            await prefetched
+        if isinstance(item, ChainRollback):
+            if session is not None:
+                await self._commit(session)
+            await self._in_parser_thread(self.parser.rollback, item.slot, item.id)
+            return None
+        if session is None:
+            session = orm.Session(self.parser.engine)
+            self.parser.batch_start = time.monotonic()
+        await self._in_parser_thread(self._process_block, session, item)
+        if i % 1000 == 0 or self.parser.should_commit(item):
+            await self._commit(session)
+            session = None
+        await self._in_parser_thread(self.parser.housekeeping, i)
+        return session
+
+    async def _consume(self):
+        session = None
+        i = -1
+        while not self.stopping:
+            self.idle = True
+            timed_out = False
+            try:
+                item, prefetched = await asyncio.wait_for(
+                    self.ready.get(), self.parser.commit_timeout()
+                )
+            except asyncio.TimeoutError:
+                timed_out = True
+            except asyncio.CancelledError:
+                asyncio.current_task().uncancel()
+                break
+            finally:
+                self.idle = False
+            if timed_out:
+                # no block arrived before the group commit deadline
+                await self._commit(session)
+                session = None
+                continue
+            if item is None:
+                break
+            if isinstance(item, BlockView):
+                i += 1
+            # a block is always processed completely, even on shutdown
+            task = asyncio.ensure_future(self._handle(item, prefetched, session, i))
+            try:
+                session = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                asyncio.current_task().uncancel()
+                self.stopping = True
+                session = await task
+        if session is not None:
+            await self._commit(session)
+        await self._in_parser_thread(self.parser.close)
+
+    async def run(self, start_slot_no: int, start_block_hash: str):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        try:
+            async with asyncio.TaskGroup() as group:
+                self.tasks["chain sync"] = group.create_task(
+                    self._produce(start_slot_no, start_block_hash)
+                )
+                self.tasks["prefetch"] = group.create_task(self._prefetch_stage())
+                self.tasks["parser"] = group.create_task(self._consume())
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            self.executor.shutdown()
+            _LOGGER.info(f"Runtime: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            "blocks": self.blocks.qsize(),
+            "prefetching": self.ready.qsize(),
+            "prefetch_time": round(self.prefetch_time, 3),
+            "parser_time": round(self.parser_time, 3),
+            **self.client.stats(),
+        }
+
+
+async def run_async(start_slot_no: int, start_block_hash: str, datum_workers: int):
+    """
+    Entry point of `python -m querier --runtime asyncio`.
+    """
+    price_provider = (
+        AsyncHttpPriceProvider()
+        if PRICE_BACKEND == "http"
+        else make_price_provider(PRICE_BACKEND)
+    )
+    datum_decoder = DatumDecoder(workers=datum_workers)
+    try:
+        parser = BlockParser(
+            iterator=None,
+            input_resolver=make_resolver(INPUT_RESOLVER),
+            price_provider=price_provider,
+            datum_decoder=datum_decoder,
+            write_path=WRITE_PATH,
+        )
+        runtime = AsyncRuntime(parser, AsyncChainSyncClient())
+        await runtime.run(start_slot_no, start_block_hash)
+    finally:
+        datum_decoder.close()
+        if isinstance(price_provider, AsyncHttpPriceProvider):
+            await price_provider.aclose()
@@ -0,0 +1,666 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import orjson
+import sqlalchemy as sqla
+from sqlalchemy import BigInteger, orm
+from sqlalchemy.dialects import postgresql, sqlite
+
+from common.db import (
+    _ENGINE,
+    BlockHeader,
+    ChainCursor,
+    UTXO_PARTITIONED,
+    Order,
+    Transaction,
+    UTxO,
+    get_chain_cursor,
+)
+from . import rollups, util
+from .batchers import BatcherIndex
+from .chainsync import BlockView, ChainSyncClient
+from .cleanup import ensure_partitions
+from .decode import DatumDecoder
+from .fallback import FallbackResolver, TokenBucket
+from .prices import make_price_provider
+from .writer import make_writer, update_by_id
+from .config import (
+    BACKFILL_DIR,
+    BACKFILL_WORKERS,
+    BLOCKFROST,
+    BLOCKFROST_BURST,
+    BLOCKFROST_RATE,
+    DEFAULT_START_HASH,
+    DEFAULT_START_SLOT,
+    INGEST_MODE,
+    PRICE_BACKEND,
+    SECURITY_PARAM,
+    WRITE_PATH,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# rows per INSERT / UPDATE statement of the merge
+_MERGE_BATCH = 10000
+# blocks per commit of the facts of a chunk
+_FACTS_BATCH = 1000
+# outputs.kind
+_UTXO = 0
+_ORDER = 1
+_OUTPUT_COLUMNS = "id, tx_hash, slot, kind, owner, value, role, sender, recipient"
+
+_FACTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS blocks (slot INTEGER PRIMARY KEY, hash TEXT, height INTEGER);
+CREATE TABLE IF NOT EXISTS txs (
+    hash TEXT PRIMARY KEY, slot INTEGER, idx INTEGER, fee INTEGER, inputs BLOB,
+    parsed INTEGER
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    id TEXT PRIMARY KEY, tx_hash TEXT, slot INTEGER, kind INTEGER, owner TEXT,
+    value BLOB, role INTEGER, sender TEXT, recipient TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_tx_hash ON outputs (tx_hash);
+CREATE INDEX IF NOT EXISTS txs_slot ON txs (slot, idx);
+"""
+
+
+########################################################################################
+#                                     Chunks                                           #
+########################################################################################
+
+
+class Chunk:
+    """
+    The blocks after (start_slot, start_hash) up to and including (end_slot, end_hash).
+    Both ends are blocks, so a worker can intersect at the start and verify the end.
+    """
+
+    __slots__ = ("start_slot", "start_hash", "end_slot", "end_hash")
+
+    def __init__(self, start_slot: int, start_hash: str, end_slot: int, end_hash: str):
+        self.start_slot = start_slot
+        self.start_hash = start_hash
+        self.end_slot = end_slot
+        self.end_hash = end_hash
+
+    def path(self, directory: str) -> str:
+        return os.path.join(directory, f"chunk-{self.start_slot}-{self.end_slot}.sqlite")
+
+    def __repr__(self) -> str:
+        return f"Chunk({self.start_slot}, {self.end_slot}]"
+
+
+def load_checkpoints(path: str) -> List[Tuple[int, str]]:
+    """
+    Checkpoints from a file with one "slot hash" per line, sorted by slot.
+    """
+    checkpoints = []
+    with open(path) as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                slot, block_hash = line.split()
+                checkpoints.append((int(slot), block_hash))
+    return sorted(checkpoints)
+
+
+def find_checkpoint(slot: int, api=BLOCKFROST, max_steps: int = 1000) -> Tuple[int, str]:
+    """
+    The newest block at or before `slot`, looked up on Blockfrost (empty slots
+    are skipped backwards).
+    """
+    from blockfrost import ApiError
+
+    bucket = TokenBucket(BLOCKFROST_RATE, BLOCKFROST_BURST)
+    for candidate in range(slot, slot - max_steps, -1):
+        bucket.acquire()
+        try:
+            block = api.block_slot(candidate)
+        except ApiError as e:
+            if e.status_code == 404:
+                continue
+            raise
+        return block.slot, block.hash
+    raise Exception(f"No block found in the {max_steps} slots before {slot}")
+
+
+def plan_chunks(
+    start: Tuple[int, str],
+    end: Tuple[int, str],
+    num_chunks: int,
+    checkpoints: List[Tuple[int, str]] = None,
+) -> List[Chunk]:
+    """
+    Splits (start, end] at the given checkpoints, or at `num_chunks` - 1 evenly
+    spaced blocks looked up on Blockfrost.
+    """
+    if checkpoints is None:
+        step = (end[0] - start[0]) // num_chunks
+        checkpoints = [find_checkpoint(start[0] + n * step) for n in range(1, num_chunks)]
+    inner = sorted({c for c in checkpoints if start[0] < c[0] < end[0]})
+    points = [start] + inner + [end]
+    return [Chunk(*a, *b) for a, b in zip(points, points[1:])]
+
+
+########################################################################################
+#                                     Facts                                            #
+########################################################################################
+
+
+class ChunkFacts:
+    """
+    Facts of a chunk that can be extracted without knowing the rest of the chain,
+    stored in a SQLite file per chunk: blocks, transactions (fee and inputs) and
+    parsed outputs, orders with their sender and recipient.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_FACTS_SCHEMA)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def complete(self) -> bool:
+        return self.get_meta("complete") == "1"
+
+    def chunk(self) -> Chunk:
+        return Chunk(
+            int(self.get_meta("start_slot")),
+            self.get_meta("start_hash"),
+            int(self.get_meta("end_slot")),
+            self.get_meta("end_hash"),
+        )
+
+    def reset(self, chunk: Chunk):
+        for table in ("meta", "blocks", "txs", "outputs"):
+            self.connection.execute(f"DELETE FROM {table}")
+        self.set_meta("start_slot", chunk.start_slot)
+        self.set_meta("start_hash", chunk.start_hash)
+        self.set_meta("end_slot", chunk.end_slot)
+        self.set_meta("end_hash", chunk.end_hash)
+        self.connection.commit()
+
+    def add_block(self, block: BlockView, decoder: DatumDecoder):
+        parties = decoder.decode_block(block)
+        txs = []
+        outputs = []
+        for idx, tx in enumerate(block.transactions):
+            input_ids = [f"{d['transaction']['id']}#{d['index']}" for d in tx["inputs"]]
+            fee = tx["fee"]["ada"]["lovelace"]
+            try:
+                parsed = [
+                    util.parse_output(
+                        tx=tx,
+                        output=output,
+                        id=f"{tx['id']}#{i}",
+                        slot=block.slot,
+                        block_hash=block.id,
+                        parties=parties.get(f"{tx['id']}#{i}"),
+                    )
+                    for i, output in enumerate(tx["outputs"])
+                ]
+            except Exception as e:
+                # the parser skips the outputs and analytics of such transactions as well,
+                # its inputs are still spent
+                _LOGGER.error(f"Error processing tx: {e}")
+                txs.append((tx["id"], block.slot, idx, fee, orjson.dumps(input_ids), 0))
+                continue
+            txs.append((tx["id"], block.slot, idx, fee, orjson.dumps(input_ids), 1))
+            for output, utxo in zip(tx["outputs"], parsed):
+                if isinstance(utxo, Order):
+                    kind, value, role = _ORDER, None, None
+                    sender, recipient = utxo.sender, utxo.recipient
+                else:
+                    kind, value, role = _UTXO, orjson.dumps(utxo.value), utxo.role
+                    sender, recipient = None, None
+                outputs.append(
+                    (utxo.id, tx["id"], block.slot, kind, output["address"], value, role, sender, recipient)
+                )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)", (block.slot, block.id, block.height)
+        )
+        self.connection.executemany("INSERT OR REPLACE INTO txs VALUES (?, ?, ?, ?, ?, ?)", txs)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", outputs
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    # reading, always restricted to the blocks after `after_slot`
+
+    def blocks(self, after_slot: int) -> Dict[int, Tuple[str, int]]:
+        return {
+            slot: (block_hash, height)
+            for slot, block_hash, height in self.connection.execute(
+                "SELECT slot, hash, height FROM blocks WHERE slot > ? ORDER BY slot",
+                (after_slot,),
+            )
+        }
+
+    def outputs(self, after_slot: int, kind: int) -> Iterator[tuple]:
+        return self.connection.execute(
+            f"SELECT {_OUTPUT_COLUMNS} FROM outputs WHERE slot > ? AND kind = ? ORDER BY slot, id",
+            (after_slot, kind),
+        )
+
+    def transactions(self, after_slot: int) -> Iterator[tuple]:
+        return self.connection.execute(
+            "SELECT hash, slot, idx, fee, inputs, parsed FROM txs WHERE slot > ? ORDER BY slot, idx",
+            (after_slot,),
+        )
+
+    def outputs_of(self, tx_hash: str) -> List[tuple]:
+        return self.connection.execute(
+            f"SELECT {_OUTPUT_COLUMNS} FROM outputs WHERE tx_hash = ? ORDER BY id", (tx_hash,)
+        ).fetchall()
+
+    def output(self, output_id: str) -> Optional[tuple]:
+        return self.connection.execute(
+            f"SELECT {_OUTPUT_COLUMNS} FROM outputs WHERE id = ?", (output_id,)
+        ).fetchone()
+
+    def close(self):
+        self.connection.close()
+
+
+def fetch_chunk(chunk: Chunk, directory: str) -> str:
+    """
+    Worker: streams the blocks of a chunk from Ogmios over its own connection and
+    stores their facts. A complete facts file of the same chunk is reused.
+    Runs in a separate process, returns the path of the facts file.
+    """
+    path = chunk.path(directory)
+    facts = ChunkFacts(path)
+    try:
+        if facts.complete:
+            _LOGGER.info(f"{chunk} already fetched")
+            return path
+        facts.reset(chunk)
+        decoder = DatumDecoder(workers=0)
+        start = time.monotonic()
+        client = ChainSyncClient()
+        num_blocks = 0
+        for item in client.iterate_from(chunk.start_slot, chunk.start_hash):
+            if not isinstance(item, BlockView):
+                # chunks must be deeper than the security parameter
+                raise Exception(f"Rollback to {item} while fetching {chunk}")
+            if item.slot > chunk.end_slot:
+                raise Exception(f"{chunk} does not end at a block, next block at {item.slot}")
+            facts.add_block(item, decoder)
+            num_blocks += 1
+            if num_blocks % _FACTS_BATCH == 0:
+                facts.commit()
+            if item.slot == chunk.end_slot:
+                if item.id != chunk.end_hash:
+                    raise Exception(f"{chunk} ends at {item.id}, expected {chunk.end_hash}")
+                break
+        facts.set_meta("complete", 1)
+        facts.commit()
+        _LOGGER.info(
+            f"Fetched {chunk}: {num_blocks} blocks in {time.monotonic() - start:.1f} s"
+        )
+        return path
+    finally:
+        facts.close()
+
+
+########################################################################################
+#                                     Merge                                            #
+########################################################################################
+
+
+def _insert_ignore(session: orm.Session, table: sqla.Table, rows: list):
+    """
+    INSERT that skips rows whose primary key exists, so merging twice is harmless.
+    """
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(table).on_conflict_do_nothing()
+    else:
+        raise ValueError(f"Backfill does not support {dialect}")
+    for start in range(0, len(rows), _MERGE_BATCH):
+        session.execute(stmt, rows[start : start + _MERGE_BATCH])
+
+
+def _utxo(row: tuple, block_hash: str) -> UTxO:
+    output_id, _, slot, _, owner, value, role, _, _ = row
+    return UTxO(
+        id=output_id,
+        owner=owner,
+        value=orjson.loads(value),
+        created_slot=slot,
+        block_hash=block_hash,
+        role=role,
+    )
+
+
+class BackfillMerger:
+    """
+    Writes the facts of consecutive chunks to the database, deterministically and
+    idempotently: the result is the one of the sequential parser in "full" mode,
+    whatever chunks the range was fetched in, and merging again changes nothing.
+
+    Only the facts after the chain cursor are merged, each facts file only after the
+    end of the previous one, so overlapping chunks are fine. Rows are inserted with
+    ON CONFLICT DO NOTHING, transactions that are already stored are skipped.
+
+    1. orders and outputs ("full" mode: all, "relevant": of order transactions)
+    2. batch transactions (spending orders) in chain order, as in BlockParser.process_tx,
+       and the rollups of their batchers
+    3. "relevant" mode: outputs at batcher addresses
+    4. spend marks, set-based
+    5. block headers of the last k blocks and the chain cursor
+    """
+
+    def __init__(
+        self,
+        paths: List[str],
+        engine: sqla.Engine = _ENGINE,
+        ingest_mode: str = INGEST_MODE,
+        price_provider=None,
+        fallback: FallbackResolver = None,
+    ):
+        self.engine = engine
+        self.ingest_mode = ingest_mode
+        self.price_provider = price_provider or make_price_provider(PRICE_BACKEND)
+        self.fallback = fallback or FallbackResolver()
+        self.is_postgres = engine.dialect.name == "postgresql"
+        self.batcher_index = BatcherIndex()
+        self.writer = make_writer(WRITE_PATH, engine, self.batcher_index)
+        self.batcher_index.before_merge = self.writer.flush
+        rollups.ensure(engine)
+
+        cursor = get_chain_cursor()
+        self.cursor_slot = cursor.slot if cursor is not None else -1
+        # (facts, merge after this slot), in chain order
+        self.windows = []
+        after_slot = self.cursor_slot
+        for facts in sorted(
+            (ChunkFacts(path) for path in paths), key=lambda f: f.chunk().start_slot
+        ):
+            chunk = facts.chunk()
+            if not facts.complete:
+                raise Exception(f"{facts.path} is incomplete, fetch it again")
+            if chunk.end_slot <= after_slot:
+                continue
+            if chunk.start_slot > after_slot and after_slot >= 0:
+                raise Exception(f"Gap between slot {after_slot} and {chunk}")
+            self.windows.append((facts, after_slot))
+            after_slot = chunk.end_slot
+        self.order_ids = set()
+
+        # statistics
+        self.transactions = 0
+
+    def _ensure_partitions(self):
+        """
+        Creates the UTxO partitions of all merged slots, see cleanup.ensure_partitions.
+        """
+        facts, after_slot = self.windows[0]
+        slot = max(facts.chunk().start_slot, after_slot + 1)
+        end_slot = self.windows[-1][0].chunk().end_slot
+        with orm.Session(self.engine) as session:
+            while slot <= end_slot:
+                slot = ensure_partitions(session, slot, ahead=0)
+            session.commit()
+
+    def _insert_outputs(self):
+        """
+        Step 1. Returns the hashes of the transactions that create or spend orders.
+        """
+        order_txs = set()
+        for facts, after_slot in self.windows:
+            for row in facts.outputs(after_slot, _ORDER):
+                self.order_ids.add(row[0])
+                order_txs.add(row[1])
+        with orm.Session(self.engine) as session:
+            self.order_ids.update(
+                session.scalars(sqla.select(Order.id).where(Order.transaction_id == None))
+            )
+        for facts, after_slot in self.windows:
+            for tx_hash, _, _, _, inputs, _ in facts.transactions(after_slot):
+                if any(i in self.order_ids for i in orjson.loads(inputs)):
+                    order_txs.add(tx_hash)
+
+        for facts, after_slot in self.windows:
+            with orm.Session(self.engine) as session:
+                block_hashes = facts.blocks(after_slot)
+                orders = [
+                    {"id": i, "sender": s, "recipient": r, "slot": slot, "transaction_id": None}
+                    for i, _, slot, _, _, _, _, s, r in facts.outputs(after_slot, _ORDER)
+                ]
+                _insert_ignore(session, Order.__table__, orders)
+                rows = []
+                for row in facts.outputs(after_slot, _UTXO):
+                    if self.ingest_mode == "full" or row[1] in order_txs:
+                        rows.append(self._utxo_row(row, block_hashes[row[2]][0]))
+                    if len(rows) >= _MERGE_BATCH:
+                        _insert_ignore(session, UTxO.__table__, rows)
+                        rows.clear()
+                _insert_ignore(session, UTxO.__table__, rows)
+                session.commit()
+        return order_txs
+
+    @staticmethod
+    def _utxo_row(row: tuple, block_hash: str) -> dict:
+        output_id, _, slot, _, owner, value, role, _, _ = row
+        return {
+            "id": output_id,
+            "owner": owner,
+            "value": orjson.loads(value),
+            "created_slot": slot,
+            "spent_slot": None,
+            "block_hash": block_hash,
+            "role": role,
+        }
+
+    def _resolve_inputs(self, session: orm.Session, input_ids: List[str]) -> List[UTxO]:
+        """
+        Stored UTxOs, then outputs in the facts of any chunk.
+        """
+        utxos = {
+            utxo.id: utxo
+            for utxo in session.scalars(sqla.select(UTxO).where(UTxO.id.in_(input_ids)))
+        }
+        for input_id in input_ids:
+            if input_id in utxos or input_id in self.order_ids:
+                continue
+            for facts, _ in self.windows:
+                row = facts.output(input_id)
+                if row is not None and row[3] == _UTXO:
+                    utxos[input_id] = _utxo(row, "")
+                    break
+        return [utxos[i] for i in input_ids if i in utxos]
+
+    def _batch_transaction(
+        self, session: orm.Session, facts: ChunkFacts, tx_hash: str, slot: int, fee: int, input_ids: List[str]
+    ):
+        """
+        Step 2 for one transaction, see BlockParser.process_tx.
+        """
+        order_ids = [i for i in input_ids if i in self.order_ids]
+        input_utxos = self._resolve_inputs(session, input_ids)
+        orders = self.writer.get_orders(session, order_ids)
+        if len(input_utxos) + len(order_ids) != len(input_ids):
+            try:
+                missing_utxos, missing_orders = self.fallback.missing_inputs(
+                    tx_hash, input_ids, [utxo.id for utxo in input_utxos], order_ids
+                )
+            except Exception as e:
+                _LOGGER.error(f"Error fetching UTxOs: {e}")
+                return
+            input_utxos.extend(missing_utxos)
+            orders.extend(missing_orders)
+        outputs = [
+            _utxo(row, "") for row in facts.outputs_of(tx_hash) if row[3] == _UTXO
+        ]
+        batcher_id, ada_profit, net_assets, equivalent_ada = util.calculate_analytics(
+            inputs=util.filter_utxos(input_utxos),
+            outputs=util.filter_utxos(outputs),
+            orders=orders,
+            session=session,
+            price_provider=self.price_provider,
+            batcher_index=self.batcher_index,
+        )
+        transaction = Transaction(
+            ada_profit=ada_profit,
+            network_fee=fee,
+            equivalent_ada=equivalent_ada,
+            net_assets=net_assets,
+            slot=slot,
+            tx_hash=tx_hash,
+        )
+        self.writer.add_transaction(session, transaction, batcher_id, orders)
+        self.transactions += 1
+
+    def _merge_transactions(self):
+        with orm.Session(self.engine) as session:
+            self.batcher_index.load(session)
+        for facts, after_slot in self.windows:
+            with orm.Session(self.engine) as session:
+                stored = set(
+                    session.scalars(
+                        sqla.select(Transaction.tx_hash).where(Transaction.slot > after_slot)
+                    )
+                )
+                for tx_hash, slot, _, fee, inputs, parsed in facts.transactions(after_slot):
+                    input_ids = orjson.loads(inputs)
+                    if not parsed or tx_hash in stored or not any(i in self.order_ids for i in input_ids):
+                        continue
+                    try:
+                        self._batch_transaction(session, facts, tx_hash, slot, fee, input_ids)
+                    except Exception as e:
+                        _LOGGER.error(f"Error processing tx: {e}")
+                self.writer.flush(session)
+                session.commit()
+
+    def _insert_batcher_outputs(self):
+        for facts, after_slot in self.windows:
+            with orm.Session(self.engine) as session:
+                block_hashes = facts.blocks(after_slot)
+                rows = [
+                    self._utxo_row(row, block_hashes[row[2]][0])
+                    for row in facts.outputs(after_slot, _UTXO)
+                    if row[4] in self.batcher_index
+                ]
+                _insert_ignore(session, UTxO.__table__, rows)
+                session.commit()
+
+    def _mark_spent(self):
+        for facts, after_slot in self.windows:
+            with orm.Session(self.engine) as session:
+                spends = []
+                for _, slot, _, _, inputs, _ in facts.transactions(after_slot):
+                    spends.extend((i, slot) for i in orjson.loads(inputs))
+                    if len(spends) >= _MERGE_BATCH:
+                        update_by_id(session, UTxO, "spent_slot", BigInteger, spends, self.is_postgres)
+                        spends = []
+                update_by_id(session, UTxO, "spent_slot", BigInteger, spends, self.is_postgres)
+                session.commit()
+
+    def _advance_cursor(self):
+        facts, after_slot = self.windows[-1]
+        blocks = sorted(facts.blocks(after_slot).items())
+        headers = [
+            {"slot": slot, "hash": block_hash, "height": height}
+            for slot, (block_hash, height) in blocks[-SECURITY_PARAM:]
+        ]
+        slot, (block_hash, height) = blocks[-1]
+        with orm.Session(self.engine) as session:
+            _insert_ignore(session, BlockHeader.__table__, headers)
+            session.execute(sqla.delete(BlockHeader).where(BlockHeader.height <= height - SECURITY_PARAM))
+            session.merge(ChainCursor(id=1, slot=slot, hash=block_hash, height=height))
+            session.commit()
+        return slot
+
+    def merge(self):
+        if not self.windows:
+            _LOGGER.info(f"Nothing to merge after slot {self.cursor_slot}")
+            return
+        start = time.monotonic()
+        if UTXO_PARTITIONED:
+            self._ensure_partitions()
+        order_txs = self._insert_outputs()
+        _LOGGER.info(f"Inserted outputs ({len(order_txs)} order transactions)")
+        self._merge_transactions()
+        _LOGGER.info(f"Merged {self.transactions} batch transactions")
+        if self.ingest_mode != "full":
+            self._insert_batcher_outputs()
+        self._mark_spent()
+        slot = self._advance_cursor()
+        _LOGGER.info(
+            f"Merged {len(self.windows)} chunks up to slot {slot}"
+            f" in {time.monotonic() - start:.1f} s"
+        )
+
+    def close(self):
+        for facts, _ in self.windows:
+            facts.close()
+
+
+def backfill(
+    start: Tuple[int, str],
+    end: Tuple[int, str],
+    num_chunks: int,
+    workers: int = BACKFILL_WORKERS,
+    directory: str = BACKFILL_DIR,
+    checkpoints: List[Tuple[int, str]] = None,
+):
+    """
+    Fetches the chunks of (start, end] in parallel, one process and Ogmios
+    connection each, then merges them into the database.
+    """
+    os.makedirs(directory, exist_ok=True)
+    chunks = plan_chunks(start, end, num_chunks, checkpoints)
+    _LOGGER.info(f"Backfilling {len(chunks)} chunks with {workers} workers: {chunks}")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        paths = list(pool.map(fetch_chunk, chunks, [directory] * len(chunks)))
+    merger = BackfillMerger(paths)
+    try:
+        merger.merge()
+    finally:
+        merger.close()
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(
+        description="Parallel historical backfill, see querier/backfill.py"
+    )
+    argp.add_argument("--to-slot", type=int, required=True, help="Last slot of the backfill")
+    argp.add_argument("--to-hash", help="Hash of the last block, looked up on Blockfrost if omitted")
+    argp.add_argument("--chunks", type=int, default=BACKFILL_WORKERS)
+    argp.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    argp.add_argument("--dir", default=BACKFILL_DIR, help="Directory of the facts files")
+    argp.add_argument(
+        "--checkpoints", help='File with one "slot hash" per line to split the range at'
+    )
+    args = argp.parse_args()
+
+    cursor = get_chain_cursor()
+    start = (cursor.slot, cursor.hash) if cursor else (DEFAULT_START_SLOT, DEFAULT_START_HASH)
+    end = (args.to_slot, args.to_hash) if args.to_hash else find_checkpoint(args.to_slot)
+    backfill(
+        start,
+        end,
+        num_chunks=args.chunks,
+        workers=args.workers,
+        directory=args.dir,
+        checkpoints=load_checkpoints(args.checkpoints) if args.checkpoints else None,
+    )
@@ -0,0 +1,257 @@
+import logging
+from typing import Callable, Iterable, List, Optional
+
+import sqlalchemy as sqla
+from sqlalchemy.orm import Session
+
+from common.db import Batcher, BatcherAddress, BatcherChange, Transaction
+from . import rollups
+from .journal import BlockUndo
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class BatcherIndex:
+    """
+    In-memory index of batcher addresses, kept in sync with the Batcher and
+    BatcherAddress tables.
+
+    Batchers form a disjoint-set forest: merging two batchers links the root of
+    the smaller one (fewer addresses, or the newer one on ties) to the other, so
+    finding the batcher of an address is a dictionary lookup plus a nearly
+    constant find. The addresses of each root are kept, so that merges only move
+    the addresses of the smaller batchers. In the database every row always points to a root, merges are
+    written with one UPDATE per table and fold the rollups of the batchers.
+
+    Ids of batchers absorbed within the current batch may still be referenced by
+    pending rows of the writer, which resolves them with `find` when flushing.
+
+    While a journal is set, new batchers, addresses and merges are recorded in it
+    and in the BatcherChange table, so that rollbacks can revert them.
+    """
+
+    def __init__(
+        self,
+        on_new_address: Callable[[str], None] = None,
+        before_merge: Callable[[Session], None] = None,
+    ):
+        self.address_to_batcher = {}  # address -> batcher id at insertion time
+        self.parent = {}  # batcher id -> parent batcher id, roots point to themselves
+        self.members = {}  # root batcher id -> its addresses
+        self.on_new_address = on_new_address
+        # called before merging, e.g. to write pending transactions so that the merge covers them
+        self.before_merge = before_merge
+        # UndoJournal of the parser, if set
+        self.journal = None
+
+        # statistics
+        self.merges = 0
+
+    def load(self, session: Session):
+        self.address_to_batcher.clear()
+        self.parent.clear()
+        self.members.clear()
+        for address, batcher_id in session.execute(
+            sqla.select(BatcherAddress.address, BatcherAddress.batcher_id)
+        ):
+            self._add_address(address, batcher_id)
+        _LOGGER.info(
+            f"Loaded {len(self.address_to_batcher)} addresses of {len(self.members)} batchers"
+        )
+
+    def restore(self, address_to_batcher: dict, parent: dict):
+        """
+        Sets the state saved by a snapshot, the addresses of each root are derived.
+        """
+        self.address_to_batcher = address_to_batcher
+        self.parent = parent
+        self.members = {r: set() for r, p in parent.items() if r == p}
+        for address in address_to_batcher:
+            self.members[self.batcher_of(address)].add(address)
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.address_to_batcher
+
+    def __iter__(self):
+        return iter(self.address_to_batcher)
+
+    def __len__(self) -> int:
+        return len(self.address_to_batcher)
+
+    def find(self, batcher_id: Optional[int]) -> Optional[int]:
+        if batcher_id is None:
+            return None
+        root = batcher_id
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        # path compression
+        while batcher_id != root:
+            self.parent[batcher_id], batcher_id = root, self.parent[batcher_id]
+        return root
+
+    def batcher_of(self, address: str) -> Optional[int]:
+        return self.find(self.address_to_batcher.get(address))
+
+    def _add_address(self, address: str, batcher_id: int):
+        self.parent.setdefault(batcher_id, batcher_id)
+        self.address_to_batcher[address] = batcher_id
+        self.members.setdefault(batcher_id, set()).add(address)
+
+    def _new_batcher(self, session: Session) -> int:
+        batcher_id = session.scalar(sqla.insert(Batcher).returning(Batcher.id))
+        self.parent[batcher_id] = batcher_id
+        self.members[batcher_id] = set()
+        self._record(session, ("batcher", batcher_id))
+        return batcher_id
+
+    def _record(self, session: Session, change: tuple):
+        if self.journal is None:
+            return
+        self.journal.current.batchers.append(change)
+        session.execute(
+            sqla.insert(BatcherChange.__table__).values(
+                slot=self.journal.current.slot, change=list(change)
+            )
+        )
+
+    def _merge(self, session: Session, roots: List[int]) -> int:
+        if self.before_merge is not None:
+            self.before_merge(session)
+        winner = max(roots, key=lambda r: (len(self.members[r]), -r))
+        absorbed = [r for r in roots if r != winner]
+        addresses = {}
+        for root in absorbed:
+            self.parent[root] = winner
+            addresses[root] = self.members.pop(root)
+            self.members[winner] |= addresses[root]
+        self.merges += len(absorbed)
+
+        session.execute(
+            sqla.update(BatcherAddress.__table__)
+            .where(BatcherAddress.batcher_id.in_(absorbed))
+            .values(batcher_id=winner)
+        )
+        for root in absorbed:
+            transaction_ids = session.scalars(
+                sqla.update(Transaction.__table__)
+                .where(Transaction.batcher_id == root)
+                .values(batcher_id=winner)
+                .returning(Transaction.id)
+            ).all()
+            self._record(
+                session, ("merge", winner, root, list(addresses[root]), list(transaction_ids))
+            )
+        rollups.merge(session, winner, absorbed)
+        session.execute(sqla.delete(Batcher.__table__).where(Batcher.id.in_(absorbed)))
+        _LOGGER.info(f"Merged batchers {absorbed} into {winner}")
+        return winner
+
+    def attribute(self, session: Session, addresses: Iterable[str]) -> Optional[int]:
+        """
+        Returns the id of the batcher owning the given addresses, creating it if
+        none of them is known and merging batchers if they belong to several.
+        Unknown addresses are added to the batcher.
+        """
+        addresses = list(addresses)
+        if not addresses:
+            return None
+
+        roots = []
+        unassociated_addresses = []
+        for address in addresses:
+            root = self.batcher_of(address)
+            if root is None:
+                unassociated_addresses.append(address)
+            elif root not in roots:
+                roots.append(root)
+
+        if not roots:
+            batcher_id = self._new_batcher(session)
+        elif len(roots) == 1:
+            batcher_id = roots[0]
+        else:
+            batcher_id = self._merge(session, roots)
+
+        if unassociated_addresses:
+            session.execute(
+                sqla.insert(BatcherAddress.__table__),
+                [{"address": a, "batcher_id": batcher_id} for a in unassociated_addresses],
+            )
+            for address in unassociated_addresses:
+                self._add_address(address, batcher_id)
+                self._record(session, ("address", address, batcher_id))
+                if self.on_new_address is not None:
+                    self.on_new_address(address)
+        return batcher_id
+
+    def undo(self, undo: BlockUndo):
+        """
+        Reverts the batchers, addresses and merges of a rolled back block in memory,
+        revert_changes reverts them in the database.
+        """
+        for op, *args in reversed(undo.batchers):
+            if op == "batcher":
+                (batcher_id,) = args
+                del self.parent[batcher_id]
+                del self.members[batcher_id]
+            elif op == "address":
+                address, batcher_id = args
+                del self.address_to_batcher[address]
+                self.members[self.find(batcher_id)].discard(address)
+            else:
+                winner, absorbed, addresses, _ = args
+                # other ids may have been compressed to point to the winner,
+                # so the addresses are pointed to the absorbed batcher directly
+                self.parent[absorbed] = absorbed
+                self.members[absorbed] = set(addresses)
+                self.members[winner] -= self.members[absorbed]
+                for address in addresses:
+                    self.address_to_batcher[address] = absorbed
+                self.merges -= 1
+
+    def stats(self) -> dict:
+        return {
+            "addresses": len(self.address_to_batcher),
+            "batchers": len(self.members),
+            "merges": self.merges,
+        }
+
+
+def revert_changes(session: Session, slot: int):
+    """
+    Reverts the batcher changes recorded after `slot` in the database, newest first.
+    The transactions after `slot` must already be deleted.
+    """
+    changes = session.execute(
+        sqla.select(BatcherChange.id, BatcherChange.change)
+        .where(BatcherChange.slot > slot)
+        .order_by(BatcherChange.id.desc())
+    ).all()
+    for _, (op, *args) in changes:
+        if op == "batcher":
+            (batcher_id,) = args
+            session.execute(sqla.delete(Batcher.__table__).where(Batcher.id == batcher_id))
+        elif op == "address":
+            address, _ = args
+            session.execute(
+                sqla.delete(BatcherAddress.__table__).where(BatcherAddress.address == address)
+            )
+        else:
+            winner, absorbed, addresses, transaction_ids = args
+            session.execute(sqla.insert(Batcher.__table__).values(id=absorbed))
+            if addresses:
+                session.execute(
+                    sqla.update(BatcherAddress.__table__)
+                    .where(BatcherAddress.address.in_(addresses))
+                    .values(batcher_id=absorbed)
+                )
+            if transaction_ids:
+                session.execute(
+                    sqla.update(Transaction.__table__)
+                    .where(Transaction.id.in_(transaction_ids))
+                    .values(batcher_id=absorbed)
+                )
+            # min and max cannot be split again, merges are rare
+            rollups.rebuild(session, batcher_ids=[winner, absorbed])
+    if changes:
+        session.execute(sqla.delete(BatcherChange.__table__).where(BatcherChange.slot > slot))
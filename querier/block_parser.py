@@ -4,14 +4,57 @@ import ogmios
 from ogmios.datatypes import Block
 import datetime
 import logging
+import time
+from typing import Optional
 import pycardano
-import ipdb
 
 import querier.util as util
-from common.db import UTxO, Order, _ENGINE, Transaction
+from common.db import (
+    UTXO_PARTITIONED,
+    BlockHeader,
+    UTxO,
+    Order,
+    _ENGINE,
+    ChainCursor,
+    Transaction,
+    get_chain_cursor,
+    get_max_slot_block_and_index,
+)
 from common.util import slot_timestamp
-from .cleanup import remove_spent_utxos
-from .config import BLOCKFROST, MUESLI_ADDR_TO_VERSION
+from . import metrics, rollups
+from .batchers import BatcherIndex
+from .cache import UTxOCache
+from .cleanup import UTxOPruner, ensure_partitions
+from .decode import DatumDecoder
+from .fallback import FallbackResolver
+from .journal import UndoJournal
+from .ogmios import ChainRollback
+from .prefilter import TransactionPrefilter
+from .profiler import PROFILER
+from .prices import PriceProvider, make_price_provider
+from .resolver import InputResolver
+from .rollback import revert_after
+from .snapshot import StateSnapshot
+from .writer import make_writer
+from .config import (
+    DATUM_WORKERS,
+    INGEST_MODE,
+    MUESLI_ADDR_TO_VERSION,
+    GROUP_COMMIT_BLOCKS,
+    GROUP_COMMIT_MS,
+    LIVE_MODE_LAG,
+    PREFILTER,
+    PRICE_BACKEND,
+    PROFILE_BLOCKS,
+    PRUNE_INTERVAL,
+    SNAPSHOT_INTERVAL,
+    SNAPSHOT_PATH,
+    UTXO_CACHE_SIZE,
+    UTXO_CACHE_MAX_AGE,
+    UTXO_BLOOM_CAPACITY,
+    UTXO_BLOOM_ERROR_RATE,
+    WRITE_PATH,
+)
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -20,51 +63,347 @@ _LOGGER = logging.getLogger(__name__)
 class BlockParser:
     engine: sqla.Engine
 
-    def __init__(self, iterator):
+    def __init__(
+        self,
+        iterator,
+        input_resolver: InputResolver = None,
+        price_provider: PriceProvider = None,
+        fallback: FallbackResolver = None,
+        datum_decoder: DatumDecoder = None,
+        write_path: str = WRITE_PATH,
+    ):
         self.iterator = iterator
+        self.input_resolver = input_resolver
+        self.price_provider = price_provider or make_price_provider(PRICE_BACKEND)
+        self.fallback = fallback or FallbackResolver()
+        self.datum_decoder = datum_decoder or DatumDecoder(workers=DATUM_WORKERS)
         self.engine = _ENGINE
+        self.batcher_index = BatcherIndex()
+        self.writer = make_writer(write_path, self.engine, self.batcher_index)
         self.current_slot = -1
+        self.pending_blocks = 0
+        self.batch_start = time.monotonic()
+        self.pruner = UTxOPruner()
+        # slot from which on the next UTxO partition is needed
+        self.partitions_until = -1
+        # (slot, hash, height) of the latest processed block
+        self.last_block = None
+        self.blocks_since_snapshot = 0
 
-        self.open_orders = util.initialise_open_orders(engine=self.engine)
+        # blocks after the latest one in the database can be reverted from the journal
+        self.journal = UndoJournal(base_slot=get_max_slot_block_and_index()[0])
+        self.batcher_index.journal = self.journal
+        # the merge must also move the pending transactions of the absorbed batchers
+        self.batcher_index.before_merge = self.writer.flush
+        self.utxo_cache = UTxOCache(
+            max_size=UTXO_CACHE_SIZE,
+            max_age=UTXO_CACHE_MAX_AGE,
+            bloom_capacity=UTXO_BLOOM_CAPACITY,
+            bloom_error_rate=UTXO_BLOOM_ERROR_RATE,
+        )
+        metrics.watch(self)
+        rollups.ensure(self.engine)
+        snapshot = self.load_snapshot()
+        self.load_state(snapshot)
+        if snapshot is None:
+            with orm.Session(self.engine) as session:
+                self.utxo_cache.load(session)
+
+    def load_snapshot(self) -> StateSnapshot:
+        """
+        The snapshot of the in-memory state, if it was taken at the chain cursor.
+        """
+        if not SNAPSHOT_PATH:
+            return None
+        start = time.monotonic()
+        snapshot = StateSnapshot.load(SNAPSHOT_PATH)
+        if snapshot is None:
+            return None
+        cursor = get_chain_cursor()
+        if cursor is None or not snapshot.matches(cursor.slot, cursor.hash):
+            _LOGGER.warning(
+                f"Ignoring snapshot at slot {snapshot.slot}, it does not match the chain cursor"
+            )
+            return None
+        _LOGGER.info(
+            f"Loaded snapshot at slot {snapshot.slot}"
+            f" in {(time.monotonic() - start) * 1000:.0f} ms"
+        )
+        return snapshot
+
+    def save_snapshot(self):
+        # only called right after a commit, so the state matches the chain cursor
+        if not SNAPSHOT_PATH or self.last_block is None:
+            return
+        slot, block_hash, _ = self.last_block
+        StateSnapshot(
+            slot,
+            block_hash,
+            list(self.open_orders),
+            self.batcher_index,
+            self.utxo_cache.bloom,
+        ).save(SNAPSHOT_PATH)
+        self.blocks_since_snapshot = 0
+
+    def load_state(self, snapshot: StateSnapshot = None):
+        """
+        (Re)load the open orders and batcher addresses from the snapshot if given,
+        otherwise from the database.
+        """
+        if snapshot is not None:
+            self.open_orders = dict.fromkeys(snapshot.open_orders, True)
+            self.batcher_index.address_to_batcher = snapshot.batcher_index.address_to_batcher
+            self.batcher_index.parent = snapshot.batcher_index.parent
+            self.batcher_index.members = snapshot.batcher_index.members
+            self.utxo_cache.bloom = snapshot.bloom
+        else:
+            self.open_orders = util.initialise_open_orders(engine=self.engine)
+            with orm.Session(self.engine) as session:
+                self.batcher_index.load(session)
+        self.prefilter = None
+        self.batcher_index.on_new_address = None
+        if PREFILTER:
+            self.prefilter = TransactionPrefilter(
+                order_addresses=MUESLI_ADDR_TO_VERSION,
+                batcher_addresses=self.batcher_index,
+                open_orders=self.open_orders,
+            )
+            self.batcher_index.on_new_address = self.prefilter.add_pattern
+
+    def _set_order_open(self, order_id: str, is_open: bool):
+        if is_open:
+            self.open_orders[order_id] = True
+            if self.prefilter:
+                self.prefilter.add_open_order(order_id)
+        else:
+            del self.open_orders[order_id]
+            if self.prefilter:
+                self.prefilter.remove_open_order(order_id)
 
     def add_open_order(self, utxo_id: str):
-        self.open_orders[utxo_id] = True
+        self._set_order_open(utxo_id, True)
+        self.journal.current.orders.append((utxo_id, True))
 
     def remove_open_order(self, tx_id: str):
-        del self.open_orders[tx_id]
+        self._set_order_open(tx_id, False)
+        self.journal.current.orders.append((tx_id, False))
 
-    def run(self):
-        for i, block in enumerate(self.iterator.iterate_blocks()):
+    def rollback(self, slot: int, block_hash: str):
+        """
+        Reverts all blocks after the given one, which must be committed.
+        The database is reverted by slot and from the recorded batcher changes,
+        the in-memory state with the undo journal if it covers the blocks,
+        otherwise it is reloaded.
+        """
+        start = time.monotonic()
+        metrics.ROLLBACKS.inc()
+        undone = self.journal.pop_after(slot) if self.journal.covers(slot) else None
+        with orm.Session(self.engine) as session:
+            revert_after(session, slot)
+            height = session.scalar(
+                sqla.select(BlockHeader.height).where(BlockHeader.slot == slot)
+            )
+            self.last_block = (slot, block_hash, height)
+            session.merge(ChainCursor(id=1, slot=slot, hash=block_hash, height=height))
+            session.commit()
+
+        if undone is None:
+            _LOGGER.warning(f"Rollback to {slot} is not journaled, reloading state")
+            self.journal.clear(base_slot=slot)
+            self.load_state()
+            # UTxOs spent by the reverted blocks are unspent again
             with orm.Session(self.engine) as session:
-                try:
-                    self.process_block(block, session)
-                except Exception as e:
-                    ipdb.post_mortem()
-                session.commit()
-            if i % 1000 == 0:
-                oldest_slot = remove_spent_utxos(self.current_slot)
-                _LOGGER.info(f"Removed spent UTxOs up to slot {oldest_slot}")
+                self.utxo_cache.load(session)
+        else:
+            for undo in undone:
+                self.batcher_index.undo(undo)
+                for order_id, opened in reversed(undo.orders):
+                    self._set_order_open(order_id, not opened)
+        self.utxo_cache.discard_after(slot)
+        self.current_slot = slot
+        _LOGGER.warning(
+            f"Rolled back to {slot}.{block_hash}"
+            f" ({len(undone) if undone is not None else 'unknown number of'} blocks)"
+            f" in {(time.monotonic() - start) * 1000:.1f} ms"
+        )
+
+    def run(self):
+        session = None
+        i = -1
+        for block in self.iterator.iterate_blocks(timeout=self.commit_timeout):
+            if block is None:
+                # no block arrived before the group commit deadline
+                if session is not None and self.commit_timeout() == 0:
+                    self.commit(session)
+                    session = None
+                continue
+            i += 1
+            if isinstance(block, ChainRollback):
+                if session is not None:
+                    self.commit(session)
+                    session = None
+                self.rollback(block.slot, block.id)
+                continue
+            if session is None:
+                session = orm.Session(self.engine)
+                self.batch_start = time.monotonic()
+            try:
+                self.process_block(block, session)
+            except Exception:
+                # the batch is not committed, so a restart resumes after the last
+                # committed block instead of skipping this one
+                _LOGGER.exception(f"Exception while processing block {block.slot}")
+                session.rollback()
+                session.close()
+                raise
+            self.pending_blocks += 1
+            if i % 1000 == 0 or self.should_commit(block):
+                self.commit(session)
+                session = None
+            self.housekeeping(i)
+        if session is not None:
+            self.commit(session)
+        self.close()
+
+    def housekeeping(self, i: int):
+        """
+        Periodic work after the i-th block: snapshots, pruning and statistics.
+        """
+        if self.blocks_since_snapshot >= SNAPSHOT_INTERVAL and self.pending_blocks == 0:
+            self.save_snapshot()
+        if i % PRUNE_INTERVAL == 0:
+            self.pruner.request(self.current_slot)
+        if i % PROFILE_BLOCKS == 0 and i and PROFILER.running:
+            PROFILER.dump(self.current_slot)
+        if i % 1000 == 0:
+            _LOGGER.info(f"Block buffer: {self.iterator.stats()}")
+            _LOGGER.info(f"UTxO cache: {self.utxo_cache.stats()}")
+            _LOGGER.info(f"Datum decoder: {self.datum_decoder.stats()}")
+            if self.prefilter:
+                _LOGGER.info(f"Prefilter: {self.prefilter.stats()}")
+            _LOGGER.info(f"Batcher index: {self.batcher_index.stats()}")
+            if self.utxo_cache.bloom.is_saturated:
+                # spent UTxOs are never removed from the bloom filter
+                with orm.Session(self.engine) as session:
+                    self.utxo_cache.load(session)
+
+    def close(self):
+        # only called after the last commit
+        self.save_snapshot()
+        self.pruner.stop()
+
+    def should_commit(self, block) -> bool:
+        """
+        Group commit: during catch-up, several blocks are committed in one
+        transaction. Close to the tip, every block is committed on its own.
+        """
+        if self.pending_blocks >= GROUP_COMMIT_BLOCKS:
+            return True
+        if (time.monotonic() - self.batch_start) * 1000 >= GROUP_COMMIT_MS:
+            return True
+        return time.time() - slot_timestamp(block.slot) < LIVE_MODE_LAG
+
+    def commit_timeout(self) -> Optional[float]:
+        """
+        Seconds until the pending blocks are due to be committed, None if there are none.
+        """
+        if not self.pending_blocks:
+            return None
+        return max(self.batch_start + GROUP_COMMIT_MS / 1000 - time.monotonic(), 0)
+
+    def commit(self, session):
+        # all blocks of a batch become visible at once, so the latest block
+        # in the database is always completely processed
+        with metrics.COMMIT.time():
+            self.writer.flush(session)
+            if self.last_block is not None:
+                slot, block_hash, height = self.last_block
+                session.merge(ChainCursor(id=1, slot=slot, hash=block_hash, height=height))
+            session.commit()
+        session.close()
+        self.pending_blocks = 0
 
     def process_block(self, block: Block, session):
         self.current_slot = block.slot
         block_time = datetime.datetime.fromtimestamp(slot_timestamp(self.current_slot))
         _LOGGER.info(f"Processing block: {block.height} ({block_time.isoformat()})")
+        if UTXO_PARTITIONED and self.current_slot >= self.partitions_until:
+            self.partitions_until = ensure_partitions(session, self.current_slot)
 
-        for tx in block.transactions:
+        self.journal.start_block(block.slot, block.id, block.height)
+        self.last_block = (block.slot, block.id, block.height)
+        self.blocks_since_snapshot += 1
+        self.writer.add_block(block.slot, block.id, block.height)
+        relevant = None
+        if self.prefilter:
+            relevant = self.prefilter.relevant_transactions(block.transactions)
+        with metrics.DECODE.time():
+            parties = self.datum_decoder.decode_block(block)
+        for idx, tx in enumerate(block.transactions):
             # TODO add error handling here if necessary
             try:
-                self.process_tx(tx, block, session)
+                if relevant is None or idx in relevant:
+                    self.process_tx(tx, block, session, parties)
+                else:
+                    self.process_plain_tx(tx, block, session, parties)
             except Exception as e:
                 _LOGGER.error(f"Error processing tx: {e}")
+        self.utxo_cache.evict(self.current_slot)
+        metrics.BLOCKS.inc()
+        metrics.TRANSACTIONS.inc(len(block.transactions))
+        metrics.set_slot(block.slot)
 
-    def process_tx(self, tx, block, session):
+    def resolve_input(self, input_id: str, session) -> UTxO:
+        utxo = self.utxo_cache.get(input_id)
+        if utxo is None and self.utxo_cache.might_exist(input_id):
+            utxo = self.writer.get_utxo(input_id)
+            if utxo is None:
+                utxo = session.query(UTxO).filter_by(id=input_id).first()
+        return utxo
+
+    def process_plain_tx(self, tx, block, session, parties: dict):
+        """
+        Bookkeeping for transactions that cannot involve orders or batchers
+        (see TransactionPrefilter): spend marks and, in "full" mode, plain outputs.
+        """
+        input_ids = [f"{d['transaction']['id']}#{d['index']}" for d in tx["inputs"]]
+        if any(input_id in self.open_orders for input_id in input_ids):
+            # spends an order created earlier in the same block, after the prefilter scan
+            return self.process_tx(tx, block, session, parties)
+        for input_id in input_ids:
+            # no lookup needed: the spend marks skip ids that are not stored,
+            # so only inputs that are certainly not stored are left out
+            self.utxo_cache.discard(input_id)
+            if self.utxo_cache.might_exist(input_id):
+                self.writer.mark_spent(input_id, self.current_slot)
+        if INGEST_MODE != "full":
+            return
+        output_utxos = [
+            UTxO(
+                id=f"{tx['id']}#{idx}",
+                value=output["value"],
+                owner=output["address"],
+                created_slot=self.current_slot,
+                block_hash=block.id,
+                role=util.address_role(output["address"]),
+            )
+            for idx, output in enumerate(tx["outputs"])
+        ]
+        for output_utxo in output_utxos:
+            self.utxo_cache.add(output_utxo)
+        self.writer.add_outputs(session, output_utxos)
+
+    def process_tx(self, tx, block, session, parties: dict):
+        resolve_start = time.perf_counter()
         order_ids = []
         input_ids = [f"{d['transaction']['id']}#{d['index']}" for d in tx["inputs"]]
+        input_utxos = []
         calculate_analytics = False
         for input_id in input_ids:
-            utxo = session.query(UTxO).filter_by(id=input_id).first()
+            utxo = self.resolve_input(input_id, session)
             if utxo:
-                utxo.spent_slot = self.current_slot
+                self.writer.mark_spent(input_id, self.current_slot)
+                input_utxos.append(utxo)
             if input_id in self.open_orders:
                 # smart_contract_version = self.open_orders[input_utxo_id]
                 # TODO: investigate muesli_orders logic
@@ -73,50 +412,39 @@ class BlockParser:
                 self.remove_open_order(input_id)
                 order_ids.append(input_id)
         if calculate_analytics:
-            input_utxos = session.query(UTxO).filter(UTxO.id.in_(input_ids)).all()
-            orders = session.query(Order).filter(Order.id.in_(order_ids)).all()
+            orders = self.writer.get_orders(session, order_ids)
+
+            if self.input_resolver and (len(input_utxos) + len(order_ids)) != len(
+                input_ids
+            ):
+                stored_ids = {utxo.id for utxo in input_utxos}
+                missing_ids = [
+                    input_id
+                    for input_id in input_ids
+                    if input_id not in stored_ids and input_id not in order_ids
+                ]
+                input_utxos.extend(self.input_resolver.resolve(missing_ids).values())
 
             # Number of cash UTxOs plus number of order UTxOs should equal total number of inputs
             if (len(input_utxos) + len(order_ids)) != len(input_ids):
                 try:
-                    utxos = BLOCKFROST.transaction_utxos(tx["id"])
-                    stored_ids = [utxo.id for utxo in input_utxos]
-
-                    for utxo in utxos.inputs:
-                        input_id = f"{utxo.tx_hash}#{utxo.output_index}"
-                        # fmt: off
-                        if (
-                            input_id not in stored_ids # Make sure we don't add duplicates
-                            and input_id in input_ids # Make sure the input is actually in the transaction
-                            and input_id not in order_ids # Make sure the input is not an order
-                        ):
-                        # fmt: on
-                            if utxo.address not in MUESLI_ADDR_TO_VERSION:
-                                input_utxos.append(
-                                    UTxO(
-                                        id=input_id,
-                                        value=util.parse_value_bf_to_ogmios(utxo.amount),
-                                        owner=utxo.address,
-                                        created_slot=0,  
-                                        block_hash="",  
-                                    )
-                                )
-                                
-                            else:
-                                sender, recipient = util.parse_bf_datum(utxo, MUESLI_ADDR_TO_VERSION[utxo.address])
-                                orders.append(
-                                    Order(
-                                        id=input_id,
-                                        sender=sender,
-                                        recipient=recipient,
-                                        slot=0, 
-                                    )
-                                )
-                                order_ids.append(input_id)
-                            stored_ids.append(input_id)
+                    missing_utxos, missing_orders = self.fallback.missing_inputs(
+                        tx["id"], input_ids, [utxo.id for utxo in input_utxos], order_ids
+                    )
                 except Exception as e:
                     _LOGGER.error(f"Error fetching UTxOs: {e}")
                     return
+                input_utxos.extend(missing_utxos)
+                orders.extend(missing_orders)
+                order_ids.extend(order.id for order in missing_orders)
+        metrics.RESOLVE.observe(time.perf_counter() - resolve_start)
+        # In "relevant" mode, only outputs of transactions that create or spend orders
+        # and outputs to known batcher addresses are stored, other inputs are resolved on demand
+        store_all_outputs = (
+            INGEST_MODE == "full"
+            or calculate_analytics
+            or any(output["address"] in MUESLI_ADDR_TO_VERSION for output in tx["outputs"])
+        )
         output_utxos = [
             util.parse_output(
                 tx=tx,
@@ -124,32 +452,36 @@ class BlockParser:
                 id=f"{tx['id']}#{idx}",
                 slot=self.current_slot,
                 block_hash=block.id,
+                parties=parties.get(f"{tx['id']}#{idx}"),
             )
             for idx, output in enumerate(tx["outputs"])
+            if store_all_outputs or output["address"] in self.batcher_index
         ]
 
         for output_utxo in output_utxos:
             if isinstance(output_utxo, Order):
                 self.add_open_order(output_utxo.id)
-        session.add_all(output_utxos)
+            else:
+                self.utxo_cache.add(output_utxo)
+        self.writer.add_outputs(session, output_utxos)
 
         if calculate_analytics:
             network_fee = tx["fee"]["ada"]["lovelace"]
-            batcher, ada_profit, net_assets, equivalent_ada = util.calculate_analytics(
-                inputs=util.filter_utxos(input_utxos),
-                outputs=util.filter_utxos(output_utxos),
-                orders=orders,
-                session=session,
-            )
-            session.add(
-                Transaction(
-                    batcher=batcher,
-                    ada_profit=ada_profit,
-                    network_fee=network_fee,
-                    equivalent_ada=equivalent_ada,
-                    net_assets=net_assets,
-                    slot=self.current_slot,
+            with metrics.ANALYTICS.time():
+                batcher_id, ada_profit, net_assets, equivalent_ada = util.calculate_analytics(
+                    inputs=util.filter_utxos(input_utxos),
+                    outputs=util.filter_utxos(output_utxos),
                     orders=orders,
-                    tx_hash=tx["id"],
+                    session=session,
+                    price_provider=self.price_provider,
+                    batcher_index=self.batcher_index,
                 )
+            transaction = Transaction(
+                ada_profit=ada_profit,
+                network_fee=network_fee,
+                equivalent_ada=equivalent_ada,
+                net_assets=net_assets,
+                slot=self.current_slot,
+                tx_hash=tx["id"],
             )
+            self.writer.add_transaction(session, transaction, batcher_id, orders)
@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from .config import GROUP_COMMIT_BLOCKS, QUEUE_MAX_BLOCKS, QUEUE_MAX_BYTES
+
+# rough size of a transaction in memory if the block does not report its size
+_ESTIMATED_TX_BYTES = 16 * 1024
+
+
+def estimate_block_size(block) -> int:
+    """
+    Estimate the memory footprint of a block from the size reported by Ogmios,
+    falling back to a per-transaction estimate.
+    """
+    size = getattr(block, "size", None)
+    if isinstance(size, dict):
+        size = size.get("bytes")
+    if isinstance(size, int):
+        return size
+    return _ESTIMATED_TX_BYTES * (len(getattr(block, "transactions", None) or ()) + 1)
+
+
+class SynchronizedIterator:
+    """
+    Bounded block buffer between the Ogmios thread (producer) and the
+    block parser (consumer).
+
+    Capacity is limited both in number of blocks and in estimated bytes,
+    including the batch handed to the consumer until it asks for the next one.
+    Producer and consumer block on condition variables instead of polling, and
+    the time each side spends waiting is accumulated for monitoring.
+    """
+
+    def __init__(
+        self,
+        max_blocks: int = QUEUE_MAX_BLOCKS,
+        max_bytes: int = QUEUE_MAX_BYTES,
+        batch_blocks: int = GROUP_COMMIT_BLOCKS,
+    ):
+        self.queue = deque()
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # blocks per batch taken by iterate_blocks
+        self.batch_blocks = batch_blocks
+        # the last batch taken by the consumer, not processed yet
+        self.drained_blocks = 0
+        self.drained_bytes = 0
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self._should_exit = False
+
+        # statistics
+        self.producer_wait_time = 0.0
+        self.consumer_wait_time = 0.0
+        self.max_depth = 0
+
+    @property
+    def should_exit(self) -> bool:
+        return self._should_exit
+
+    @should_exit.setter
+    def should_exit(self, value: bool):
+        with self.lock:
+            self._should_exit = value
+            # wake up both sides so that they notice the exit flag immediately
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def _is_full(self, size: int) -> bool:
+        num_blocks = len(self.queue) + self.drained_blocks
+        if not num_blocks:
+            # always accept a block into an empty buffer, even if it is oversized
+            return False
+        return (
+            num_blocks >= self.max_blocks
+            or self.num_bytes + self.drained_bytes + size > self.max_bytes
+        )
+
+    def submit_block(self, block, timeout: float = None) -> bool:
+        """
+        Put a block into the buffer, blocking while the buffer is full.
+        Returns False if the iterator is shutting down or the timeout expired.
+        """
+        size = estimate_block_size(block)
+        with self.not_full:
+            if self._is_full(size) and not self._should_exit:
+                start = time.monotonic()
+                self.not_full.wait_for(
+                    lambda: self._should_exit or not self._is_full(size), timeout
+                )
+                self.producer_wait_time += time.monotonic() - start
+            if self._should_exit or self._is_full(size):
+                return False
+            self.queue.append((block, size))
+            self.num_bytes += size
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.not_empty.notify()
+        return True
+
+    def get_blocks(self, max_blocks: int = None, timeout: float = None) -> list:
+        """
+        Remove up to max_blocks blocks (all buffered blocks if None) from the
+        buffer, blocking until at least one block is available.
+        Returns an empty list if the iterator is shutting down or the timeout expired.
+        The returned blocks count against the capacity until the next call.
+        """
+        with self.not_empty:
+            if self.drained_blocks:
+                # the previous batch is processed
+                self.drained_blocks = 0
+                self.drained_bytes = 0
+                self.not_full.notify_all()
+            if not self.queue and not self._should_exit:
+                start = time.monotonic()
+                self.not_empty.wait_for(
+                    lambda: self._should_exit or self.queue, timeout
+                )
+                self.consumer_wait_time += time.monotonic() - start
+            if self._should_exit:
+                return []
+            n = len(self.queue) if max_blocks is None else min(max_blocks, len(self.queue))
+            blocks = []
+            for _ in range(n):
+                block, size = self.queue.popleft()
+                self.num_bytes -= size
+                self.drained_bytes += size
+                blocks.append(block)
+            self.drained_blocks = len(blocks)
+        return blocks
+
+    def iterate_blocks(self, timeout: Callable[[], Optional[float]] = None):
+        """
+        Yields the buffered blocks, and None whenever no block arrived within
+        timeout() seconds (waits indefinitely if it returns None), so that the
+        consumer can meet its deadlines while the buffer is empty.
+        """
+        while not self._should_exit:
+            blocks = self.get_blocks(self.batch_blocks, timeout() if timeout else None)
+            if not blocks and not self._should_exit:
+                yield None
+            yield from blocks
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "depth": len(self.queue),
+                "bytes": self.num_bytes,
+                "drained": self.drained_blocks,
+                "max_depth": self.max_depth,
+                "producer_wait_time": self.producer_wait_time,
+                "consumer_wait_time": self.consumer_wait_time,
+            }
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import math
+from collections import OrderedDict
+
+import sqlalchemy as sqla
+from sqlalchemy.orm import Session
+
+from common.db import UTxO
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Probabilistic set membership. May report false positives, never false negatives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    @property
+    def is_saturated(self) -> bool:
+        return self.count > self.capacity
+
+
+class UTxOCache:
+    """
+    Working set of recently created UTxOs, used to resolve transaction inputs
+    without a database round trip.
+
+    - A bloom filter over all unspent UTxO ids in the database lets inputs that
+      were never stored (most inputs on the chain) skip the SELECT entirely.
+    - An LRU of recently created UTxOs, bounded in size and age (in slots),
+      answers most of the remaining lookups from memory.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        max_age: int,
+        bloom_capacity: int,
+        bloom_error_rate: float,
+    ):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        # id -> (owner, value, created_slot, block_hash), ordered by creation
+        self.entries = OrderedDict()
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def load(self, session: Session):
+        """
+        (Re-)build the bloom filter from the unspent UTxOs in the database.
+
+        The filter has room for twice the unspent UTxOs (at least bloom_capacity),
+        otherwise it would be saturated right after loading and reloaded again.
+        """
+        unspent = UTxO.spent_slot == None
+        num_unspent = session.scalar(sqla.select(sqla.func.count()).where(unspent))
+        capacity = max(self.bloom_capacity, 2 * num_unspent)
+        if capacity > self.bloom_capacity:
+            _LOGGER.warning(
+                f"UTXO_BLOOM_CAPACITY {self.bloom_capacity} is too small for {num_unspent}"
+                f" unspent UTxOs, using a capacity of {capacity}"
+            )
+        self.bloom = BloomFilter(capacity, self.bloom_error_rate)
+        stmt = sqla.select(UTxO.id).where(unspent)
+        for (utxo_id,) in session.execute(stmt.execution_options(yield_per=10000)):
+            self.bloom.add(utxo_id)
+        _LOGGER.info(f"Loaded {self.bloom.count} unspent UTxO ids into bloom filter")
+
+    def add(self, utxo: UTxO):
+        self.entries[utxo.id] = (
+            utxo.owner,
+            utxo.value,
+            utxo.created_slot,
+            utxo.block_hash,
+            utxo.role,
+        )
+        self.bloom.add(utxo.id)
+
+    def evict(self, current_slot: int):
+        """
+        Evict the oldest entries if the cache exceeds its size or if they
+        were created more than max_age slots ago.
+        """
+        oldest_slot = current_slot - self.max_age
+        while self.entries:
+            _, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_size and entry[2] >= oldest_slot:
+                break
+            self.entries.popitem(last=False)
+
+    def discard(self, utxo_id: str):
+        self.entries.pop(utxo_id, None)
+
+    def discard_after(self, slot: int):
+        """
+        Removes the entries created after `slot` (rolled back), newest entries are last.
+        """
+        while self.entries:
+            utxo_id, entry = next(reversed(self.entries.items()))
+            if entry[2] <= slot:
+                break
+            self.entries.popitem()
+
+    def get(self, utxo_id: str) -> UTxO:
+        """
+        Returns a transient copy of the cached UTxO and removes it from the cache
+        (it is being spent), or None if it is not cached.
+        """
+        entry = self.entries.pop(utxo_id, None)
+        if entry is None:
+            return None
+        self.hits += 1
+        owner, value, created_slot, block_hash, role = entry
+        return UTxO(
+            id=utxo_id,
+            owner=owner,
+            value=value,
+            created_slot=created_slot,
+            block_hash=block_hash,
+            role=role,
+        )
+
+    def might_exist(self, utxo_id: str) -> bool:
+        """
+        False if the UTxO is certainly not stored in the database.
+        """
+        if utxo_id not in self.bloom:
+            self.skipped += 1
+            return False
+        self.misses += 1
+        return True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.skipped
+        return {
+            "size": len(self.entries),
+            "bloom_count": self.bloom.count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "hit_rate": (self.hits + self.skipped) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, Union
+
+import orjson
+from sqlalchemy.orm import Session
+from websockets.asyncio.client import connect as connect_async
+from websockets.sync.client import connect
+
+from common.db import _ENGINE
+from . import metrics
+from .ogmios import ChainRollback
+from .rollback import intersection_points
+from .config import (
+    OGMIOS_URL,
+    PIPELINE_MAX_DEPTH,
+    PIPELINE_MIN_DEPTH,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+_NEXT_BLOCK = orjson.dumps({"jsonrpc": "2.0", "method": "nextBlock"})
+
+# weight of a new measurement in the moving average of the consumer time
+_EWMA_ALPHA = 0.05
+# number of recent round trip times of which the minimum is used
+_RTT_SAMPLES = 100
+# the asyncio client cannot poll the socket, it counts waits longer than this as a stall
+_STALL_SECONDS = 0.001
+
+
+class BlockView:
+    """
+    The parts of an Ogmios v6 block that the parser reads. Transactions are the
+    decoded JSON dicts, exactly as in the `ogmios` library.
+    """
+
+    __slots__ = ("id", "slot", "height", "size", "transactions")
+
+    def __init__(self, block: dict):
+        self.id = block["id"]
+        self.slot = block.get("slot", 0)
+        self.height = block.get("height", 0)
+        self.size = block.get("size")
+        # epoch boundary blocks have no transactions
+        self.transactions = block.get("transactions", [])
+
+    def __repr__(self) -> str:
+        return f"BlockView({self.height}, {self.slot}.{self.id})"
+
+
+class ChainSyncError(Exception):
+    pass
+
+
+class PipelineDepth:
+    """
+    Number of nextBlock requests to keep in flight.
+
+    Enough requests must be in flight to cover the round trip to Ogmios while
+    the consumer handles the blocks already received (bandwidth-delay product):
+    depth = round trip time / consumer time per block, doubled as a safety margin.
+    The round trip time is the minimum of the recent measurements, since deeper
+    pipelines only add queueing delay on a busy node, not throughput.
+    """
+
+    def __init__(
+        self, min_depth: int = PIPELINE_MIN_DEPTH, max_depth: int = PIPELINE_MAX_DEPTH
+    ):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth = min_depth
+        self.rtts = deque(maxlen=_RTT_SAMPLES)  # seconds between request and response
+        self.consumer_time = None  # seconds the consumer spends per block
+
+        # statistics
+        self.stalls = 0
+
+    @property
+    def rtt(self) -> float:
+        return min(self.rtts, default=0.0)
+
+    def update(self, consumer_time: float, rtt: Optional[float] = None):
+        """
+        Called per response. The round trip time is only known if the client had to
+        wait for the response (otherwise it was already buffered), i.e. on a stall.
+        """
+        if self.consumer_time is None:
+            self.consumer_time = consumer_time
+        else:
+            self.consumer_time += _EWMA_ALPHA * (consumer_time - self.consumer_time)
+        if rtt is not None:
+            self.rtts.append(rtt)
+            self.stalls += 1
+        target = 2 * math.ceil(self.rtt / max(self.consumer_time, 1e-6))
+        self.depth = max(self.min_depth, min(self.max_depth, target))
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "rtt_ms": round(self.rtt * 1000, 2),
+            "consumer_ms": round((self.consumer_time or 0) * 1000, 2),
+            "stalls": self.stalls,
+        }
+
+
+def _message(method: str, params: dict = None) -> bytes:
+    message = {"jsonrpc": "2.0", "method": method}
+    if params is not None:
+        message["params"] = params
+    return orjson.dumps(message)
+
+
+def _result(method: str, frame: bytes) -> dict:
+    response = orjson.loads(frame)
+    if "error" in response:
+        raise ChainSyncError(f"{method} failed: {response['error']}")
+    return response["result"]
+
+
+def _candidate_points(start_slot_no: int, start_block_hash: str) -> List[Tuple[int, str]]:
+    # One request with exponentially spaced recent blocks, Ogmios returns
+    # the newest one that is still on the chain
+    with Session(_ENGINE) as session:
+        candidates = intersection_points(session)
+    if (start_slot_no, start_block_hash) not in candidates:
+        candidates.insert(0, (start_slot_no, start_block_hash))
+    return candidates
+
+
+def _intersection_params(points: List[Tuple[int, str]]) -> dict:
+    return {"points": [{"slot": slot, "id": block_hash} for slot, block_hash in points]}
+
+
+def _intersection(result: dict) -> Tuple[int, str]:
+    intersection = result["intersection"]
+    if intersection == "origin":
+        return 0, ""
+    return intersection["slot"], intersection["id"]
+
+
+def _chain_item(result: dict) -> Union[BlockView, ChainRollback]:
+    if result["direction"] == "backward":
+        point = result["point"]
+        # the origin has no slot
+        if point == "origin":
+            return ChainRollback(0, "")
+        return ChainRollback(point["slot"], point["id"])
+    return BlockView(result["block"])
+
+
+class ChainSyncClient:
+    """
+    Minimal Ogmios v6 chain-sync client speaking JSON-RPC over a websocket and
+    decoding frames with orjson, a drop-in replacement for OgmiosIterator.
+    """
+
+    def __init__(self, url: str = OGMIOS_URL, depth: PipelineDepth = None):
+        self.url = url
+        self.pipeline = depth or PipelineDepth()
+        self.connection = None
+        # send times of the nextBlock requests in flight, responses arrive in order
+        self.in_flight = deque()
+        # whether the latest block was the tip of the node
+        self.at_tip = False
+
+        # statistics
+        self.blocks = 0
+        self.bytes = 0
+
+    def _request(self, method: str, params: dict = None) -> dict:
+        self.connection.send(_message(method, params))
+        return _result(method, self.connection.recv(decode=False))
+
+    def find_intersection(self, points: List[Tuple[int, str]]) -> Optional[Tuple[int, str]]:
+        """
+        The newest of the given points that is on the chain of the node, None if none is.
+        """
+        try:
+            return _intersection(
+                self._request("findIntersection", _intersection_params(points))
+            )
+        except ChainSyncError:
+            return None
+
+    def _init_connection(
+        self, start_slot_no: int, start_block_hash: str
+    ) -> Optional[ChainRollback]:
+        """
+        Returns the rollback to the newest common block if we were on a fork.
+        """
+        point = self.find_intersection(_candidate_points(start_slot_no, start_block_hash))
+        if point is None:
+            raise ChainSyncError("No intersection with the chain of the node found")
+        # the first response after an intersection is a rollback to it,
+        # its round trip time is the initial estimate
+        start = time.monotonic()
+        self._request("nextBlock")
+        self.pipeline.rtts.append(time.monotonic() - start)
+        if point[0] < start_slot_no:
+            # we were on a fork, the parser reverts everything after the common block
+            return ChainRollback(*point)
+        return None
+
+    def _fill_pipeline(self):
+        while len(self.in_flight) < self.pipeline.depth:
+            self.in_flight.append(time.monotonic())
+            self.connection.send(_NEXT_BLOCK)
+
+    def _receive(self, frame: bytes, received: float, stalled: bool):
+        """
+        Handles a nextBlock response, returns the block or rollback and the
+        round trip time if it could be measured.
+        """
+        sent = self.in_flight.popleft()
+        # at the tip, the node answers when the next block is minted
+        rtt = received - sent if stalled and not self.at_tip else None
+        result = _result("nextBlock", frame)
+        item = _chain_item(result)
+        if isinstance(item, BlockView):
+            self.at_tip = item.slot >= result["tip"]["slot"]
+            metrics.set_tip(result["tip"]["slot"])
+            self.blocks += 1
+            self.bytes += len(frame)
+            if self.blocks % 10000 == 0:
+                _LOGGER.info(f"Chain sync: {self.stats()}")
+        return item, rtt
+
+    def _intersect_exactly(self, slot: int, block_hash: str):
+        point = self.find_intersection([(slot, block_hash)])
+        if point != (slot, block_hash):
+            raise ChainSyncError(f"Block {slot}.{block_hash} is not on the chain of the node")
+        self._request("nextBlock")
+
+    def _stream(self, init) -> Iterator[Union[BlockView, ChainRollback]]:
+        with connect(self.url, max_size=None, compression=None) as self.connection:
+            rollback = init()
+            self._fill_pipeline()
+            if rollback is not None:
+                yield rollback
+            while True:
+                # frames are passed to orjson as bytes, without decoding them to str
+                try:
+                    # already buffered, the pipeline is deep enough
+                    frame = self.connection.recv(timeout=0, decode=False)
+                    stalled = False
+                except TimeoutError:
+                    frame = self.connection.recv(decode=False)
+                    stalled = True
+                received = time.monotonic()
+                item, rtt = self._receive(frame, received, stalled)
+                self._fill_pipeline()
+                yield item
+                # time until the consumer asked for the next block
+                self.pipeline.update(time.monotonic() - received, rtt)
+
+    def iterate_blocks(
+        self, start_slot_no: int, start_block_hash: str
+    ) -> Iterator[Union[BlockView, ChainRollback]]:
+        return self._stream(lambda: self._init_connection(start_slot_no, start_block_hash))
+
+    def iterate_from(
+        self, slot: int, block_hash: str
+    ) -> Iterator[Union[BlockView, ChainRollback]]:
+        """
+        Blocks after the given one, without touching the database (see querier/backfill.py).
+        """
+        return self._stream(lambda: self._intersect_exactly(slot, block_hash))
+
+    def stats(self) -> dict:
+        return {"blocks": self.blocks, "bytes": self.bytes, **self.pipeline.stats()}
+
+
+class AsyncChainSyncClient(ChainSyncClient):
+    """
+    ChainSyncClient for the asyncio runtime (see querier/aio.py). Database work
+    at startup (intersection candidates, rollback) runs in a worker thread.
+    """
+
+    async def _request(self, method: str, params: dict = None) -> dict:
+        await self.connection.send(_message(method, params))
+        return _result(method, await self.connection.recv(decode=False))
+
+    async def find_intersection(
+        self, points: List[Tuple[int, str]]
+    ) -> Optional[Tuple[int, str]]:
+        try:
+            return _intersection(
+                await self._request("findIntersection", _intersection_params(points))
+            )
+        except ChainSyncError:
+            return None
+
+    async def _init_connection(
+        self, start_slot_no: int, start_block_hash: str
+    ) -> Optional[ChainRollback]:
+        candidates = await asyncio.to_thread(
+            _candidate_points, start_slot_no, start_block_hash
+        )
+        point = await self.find_intersection(candidates)
+        if point is None:
+            raise ChainSyncError("No intersection with the chain of the node found")
+        start = time.monotonic()
+        await self._request("nextBlock")
+        self.pipeline.rtts.append(time.monotonic() - start)
+        if point[0] < start_slot_no:
+            return ChainRollback(*point)
+        return None
+
+    async def _fill_pipeline(self):
+        while len(self.in_flight) < self.pipeline.depth:
+            self.in_flight.append(time.monotonic())
+            await self.connection.send(_NEXT_BLOCK)
+
+    async def iterate_blocks(
+        self, start_slot_no: int, start_block_hash: str
+    ) -> AsyncIterator[Union[BlockView, ChainRollback]]:
+        async with connect_async(
+            self.url, max_size=None, compression=None
+        ) as self.connection:
+            rollback = await self._init_connection(start_slot_no, start_block_hash)
+            await self._fill_pipeline()
+            if rollback is not None:
+                yield rollback
+            while True:
+                wait_start = time.monotonic()
+                frame = await self.connection.recv(decode=False)
+                received = time.monotonic()
+                item, rtt = self._receive(
+                    frame, received, received - wait_start > _STALL_SECONDS
+                )
+                await self._fill_pipeline()
+                yield item
+                self.pipeline.update(time.monotonic() - received, rtt)
@@ -1,22 +1,181 @@
 import datetime
+import logging
+import re
+import threading
+
+import sqlalchemy as sqla
 import sqlalchemy.orm as orm
 
-from common.db import UTxO, _ENGINE
-from common.util import timestamp_slot
+from common.db import (
+    UTXO_PARTITION_SLOTS,
+    UTXO_PARTITIONED,
+    BatcherChange,
+    PruneProgress,
+    UTxO,
+    _ENGINE,
+)
+from .config import PRUNE_CHUNK_SIZE, STABILITY_WINDOW
+
+_LOGGER = logging.getLogger(__name__)
+
+_PARTITION_NAME = re.compile(r"^UTxO_p(\d+)$")
+
+
+def prune_cutoff(latest_slot: int) -> int:
+    """
+    UTxOs spent before this slot can no longer be needed by a rollback.
+    """
+    return latest_slot - STABILITY_WINDOW
+
+
+def _record_progress(
+    session: orm.Session, cutoff_slot: int, deleted_rows: int, finished: bool
+):
+    progress = session.get(PruneProgress, UTxO.__tablename__)
+    if progress is None:
+        progress = PruneProgress(table=UTxO.__tablename__, total_deleted_rows=0)
+        session.add(progress)
+    progress.cutoff_slot = cutoff_slot
+    progress.deleted_rows = deleted_rows
+    progress.finished = finished
+    progress.updated_at = datetime.datetime.utcnow()
+
+
+def remove_spent_utxos(
+    latest_slot: int, chunk_size: int = PRUNE_CHUNK_SIZE, engine=_ENGINE
+) -> int:
+    """
+    Removes UTxOs that were spent before the stability window from the database,
+    with one DELETE per chunk of `chunk_size` rows and a commit after each chunk,
+    so the writer is never blocked for long. Progress is recorded in PruneProgress.
+    Returns the number of deleted rows.
+    """
+    cutoff_slot = prune_cutoff(latest_slot)
+    deleted_rows = 0
+    with orm.Session(engine) as session:
+        if UTXO_PARTITIONED:
+            deleted_rows += drop_pruned_partitions(session, cutoff_slot)
+        # batcher changes before the cutoff cannot be rolled back either
+        session.execute(sqla.delete(BatcherChange).where(BatcherChange.slot < cutoff_slot))
+        session.commit()
+
+        chunk = (
+            sqla.select(UTxO.id)
+            .where(UTxO.spent_slot < cutoff_slot)
+            .limit(chunk_size)
+            .scalar_subquery()
+        )
+        stmt = sqla.delete(UTxO.__table__).where(UTxO.id.in_(chunk))
+        while True:
+            deleted = session.execute(stmt).rowcount
+            deleted_rows += deleted
+            finished = deleted < chunk_size
+            _record_progress(session, cutoff_slot, deleted_rows, finished)
+            session.commit()
+            if finished:
+                break
+
+        progress = session.get(PruneProgress, UTxO.__tablename__)
+        progress.total_deleted_rows += deleted_rows
+        session.commit()
+    return deleted_rows
 
 
-def remove_spent_utxos(latest_slot: int) -> int:
+def ensure_partitions(session: orm.Session, latest_slot: int, ahead: int = 1) -> int:
     """
-    Removes UTxOs that have been spent for at least 24h from the database.
-    This keeps the UTxO table relatively small while still allowing for rollbacks
-    within the security window.
+    Creates the partitions of the UTxO table for the slot range of `latest_slot`
+    and the `ahead` following ranges. Postgres with UTXO_PARTITION_SLOTS only.
+
+    Must run in the session that writes the UTxOs, before rows of a new range are
+    inserted, otherwise they end up in the default partition.
+    Returns the slot at which it should be called again.
     """
-    oldest_slot = latest_slot - 24 * 60 * 60
-    with orm.Session(_ENGINE) as session:
-        spent_utxos = session.query(UTxO).filter(UTxO.spent_slot < oldest_slot).all()
+    first = latest_slot // UTXO_PARTITION_SLOTS
+    for n in range(first, first + ahead + 1):
+        session.execute(
+            sqla.text(
+                f'CREATE TABLE IF NOT EXISTS "UTxO_p{n}" PARTITION OF "UTxO" '
+                f"FOR VALUES FROM ({n * UTXO_PARTITION_SLOTS}) "
+                f"TO ({(n + 1) * UTXO_PARTITION_SLOTS})"
+            )
+        )
+    return (first + 1) * UTXO_PARTITION_SLOTS
 
-        for utxo in spent_utxos:
-            session.delete(utxo)
 
+def drop_pruned_partitions(session: orm.Session, cutoff_slot: int) -> int:
+    """
+    Detaches and drops the partitions that only contain UTxOs created and spent
+    before `cutoff_slot`. Returns the number of dropped rows.
+    """
+    partitions = session.execute(
+        sqla.text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = '\"UTxO\"'::regclass"
+        )
+    ).scalars().all()
+    dropped_rows = 0
+    for name in partitions:
+        match = _PARTITION_NAME.match(name)
+        if match is None or (int(match[1]) + 1) * UTXO_PARTITION_SLOTS > cutoff_slot:
+            continue
+        still_needed = session.execute(
+            sqla.text(
+                f'SELECT 1 FROM "{name}" '
+                "WHERE spent_slot IS NULL OR spent_slot >= :cutoff LIMIT 1"
+            ),
+            {"cutoff": cutoff_slot},
+        ).first()
+        if still_needed:
+            continue
+        dropped_rows += session.execute(sqla.text(f'SELECT count(*) FROM "{name}"')).scalar()
+        session.execute(sqla.text(f'ALTER TABLE "UTxO" DETACH PARTITION "{name}"'))
+        session.execute(sqla.text(f'DROP TABLE "{name}"'))
         session.commit()
-    return oldest_slot
+        _LOGGER.info(f"Dropped UTxO partition {name}")
+    return dropped_rows
+
+
+class UTxOPruner:
+    """
+    Prunes spent UTxOs in a background thread, so the parser does not wait for it.
+    `request` only records the latest slot; if a run is in progress, the next run
+    starts as soon as it finished.
+    """
+
+    def __init__(self, chunk_size: int = PRUNE_CHUNK_SIZE, engine=_ENGINE):
+        self.chunk_size = chunk_size
+        self.engine = engine
+        self.latest_slot = None
+        self.should_exit = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="pruner", daemon=True)
+        self.thread.start()
+
+    def request(self, latest_slot: int):
+        with self.condition:
+            self.latest_slot = latest_slot
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.latest_slot is None and not self.should_exit:
+                    self.condition.wait()
+                if self.should_exit:
+                    return
+                latest_slot, self.latest_slot = self.latest_slot, None
+            try:
+                deleted_rows = remove_spent_utxos(
+                    latest_slot, self.chunk_size, engine=self.engine
+                )
+                _LOGGER.info(
+                    f"Removed {deleted_rows} UTxOs spent before slot {prune_cutoff(latest_slot)}"
+                )
+            except Exception:
+                _LOGGER.exception("Exception while pruning UTxOs")
+
+    def stop(self):
+        with self.condition:
+            self.should_exit = True
+            self.condition.notify()
+        self.thread.join()
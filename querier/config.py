@@ -63,7 +63,97 @@ DEFAULT_START_HASH = "f6566cd85706932d8e60d02cdd882640ec358e73b0c8171d969045c1bb
 # DEFAULT_START_HASH = "770685fbaa53286ced25d46d6e1756eca23a143b493e194577fee1870aeda5cc"
 
 OGMIOS_URL = os.environ.get("OGMIOS_URL", "ws://localhost:1337")
+# "json" uses the raw JSON-RPC client in querier/chainsync.py, "ogmios" the ogmios library
+CHAIN_SYNC_CLIENT = os.environ.get("CHAIN_SYNC_CLIENT", "json")
+# bounds of the adaptive number of nextBlock requests in flight
+PIPELINE_MIN_DEPTH = int(os.environ.get("PIPELINE_MIN_DEPTH", 8))
+PIPELINE_MAX_DEPTH = int(os.environ.get("PIPELINE_MAX_DEPTH", 1000))
+
+# Capacity of the block buffer between the Ogmios thread and the block parser
+QUEUE_MAX_BLOCKS = int(os.environ.get("QUEUE_MAX_BLOCKS", 3000))
+QUEUE_MAX_BYTES = int(os.environ.get("QUEUE_MAX_BYTES", 512 * 1024 * 1024))
+# asyncio runtime: number of blocks ahead of the parser whose prices are fetched concurrently
+PREFETCH_BLOCKS = int(os.environ.get("PREFETCH_BLOCKS", 16))
+
 PRICE_EP = "https://api.muesliswap.com/price"
+# "http" queries PRICE_EP, "stub" uses fixed prices without network access
+PRICE_BACKEND = os.environ.get("PRICE_BACKEND", "http")
+PRICE_TTL = float(os.environ.get("PRICE_TTL", 300))
+PRICE_CACHE_SIZE = int(os.environ.get("PRICE_CACHE_SIZE", 10000))
+PRICE_WORKERS = int(os.environ.get("PRICE_WORKERS", 16))
 BLOCKFROST = blockfrost.BlockFrostApi(
     BLOCKFROST_PROJECT_ID, base_url="https://cardano-mainnet.blockfrost.io/api"
 )
+# Blockfrost lookups for inputs that are not in the database are cached on disk
+FALLBACK_CACHE_PATH = os.environ.get("FALLBACK_CACHE_PATH", "cache/blockfrost.sqlite")
+BLOCKFROST_RATE = float(os.environ.get("BLOCKFROST_RATE", 10))  # requests per second
+BLOCKFROST_BURST = int(os.environ.get("BLOCKFROST_BURST", 50))
+BLOCKFROST_WORKERS = int(os.environ.get("BLOCKFROST_WORKERS", 8))
+
+# Group commit: during catch-up, commit after this many blocks or milliseconds,
+# whichever comes first. Blocks less than LIVE_MODE_LAG seconds old are committed one by one.
+GROUP_COMMIT_BLOCKS = int(os.environ.get("GROUP_COMMIT_BLOCKS", 100))
+GROUP_COMMIT_MS = int(os.environ.get("GROUP_COMMIT_MS", 2000))
+LIVE_MODE_LAG = int(os.environ.get("LIVE_MODE_LAG", 300))
+
+# In-memory working set of UTxOs used to resolve transaction inputs.
+# UTXO_CACHE_MAX_AGE is in slots, the bloom filter covers all unspent UTxOs in the database.
+# UTXO_BLOOM_CAPACITY is a minimum, the filter is sized for twice the unspent UTxOs on (re)load.
+UTXO_CACHE_SIZE = int(os.environ.get("UTXO_CACHE_SIZE", 500000))
+UTXO_CACHE_MAX_AGE = int(os.environ.get("UTXO_CACHE_MAX_AGE", 7 * 24 * 60 * 60))
+UTXO_BLOOM_CAPACITY = int(os.environ.get("UTXO_BLOOM_CAPACITY", 20000000))
+UTXO_BLOOM_ERROR_RATE = float(os.environ.get("UTXO_BLOOM_ERROR_RATE", 0.01))
+
+# "full" stores every output on the chain in case it is later spent by a batcher.
+# "relevant" only stores outputs of transactions that create or spend orders and outputs
+# to known batcher addresses, other inputs are resolved on demand by the cached Blockfrost
+# fallback. INPUT_RESOLVER=stub resolves them from a dictionary first (tests, replays).
+INGEST_MODE = os.environ.get("INGEST_MODE", "full")
+INPUT_RESOLVER = os.environ.get("INPUT_RESOLVER", "none")
+
+# "bulk" writes each batch of blocks with Core INSERT/COPY and UPDATE ... FROM (VALUES ...),
+# "orm" uses the ORM unit of work (kept for comparison in benchmarks)
+WRITE_PATH = os.environ.get("WRITE_PATH", "bulk")
+
+# Number of worker processes decoding order datums, 0 decodes inline in the parser thread
+DATUM_WORKERS = int(os.environ.get("DATUM_WORKERS", 0))
+# Addresses whose AddressRole is kept in memory
+ADDRESS_ROLE_CACHE_SIZE = int(os.environ.get("ADDRESS_ROLE_CACHE_SIZE", 100000))
+
+# Decoded order datums kept by datum hash
+DATUM_MEMO_SIZE = int(os.environ.get("DATUM_MEMO_SIZE", 100000))
+
+# Scan each block with an Aho-Corasick automaton and skip the order handling
+# for transactions that cannot involve orders or batchers
+PREFILTER = os.environ.get("PREFILTER", "1") == "1"
+
+# Cardano security parameter k and active slot coefficient f (mainnet).
+# Blocks older than the stability window of 3k/f slots cannot be rolled back.
+SECURITY_PARAM = int(os.environ.get("SECURITY_PARAM", 2160))
+ACTIVE_SLOT_COEFF = float(os.environ.get("ACTIVE_SLOT_COEFF", 0.05))
+STABILITY_WINDOW = int(3 * SECURITY_PARAM / ACTIVE_SLOT_COEFF)
+
+# Spent UTxOs are removed in the background once they were spent before the
+# stability window, PRUNE_CHUNK_SIZE rows per DELETE
+PRUNE_INTERVAL = int(os.environ.get("PRUNE_INTERVAL", 1000))  # blocks
+PRUNE_CHUNK_SIZE = int(os.environ.get("PRUNE_CHUNK_SIZE", 10000))
+
+# Snapshot of the in-memory parser state (open orders, batcher index, bloom filter),
+# written every SNAPSHOT_INTERVAL blocks and on shutdown, used on restart if it
+# matches the chain cursor. An empty path disables snapshots.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "cache/state.snapshot")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 10000))  # blocks
+
+# Parallel historical backfill (python -m querier.backfill): facts of each slot range
+# are fetched into a SQLite file in BACKFILL_DIR, one process and Ogmios connection each
+BACKFILL_DIR = os.environ.get("BACKFILL_DIR", "cache/backfill")
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 4))
+
+# Prometheus endpoint of the querier (http://METRICS_ADDR:METRICS_PORT/metrics), 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+
+# Sampling profiler (python -m querier --profile, or SIGUSR2 to toggle at runtime):
+# one sample every PROFILE_INTERVAL_MS, collapsed stacks written to logs/ every PROFILE_BLOCKS blocks
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 10))
+PROFILE_BLOCKS = int(os.environ.get("PROFILE_BLOCKS", 10000))
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import cbor2
+
+from .config import DATUM_MEMO_SIZE
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _fields(cbor) -> list:
+    """
+    Fields of a Plutus constructor, see common.cardano_utils.datum_from_cbortag.
+    Raises KeyError for anything that is not a constructor, like indexing the generic datum would.
+    """
+    if isinstance(cbor, cbor2.CBORTag):
+        if 121 <= cbor.tag <= 121 + 6 or 1280 <= cbor.tag <= 1280 + (127 - 7):
+            return cbor.value
+        if cbor.tag == 102:
+            return cbor.value[1]
+        raise ValueError(f"Invalid cbor with tag {cbor.tag}")
+    raise KeyError("fields")
+
+
+def _constructor(cbor) -> int:
+    if cbor.tag == 102:
+        return cbor.value[0]
+    if cbor.tag >= 1280:
+        return cbor.tag - 1280 + 7
+    return cbor.tag - 121
+
+
+def _bytes(cbor) -> str:
+    if not isinstance(cbor, bytes):
+        raise KeyError("bytes")
+    return cbor.hex()
+
+
+def _wallet_address(cbor) -> str:
+    """
+    Payment key hash + stake key hash of a Plutus address, same as util.parse_wallet_address.
+    """
+    fields = _fields(cbor)
+    pkh = _bytes(_fields(fields[0])[0])
+    skh_cons = fields[1]
+    try:
+        skh = _bytes(_fields(_fields(_fields(skh_cons)[0])[0])[0])
+    except (KeyError, IndexError):
+        assert _constructor(skh_cons) == 1
+        skh = ""
+    return pkh + skh
+
+
+def extract_parties(datum_cbor: bytes, contract_version: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the sender and recipient of an order datum, walking the decoded CBOR directly
+    instead of converting it with datum_from_cbortag first. Same result as util.parse_order_datum.
+    """
+    datum = cbor2.loads(datum_cbor)
+    if "lq" in contract_version:
+        fields = _fields(datum)
+        return _wallet_address(fields[0]), _wallet_address(fields[1])
+
+    if contract_version in ["v2", "v3", "v4"]:
+        sender = _wallet_address(_fields(_fields(datum)[0])[0])
+        return sender, sender
+
+
+class DatumMemo:
+    """
+    Extracted order parties by datum hash and contract version, at most `max_size` entries (LRU).
+    Datums in the witness set repeat, e.g. for orders with the same owner and parameters.
+    """
+
+    def __init__(self, max_size: int = DATUM_MEMO_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (datum hash, contract version) -> parties
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(datum_hex: str, contract_version: str, datum_hash: str = None) -> tuple:
+        """
+        datum_hash is computed from the datum if not given (inline datums).
+        """
+        if datum_hash is None:
+            datum_hash = hashlib.blake2b(
+                bytes.fromhex(datum_hex), digest_size=32
+            ).hexdigest()
+        return (datum_hash, contract_version)
+
+    def get(self, key: tuple):
+        """
+        Returns the memoized parties or None.
+        """
+        parties = self.entries.get(key)
+        if parties is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return parties
+
+    def put(self, key: tuple, parties: Tuple[str, str]):
+        if self.max_size <= 0 or parties is None:
+            return
+        self.entries[key] = parties
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def parties(
+        self, datum_hex: str, contract_version: str, datum_hash: str = None
+    ) -> Optional[Tuple[str, str]]:
+        key = self.key(datum_hex, contract_version, datum_hash)
+        parties = self.get(key)
+        if parties is None:
+            parties = extract_parties(bytes.fromhex(datum_hex), contract_version)
+            self.put(key, parties)
+        return parties
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
@@ -0,0 +1,103 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Tuple
+
+from .config import MUESLI_ADDR_TO_VERSION
+from .datum import DatumMemo, extract_parties
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def decode_parties(job: Tuple[str, str]):
+    """
+    Decode an order datum and return its sender and recipient.
+    Runs in the worker processes, so errors are returned instead of raised.
+    """
+    datum_hex, contract_version = job
+    try:
+        return extract_parties(bytes.fromhex(datum_hex), contract_version)
+    except Exception:
+        return None
+
+
+class DatumDecoder:
+    """
+    Decodes the datums of all order outputs of a block up front, in a process pool
+    if `workers` > 0 and inline otherwise. Outputs whose datum could not be decoded
+    are left out and handled by `parse_output` as usual.
+    Results are memoized by datum hash, only unknown datums are sent to the pool.
+
+    Must be created in the main thread, before other threads are started.
+    """
+
+    def __init__(self, workers: int = 0, min_parallel: int = 8):
+        self.workers = workers
+        self.min_parallel = min_parallel
+        self.memo = DatumMemo()
+        self.pool = None
+        if workers > 0:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+            # start the workers now, forking later from the parser thread is unsafe
+            self.pool.submit(int).result()
+
+        # statistics
+        self.decoded = 0
+        self.decode_time = 0.0
+
+    def decode_block(self, block) -> Dict[str, Tuple[str, str]]:
+        """
+        Returns a mapping from output id to (sender, recipient) for the order outputs of the block.
+        """
+        start = time.perf_counter()
+        parties = {}
+        output_ids = []
+        keys = []
+        jobs = []
+        for tx in block.transactions:
+            for idx, output in enumerate(tx["outputs"]):
+                contract_version = MUESLI_ADDR_TO_VERSION.get(output["address"])
+                if contract_version is None:
+                    continue
+                datum_hash = output.get("datumHash")
+                datum_hex = output.get("datum")
+                if datum_hex is None:
+                    datum_hex = tx["datums"].get(datum_hash)
+                if datum_hex is None:
+                    continue
+                output_id = f"{tx['id']}#{idx}"
+                key = self.memo.key(datum_hex, contract_version, datum_hash)
+                result = self.memo.get(key)
+                if result is not None:
+                    parties[output_id] = result
+                    continue
+                output_ids.append(output_id)
+                keys.append(key)
+                jobs.append((datum_hex, contract_version))
+
+        if self.pool is not None and len(jobs) >= self.min_parallel:
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+            results = self.pool.map(decode_parties, jobs, chunksize=chunksize)
+        else:
+            results = map(decode_parties, jobs)
+        for output_id, key, result in zip(output_ids, keys, results):
+            if result is not None:
+                parties[output_id] = result
+                self.memo.put(key, result)
+
+        self.decoded += len(jobs)
+        self.decode_time += time.perf_counter() - start
+        return parties
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "decoded": self.decoded,
+            "memo": self.memo.stats(),
+            "decode_time": self.decode_time,
+            "datums_per_second": self.decoded / self.decode_time if self.decode_time else 0.0,
+        }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
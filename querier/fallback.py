@@ -0,0 +1,245 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+import orjson
+
+from common.db import Order, UTxO
+from . import util
+
+from .config import (
+    MUESLI_ADDR_TO_VERSION,
+    BLOCKFROST,
+    BLOCKFROST_BURST,
+    BLOCKFROST_RATE,
+    BLOCKFROST_WORKERS,
+    FALLBACK_CACHE_PATH,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and bursts of up to `burst` calls.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BlockfrostBackend:
+    """
+    Remote lookups through the Blockfrost API, returning plain JSON.
+    """
+
+    def __init__(self, api=BLOCKFROST):
+        self.api = api
+
+    def transaction_utxos(self, tx_hash: str) -> dict:
+        return self.api.transaction_utxos(tx_hash, return_type="json")
+
+    def datum_cbor(self, datum_hash: str) -> str:
+        return self.api.script_datum_cbor(datum_hash, return_type="json")["cbor"]
+
+
+class FakeBlockfrostBackend:
+    """
+    Local backend serving transaction UTxOs and datums from dictionaries, for tests.
+    """
+
+    def __init__(self, tx_utxos: dict = None, datums: dict = None):
+        self.tx_utxos = dict(tx_utxos or {})
+        self.datums = dict(datums or {})
+        self.calls = 0
+
+    def transaction_utxos(self, tx_hash: str) -> dict:
+        self.calls += 1
+        return self.tx_utxos[tx_hash]
+
+    def datum_cbor(self, datum_hash: str) -> str:
+        self.calls += 1
+        return self.datums[datum_hash]
+
+
+class DiskCache:
+    """
+    Persistent cache of transaction UTxOs and datums in a SQLite file.
+    Both are immutable on chain, so entries never expire.
+    """
+
+    def __init__(self, path: str):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(kind TEXT, key TEXT, value BLOB, PRIMARY KEY (kind, key))"
+            )
+            self.connection.commit()
+
+    def get(self, kind: str, key: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM cache WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+        return orjson.loads(row[0]) if row is not None else None
+
+    def put(self, kind: str, key: str, value):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (kind, key, orjson.dumps(value)),
+            )
+            self.connection.commit()
+
+
+class FallbackResolver:
+    """
+    Looks up transaction UTxOs and datums that are not in our database.
+
+    Results are cached on disk, so re-syncing the same range makes no remote calls.
+    Remote calls are rate limited with a token bucket, run concurrently in a thread
+    pool and concurrent lookups of the same key share a single call.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        cache_path: str = FALLBACK_CACHE_PATH,
+        rate: float = BLOCKFROST_RATE,
+        burst: int = BLOCKFROST_BURST,
+        max_workers: int = BLOCKFROST_WORKERS,
+    ):
+        self.backend = backend or BlockfrostBackend()
+        self.cache = DiskCache(cache_path)
+        self.bucket = TokenBucket(rate, burst)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="fallback"
+        )
+        self.lock = threading.Lock()
+        self.in_flight = {}  # (kind, key) -> Future
+
+        # statistics
+        self.hits = 0
+        self.remote_calls = 0
+
+    def _fetch(self, kind: str, key: str):
+        try:
+            self.bucket.acquire()
+            self.remote_calls += 1
+            if kind == "tx_utxos":
+                value = self.backend.transaction_utxos(key)
+            else:
+                value = self.backend.datum_cbor(key)
+            self.cache.put(kind, key, value)
+            return value
+        finally:
+            with self.lock:
+                self.in_flight.pop((kind, key), None)
+
+    def _lookup_many(self, kind: str, keys: Iterable[str]) -> dict:
+        results = {}
+        futures = {}
+        for key in set(keys):
+            value = self.cache.get(kind, key)
+            if value is not None:
+                self.hits += 1
+                results[key] = value
+                continue
+            with self.lock:
+                future = self.in_flight.get((kind, key))
+                if future is None:
+                    future = self.executor.submit(self._fetch, kind, key)
+                    self.in_flight[(kind, key)] = future
+            futures[key] = future
+        for key, future in futures.items():
+            results[key] = future.result()
+        return results
+
+    def transaction_utxos(self, tx_hash: str) -> dict:
+        """
+        Inputs and outputs of a transaction in the Blockfrost JSON format.
+        """
+        return self._lookup_many("tx_utxos", [tx_hash])[tx_hash]
+
+    def prefetch(self, tx_hashes: Iterable[str]) -> Dict[str, dict]:
+        return self._lookup_many("tx_utxos", tx_hashes)
+
+    def datums(self, datum_hashes: Iterable[str]) -> Dict[str, str]:
+        """
+        CBOR hex of the datums with the given hashes, fetched concurrently.
+        """
+        return self._lookup_many("datums", datum_hashes)
+
+    def missing_inputs(
+        self,
+        tx_hash: str,
+        input_ids: List[str],
+        stored_ids: List[str],
+        order_ids: List[str],
+    ) -> Tuple[List[UTxO], List[Order]]:
+        """
+        The inputs of a transaction that are neither stored UTxOs nor known orders,
+        as UTxOs and orders. Datums of the missing orders are fetched concurrently.
+        """
+        missing_inputs = {}
+        for utxo in self.transaction_utxos(tx_hash)["inputs"]:
+            input_id = f"{utxo['tx_hash']}#{utxo['output_index']}"
+            if (
+                input_id not in stored_ids  # Make sure we don't add duplicates
+                and input_id in input_ids  # Make sure the input is actually in the transaction
+                and input_id not in order_ids  # Make sure the input is not an order
+            ):
+                missing_inputs[input_id] = utxo
+        datums = self.datums(
+            utxo["data_hash"]
+            for utxo in missing_inputs.values()
+            if utxo["address"] in MUESLI_ADDR_TO_VERSION and not utxo["inline_datum"]
+        )
+
+        utxos = []
+        orders = []
+        for input_id, utxo in missing_inputs.items():
+            if utxo["address"] not in MUESLI_ADDR_TO_VERSION:
+                utxos.append(
+                    UTxO(
+                        id=input_id,
+                        value=util.parse_value_bf_to_ogmios(utxo["amount"]),
+                        owner=utxo["address"],
+                        created_slot=0,
+                        block_hash="",
+                    )
+                )
+            else:
+                sender, recipient = util.parse_bf_datum(
+                    utxo["inline_datum"] or datums[utxo["data_hash"]],
+                    MUESLI_ADDR_TO_VERSION[utxo["address"]],
+                )
+                orders.append(Order(id=input_id, sender=sender, recipient=recipient, slot=0))
+        return utxos, orders
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "remote_calls": self.remote_calls}
@@ -0,0 +1,75 @@
+import logging
+from collections import deque
+from typing import List
+
+from .config import SECURITY_PARAM
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class BlockUndo:
+    """
+    Changes to the in-memory state of the parser made by one block, and the
+    batcher changes that cannot be reverted by slot in the database.
+    Rows created, spent and linked by the block are reverted by slot.
+    """
+
+    __slots__ = (
+        "slot",
+        "hash",
+        "height",
+        "orders",
+        "batchers",
+    )
+
+    def __init__(self, slot: int, block_hash: str, height: int):
+        self.slot = slot
+        self.hash = block_hash
+        self.height = height
+        self.orders = []  # (order id, True if opened / False if closed), in order
+        # in order: ("batcher", id), ("address", address, batcher id),
+        # ("merge", winner id, absorbed id, addresses, transaction ids)
+        self.batchers = []
+
+
+class UndoJournal:
+    """
+    Undo records of the last `depth` processed blocks, enough to revert any
+    rollback within the security parameter without reloading the state.
+    """
+
+    def __init__(self, base_slot: int, depth: int = SECURITY_PARAM):
+        self.depth = depth
+        self.blocks = deque()
+        # slot of the newest block that is not journaled
+        self.base_slot = base_slot
+
+    @property
+    def current(self) -> BlockUndo:
+        return self.blocks[-1] if self.blocks else None
+
+    def start_block(self, slot: int, block_hash: str, height: int) -> BlockUndo:
+        if len(self.blocks) >= self.depth:
+            self.base_slot = self.blocks.popleft().slot
+        undo = BlockUndo(slot, block_hash, height)
+        self.blocks.append(undo)
+        return undo
+
+    def covers(self, slot: int) -> bool:
+        """
+        Whether all blocks after `slot` are journaled.
+        """
+        return slot >= self.base_slot
+
+    def pop_after(self, slot: int) -> List[BlockUndo]:
+        """
+        Removes and returns the records of the blocks after `slot`, newest first.
+        """
+        undone = []
+        while self.blocks and self.blocks[-1].slot > slot:
+            undone.append(self.blocks.pop())
+        return undone
+
+    def clear(self, base_slot: int):
+        self.blocks.clear()
+        self.base_slot = base_slot
@@ -0,0 +1,151 @@
+import logging
+import time
+
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from common.util import slot_timestamp
+
+_LOGGER = logging.getLogger(__name__)
+
+# 50 us to 10 s, stages range from a dictionary lookup to a commit of many blocks
+_STAGE_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Throughput, use rate() for blocks and transactions per second
+BLOCKS = Counter("querier_blocks", "Blocks processed by the parser")
+TRANSACTIONS = Counter("querier_transactions", "Transactions in the processed blocks")
+ROLLBACKS = Counter("querier_rollbacks", "Chain rollbacks handled by the parser")
+
+# Latency per pipeline stage
+STAGE_SECONDS = Histogram(
+    "querier_stage_seconds",
+    "Time spent per stage: decode (order datums of a block), resolve (inputs of a"
+    " transaction), analytics (of a batch transaction, including prices), prices"
+    " (one price lookup) and commit (one group commit)",
+    ["stage"],
+    buckets=_STAGE_BUCKETS,
+)
+DECODE = STAGE_SECONDS.labels("decode")
+RESOLVE = STAGE_SECONDS.labels("resolve")
+ANALYTICS = STAGE_SECONDS.labels("analytics")
+PRICES = STAGE_SECONDS.labels("prices")
+COMMIT = STAGE_SECONDS.labels("commit")
+
+# latest processed slot and tip of the node, read on scrape
+_chain = {"slot": None, "tip": None}
+# parser whose caches, clients and block buffer are reported, see watch
+_parser = None
+# HTTP server of the endpoint, see serve
+_server = None
+
+
+def set_slot(slot: int):
+    _chain["slot"] = slot
+
+
+def set_tip(slot: int):
+    _chain["tip"] = slot
+
+
+def watch(parser):
+    """
+    Report the caches and API calls of this BlockParser (the latest one created).
+    """
+    global _parser
+    _parser = parser
+
+
+def _hit_ratio(hits: int, misses: int) -> float:
+    lookups = hits + misses
+    return hits / lookups if lookups else 0.0
+
+
+class _ParserCollector:
+    """
+    Reads the statistics the components already keep at scrape time, so they cost
+    nothing per block: chain lag, block buffer, cache hit rates and remote calls.
+    """
+
+    def collect(self):
+        slot, tip = _chain["slot"], _chain["tip"]
+        if slot is not None:
+            yield GaugeMetricFamily("querier_slot", "Slot of the latest processed block", slot)
+            yield GaugeMetricFamily(
+                "querier_block_age_seconds",
+                "Wall-clock age of the latest processed block",
+                time.time() - slot_timestamp(slot),
+            )
+        if tip is not None:
+            yield GaugeMetricFamily("querier_tip_slot", "Slot of the tip of the node", tip)
+        if slot is not None and tip is not None:
+            yield GaugeMetricFamily(
+                "querier_slot_lag", "Slots between the node tip and the parser", max(tip - slot, 0)
+            )
+
+        parser = _parser
+        if parser is None:
+            return
+
+        iterator_stats = parser.iterator.stats() if parser.iterator is not None else {}
+        if "depth" in iterator_stats:
+            yield GaugeMetricFamily(
+                "querier_queue_blocks", "Blocks in the buffer of the parser", iterator_stats["depth"]
+            )
+            yield GaugeMetricFamily(
+                "querier_queue_bytes", "Estimated bytes in the block buffer", iterator_stats["bytes"]
+            )
+            wait = CounterMetricFamily(
+                "querier_queue_wait_seconds",
+                "Time the chain sync (producer) and parser (consumer) waited on the buffer",
+                labels=["side"],
+            )
+            wait.add_metric(["producer"], iterator_stats["producer_wait_time"])
+            wait.add_metric(["consumer"], iterator_stats["consumer_wait_time"])
+            yield wait
+
+        # cache -> (hits, misses)
+        caches = {}
+        utxos = parser.utxo_cache.stats()
+        caches["utxo"] = (utxos["hits"] + utxos["skipped"], utxos["misses"])
+        memo = parser.datum_decoder.memo.stats()
+        caches["datum"] = (memo["hits"], memo["misses"])
+        price_requests = getattr(parser.price_provider, "requests", None)
+        if price_requests is not None:
+            caches["price"] = (parser.price_provider.hits, price_requests)
+        caches["blockfrost"] = (parser.fallback.hits, parser.fallback.remote_calls)
+
+        hits = CounterMetricFamily("querier_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("querier_cache_misses", "Cache misses", labels=["cache"])
+        ratio = GaugeMetricFamily(
+            "querier_cache_hit_ratio", "Hits per lookup since the start", labels=["cache"]
+        )
+        for cache, (cache_hits, cache_misses) in caches.items():
+            hits.add_metric([cache], cache_hits)
+            misses.add_metric([cache], cache_misses)
+            ratio.add_metric([cache], _hit_ratio(cache_hits, cache_misses))
+        yield hits
+        yield misses
+        yield ratio
+
+        yield CounterMetricFamily(
+            "querier_blockfrost_calls", "Remote Blockfrost calls", parser.fallback.remote_calls
+        )
+        if price_requests is not None:
+            yield CounterMetricFamily(
+                "querier_price_api_calls", "Requests to the price API", price_requests
+            )
+
+
+def serve(port: int, addr: str = "127.0.0.1"):
+    """
+    Expose /metrics on addr:port from a daemon thread. Port 0 disables the endpoint.
+    """
+    global _server
+    if not port or _server is not None:
+        return
+    REGISTRY.register(_ParserCollector())
+    _server = start_http_server(port, addr=addr)
+    _LOGGER.info(f"Serving metrics on http://{addr}:{port}/metrics")
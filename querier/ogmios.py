@@ -1,49 +1,73 @@
 import ogmios
 from ogmios.datatypes import Point
-from .rollback import RollbackHandler
-from . import OGMIOS_HOSTNAME
+from sqlalchemy.orm import Session
+
+from common.db import _ENGINE
+from .rollback import RollbackHandler, intersection_points
+from . import OGMIOS_HOSTNAME, metrics
 
 num_blocks_to_queue = 100
 
 
+class ChainRollback:
+    """
+    Passed down the block stream instead of a block when the node switched to
+    another fork: all blocks after (slot, id) have to be reverted.
+    """
+
+    __slots__ = ("slot", "id")
+
+    def __init__(self, slot: int, id: str):
+        self.slot = slot
+        self.id = id
+
+    def __repr__(self) -> str:
+        return f"ChainRollback({self.slot}.{self.id})"
+
+
 class OgmiosIterator:
     def __init__(self):
         pass
 
     def _init_connection(self, client: ogmios.Client, start_slot_no, start_block_hash):
+        """
+        Returns the rollback to the newest common block if we were on a fork.
+        """
+        # One request with exponentially spaced recent blocks, Ogmios returns
+        # the newest one that is still on the chain
+        with Session(_ENGINE) as session:
+            candidates = intersection_points(session)
+        if (start_slot_no, start_block_hash) not in candidates:
+            candidates.insert(0, (start_slot_no, start_block_hash))
+        points = [Point(slot=slot, id=block_hash) for slot, block_hash in candidates]
         try:
-            point, _, _ = client.find_intersection.execute(
-                [Point(slot=start_slot_no, id=start_block_hash)]
-            )
-        except Exception as e:
-            rollback_handler = RollbackHandler()
-            while True:
-                slot, block_hash = rollback_handler.prev_block()
-                try:
-                    point, _, _ = client.find_intersection.execute(
-                        [Point(slot=slot, id=block_hash)]
-                    )
-                    rollback_handler.rollback()
-                    break
-                except:
-                    pass
+            point, _, _ = client.find_intersection.execute(points)
         finally:
             client.next_block.send()
             client.next_block.receive()
+        if point.slot < start_slot_no:
+            # we were on a fork, the parser reverts everything after the common block
+            return ChainRollback(point.slot, point.id)
+        return None
 
     def iterate_blocks(self, start_slot_no, start_block_hash):
 
         with ogmios.Client(host=OGMIOS_HOSTNAME) as client:
             # Ensures that the client points to the latest block in our database
-            self._init_connection(client, start_slot_no, start_block_hash)
+            rollback = self._init_connection(client, start_slot_no, start_block_hash)
             for i in range(num_blocks_to_queue):
                 client.next_block.send()
+            if rollback is not None:
+                yield rollback
             while True:
                 direction, tip, block, _ = client.next_block.receive()
-                if direction == ogmios.Direction.backward:
-                    raise Exception("Ogmios Rollback!")
                 client.next_block.send()
-                yield block
+                metrics.set_tip(tip.slot)
+                if direction == ogmios.Direction.backward:
+                    # block is the point to roll back to, the origin has no slot
+                    yield ChainRollback(getattr(block, "slot", 0), getattr(block, "id", ""))
+                else:
+                    yield block
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import bisect
+import logging
+from collections import Counter
+from typing import Iterable, Set
+
+import ahocorasick
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TransactionPrefilter:
+    """
+    Finds the transactions of a block that may be relevant for the analytics, i.e.
+    that mention an order contract address, a known batcher address or the hash of a
+    transaction with an open order, with a single Aho-Corasick scan over the input
+    hashes and output addresses of the block.
+
+    False positives are possible (e.g. a transaction spending another output of a
+    transaction with an open order). The patterns are those known before the scan, so
+    transactions that depend on an earlier one of the same block (e.g. spending an
+    order it created) can be missed, BlockParser.process_plain_tx handles these.
+    Patterns can be added and removed at any time, the automaton is rebuilt lazily
+    before the next scan.
+    """
+
+    def __init__(
+        self,
+        order_addresses: Iterable[str],
+        batcher_addresses: Iterable[str],
+        open_orders: Iterable[str],
+    ):
+        self.automaton = ahocorasick.Automaton()
+        # open order tx hash -> number of open orders created by that transaction
+        self.open_order_txs = Counter()
+        self.dirty = True
+
+        for address in order_addresses:
+            self.add_pattern(address)
+        for address in batcher_addresses:
+            self.add_pattern(address)
+        for order_id in open_orders:
+            self.add_open_order(order_id)
+
+        # statistics
+        self.scanned = 0
+        self.relevant = 0
+
+    def add_pattern(self, pattern: str):
+        if pattern not in self.automaton:
+            self.automaton.add_word(pattern, pattern)
+            self.dirty = True
+
+    def add_open_order(self, order_id: str):
+        tx_hash = order_id.split("#")[0]
+        self.open_order_txs[tx_hash] += 1
+        self.add_pattern(tx_hash)
+
+    def remove_open_order(self, order_id: str):
+        tx_hash = order_id.split("#")[0]
+        self.open_order_txs[tx_hash] -= 1
+        if self.open_order_txs[tx_hash] <= 0:
+            del self.open_order_txs[tx_hash]
+            self.automaton.remove_word(tx_hash)
+            self.dirty = True
+
+    def relevant_transactions(self, transactions: list) -> Set[int]:
+        """
+        Returns the indices of the transactions that may be relevant.
+        """
+        if self.dirty:
+            self.automaton.make_automaton()
+            self.dirty = False
+
+        # one payload for the whole block, remembering where each transaction starts;
+        # the patterns can only occur in the input hashes and output addresses
+        starts = []
+        parts = []
+        offset = 0
+        relevant = set()
+        for tx in transactions:
+            part = " ".join(
+                [d["transaction"]["id"] for d in tx["inputs"]]
+                + [output["address"] for output in tx["outputs"]]
+            )
+            starts.append(offset)
+            parts.append(part)
+            offset += len(part) + 1
+        payload = "\n".join(parts)
+
+        if len(self.automaton) > 0:
+            for end, _ in self.automaton.iter(payload):
+                relevant.add(bisect.bisect_right(starts, end) - 1)
+
+        self.scanned += len(transactions)
+        self.relevant += len(relevant)
+        return relevant
+
+    def stats(self) -> dict:
+        return {
+            "patterns": len(self.automaton),
+            "scanned": self.scanned,
+            "relevant": self.relevant,
+        }
@@ -0,0 +1,212 @@
+import abc
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.classes import Token
+from .config import PRICE_EP, PRICE_CACHE_SIZE, PRICE_TTL, PRICE_WORKERS
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PriceProvider(abc.ABC):
+    """
+    Provides prices of tokens in ADA.
+    """
+
+    @abc.abstractmethod
+    def get_prices(self, tokens: Iterable[Token]) -> Dict[Token, float]:
+        """
+        The prices of all given tokens.
+        """
+
+    def get_price(self, token: Token) -> float:
+        return self.get_prices([token])[token]
+
+
+class StubPriceProvider(PriceProvider):
+    """
+    Offline price provider with fixed prices, for tests and benchmarks.
+    """
+
+    def __init__(self, prices: Dict[Token, float] = None, default: float = 0.0):
+        self.prices = dict(prices or {})
+        self.default = default
+
+    def get_prices(self, tokens: Iterable[Token]) -> Dict[Token, float]:
+        return {token: self.prices.get(token, self.default) for token in tokens}
+
+
+class HttpPriceProvider(PriceProvider):
+    """
+    Fetches prices from the MuesliSwap price API.
+
+    - keep-alive connections are reused through a pooled requests.Session
+    - prices are cached per token for `ttl` seconds, at most `max_size` tokens (LRU)
+    - all missing tokens of a request are fetched concurrently
+    - concurrent lookups of the same token share a single request
+    """
+
+    def __init__(
+        self,
+        url: str = PRICE_EP,
+        ttl: float = PRICE_TTL,
+        max_size: int = PRICE_CACHE_SIZE,
+        max_workers: int = PRICE_WORKERS,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_workers = max_workers
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prices"
+        )
+
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # token -> (expiry, price)
+        self.in_flight = {}  # token -> Future
+
+        # statistics
+        self.hits = 0
+        self.requests = 0
+
+    def _fetch(self, token: Token) -> float:
+        # Base and quote are flipped because that is how the middleware expects it :(
+        params = {
+            "quote-policy-id": token.policy_id,
+            "quote-tokenname": token.name,
+            "base-policy-id": "",
+            "base-tokenname": "",
+        }
+        with self.lock:
+            self.requests += 1
+        response = self.session.get(self.url, params=params, timeout=10)
+        response.raise_for_status()
+        return response.json()["price"]
+
+    def _fetch_and_store(self, token: Token) -> float:
+        try:
+            price = self._fetch(token)
+            with self.lock:
+                self.cache[token] = (time.monotonic() + self.ttl, price)
+                self.cache.move_to_end(token)
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+            return price
+        finally:
+            with self.lock:
+                self.in_flight.pop(token, None)
+
+    def get_prices(self, tokens: Iterable[Token]) -> Dict[Token, float]:
+        prices = {}
+        futures = {}
+        now = time.monotonic()
+        with self.lock:
+            for token in set(tokens):
+                cached = self.cache.get(token)
+                if cached is not None and cached[0] > now:
+                    self.cache.move_to_end(token)
+                    self.hits += 1
+                    prices[token] = cached[1]
+                    continue
+                future = self.in_flight.get(token)
+                if future is None:
+                    future = self.executor.submit(self._fetch_and_store, token)
+                    self.in_flight[token] = future
+                futures[token] = future
+        for token, future in futures.items():
+            prices[token] = future.result()
+        return prices
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.cache),
+            "hits": self.hits,
+            "requests": self.requests,
+        }
+
+
+class AsyncHttpPriceProvider(HttpPriceProvider):
+    """
+    HttpPriceProvider that can also fetch prices from an event loop with httpx.
+    The asyncio runtime prefetches the prices a block will probably need while the
+    previous blocks are processed; `get_prices` then mostly hits the cache and
+    fetches the remaining tokens synchronously as before.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=self.max_workers),
+        )
+        self.tasks = {}  # token -> asyncio.Task
+
+    async def _fetch_async(self, token: Token):
+        params = {
+            "quote-policy-id": token.policy_id,
+            "quote-tokenname": token.name,
+            "base-policy-id": "",
+            "base-tokenname": "",
+        }
+        try:
+            with self.lock:
+                self.requests += 1
+            response = await self.client.get(self.url, params=params)
+            response.raise_for_status()
+            price = response.json()["price"]
+            with self.lock:
+                self.cache[token] = (time.monotonic() + self.ttl, price)
+                self.cache.move_to_end(token)
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            # get_prices tries again
+            _LOGGER.warning(f"Could not prefetch price of {token}: {e}")
+        finally:
+            self.tasks.pop(token, None)
+
+    async def prefetch(self, tokens: Iterable[Token]):
+        """
+        Fetches the prices of the tokens that are not cached, concurrently.
+        """
+        now = time.monotonic()
+        with self.lock:
+            missing = [
+                token
+                for token in set(tokens)
+                if token not in self.cache or self.cache[token][0] <= now
+            ]
+        tasks = []
+        for token in missing:
+            task = self.tasks.get(token)
+            if task is None:
+                task = asyncio.create_task(self._fetch_async(token))
+                self.tasks[token] = task
+            tasks.append(task)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def make_price_provider(name: str) -> PriceProvider:
+    if name == "http":
+        return HttpPriceProvider()
+    if name == "stub":
+        return StubPriceProvider()
+    raise ValueError(f"Unknown price backend: {name}")
@@ -0,0 +1,150 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from . import LOG_DIR
+from .config import PROFILE_INTERVAL_MS
+
+_LOGGER = logging.getLogger(__name__)
+
+# querier function -> pipeline stage, the innermost match on the stack labels a sample
+_STAGES = {
+    "decode_block": "decode",
+    "resolve_input": "resolve",
+    "resolve": "resolve",
+    "missing_inputs": "resolve",
+    "get_prices": "prices",
+    "calculate_analytics": "analytics",
+    "commit": "commit",
+    "rollback": "rollback",
+    "housekeeping": "housekeeping",
+    "process_block": "parse",
+    "iterate_blocks": "chain sync",
+    "submit_block": "chain sync",
+}
+_QUERIER_DIR = os.path.dirname(os.path.abspath(__file__))
+# frames deeper than this are cut off at the root
+_MAX_DEPTH = 200
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler for production: a daemon thread takes the
+    stacks of the watched threads (all others if none is watched) every
+    `interval` seconds with sys._current_frames. Nothing runs in the profiled
+    threads themselves.
+
+    Samples are aggregated as collapsed stacks ("thread;[stage];frame;... count",
+    the input format of flamegraph.pl and speedscope) and written to `directory`
+    on `dump`, which the parser calls every PROFILE_BLOCKS blocks.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000, directory: str = LOG_DIR):
+        self.interval = interval
+        self.directory = directory
+        self.threads: Dict[int, str] = {}  # ident -> label
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.samples = 0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def watch_thread(self, label: str, ident: int = None):
+        """
+        Samples the given (default: current) thread under `label`.
+        """
+        self.threads[ident or threading.get_ident()] = label
+
+    def start(self):
+        if self.running and not self.stop_event.is_set():
+            return
+        # a sampler that is still stopping keeps its own event and finishes its dump,
+        # so starting again right after a stop is not lost
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, args=(self.stop_event,), name="profiler", daemon=True
+        )
+        self.thread.start()
+        _LOGGER.info(f"Profiler started, sampling every {self.interval * 1000:.0f} ms")
+
+    def stop(self):
+        """
+        Stops sampling, the sampler writes the remaining samples. Safe in signal handlers.
+        """
+        self.stop_event.set()
+
+    def toggle(self, *_):
+        if self.running and not self.stop_event.is_set():
+            self.stop()
+        else:
+            self.start()
+
+    @staticmethod
+    def _collapse(label: str, frame) -> str:
+        frames = []
+        stage = None
+        while frame is not None and len(frames) < _MAX_DEPTH:
+            code = frame.f_code
+            if stage is None and code.co_name in _STAGES and code.co_filename.startswith(_QUERIER_DIR):
+                stage = _STAGES[code.co_name]
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            frames.append(f"{module}:{code.co_name}")
+            frame = frame.f_back
+        frames.append(f"[{stage or 'other'}]")
+        frames.append(label)
+        return ";".join(reversed(frames))
+
+    def _sample(self):
+        own = threading.get_ident()
+        frames = sys._current_frames()
+        if self.threads:
+            targets = [(ident, label) for ident, label in self.threads.items() if ident in frames]
+        else:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            targets = [(ident, names.get(ident, str(ident))) for ident in frames if ident != own]
+        stacks = [self._collapse(label, frames[ident]) for ident, label in targets]
+        with self.lock:
+            self.stacks.update(stacks)
+            self.samples += 1
+
+    def _run(self, stop_event: threading.Event):
+        try:
+            while not stop_event.wait(self.interval):
+                self._sample()
+        finally:
+            self.dump("stop")
+            _LOGGER.info("Profiler stopped")
+
+    def dump(self, tag) -> Optional[str]:
+        """
+        Writes and resets the samples since the last dump, returns the file name.
+        """
+        with self.lock:
+            stacks, self.stacks = self.stacks, Counter()
+            samples, self.samples = self.samples, 0
+        if not stacks:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{int(time.time())}-{tag}.collapsed")
+        with open(path, "w") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        by_stage = Counter()
+        for stack, count in stacks.items():
+            thread, stage = stack.split(";", 2)[:2]
+            by_stage[f"{thread}{stage}"] += count
+        total = sum(by_stage.values())
+        summary = ", ".join(f"{k} {v / total:.0%}" for k, v in by_stage.most_common())
+        _LOGGER.info(f"Profile of {samples} samples written to {path}: {summary}")
+        return path
+
+
+PROFILER = SamplingProfiler()
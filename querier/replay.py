@@ -0,0 +1,377 @@
+import argparse
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional, Union
+
+import orjson
+import sqlalchemy as sqla
+from sqlalchemy import event, orm
+
+from common.db import get_chain_cursor
+from .block_parser import BlockParser
+from .chainsync import BlockView, ChainSyncClient
+from .decode import DatumDecoder
+from .fallback import FallbackResolver
+from .ogmios import ChainRollback
+from .prices import make_price_provider
+from .resolver import make_resolver
+from .config import DATUM_WORKERS, INPUT_RESOLVER, WRITE_PATH
+
+_LOGGER = logging.getLogger(__name__)
+
+_MAGIC = b"BATCHER-MONITORING-BLOCKS-1\n"
+_END = b"BLOCKS-END\n"
+# zlib level of the block frames, recordings are written once and read often
+_COMPRESSION_LEVEL = 6
+
+
+########################################################################################
+#                                     Recording                                        #
+########################################################################################
+
+
+class BlockRecorder:
+    """
+    Writes the blocks and rollbacks of a chain-sync stream to a file.
+
+    On disk: a magic line, then one frame per item (length as 4 bytes, then the
+    zlib-compressed orjson of the parts of the block that the parser reads, or of
+    the rollback point), then the zlib-compressed index, its offset (8 bytes) and
+    an end marker. The index holds the start point and (slot, offset) of each block,
+    so a replay can start anywhere. Files without an index (interrupted recordings)
+    are scanned instead.
+    """
+
+    def __init__(self, path: str, start_slot: int, start_hash: str):
+        self.path = path
+        self.start = [start_slot, start_hash]
+        self.index = []  # [slot, offset] per block
+        self.blocks = 0
+        self.transactions = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "wb")
+        self.file.write(_MAGIC)
+
+    def _write_frame(self, item: dict):
+        frame = zlib.compress(orjson.dumps(item), _COMPRESSION_LEVEL)
+        self.file.write(struct.pack(">I", len(frame)))
+        self.file.write(frame)
+
+    def add(self, item: Union[BlockView, ChainRollback]):
+        if isinstance(item, ChainRollback):
+            self._write_frame({"rollback": {"slot": item.slot, "id": item.id}})
+            return
+        self.index.append([item.slot, self.file.tell()])
+        self._write_frame(
+            {
+                "id": item.id,
+                "slot": item.slot,
+                "height": item.height,
+                "size": item.size,
+                "transactions": item.transactions,
+            }
+        )
+        self.blocks += 1
+        self.transactions += len(item.transactions)
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(
+            zlib.compress(orjson.dumps({"start": self.start, "blocks": self.index}))
+        )
+        self.file.write(struct.pack(">Q", index_offset))
+        self.file.write(_END)
+        self.file.close()
+        _LOGGER.info(
+            f"Recorded {self.blocks} blocks with {self.transactions} transactions"
+            f" to {self.path} ({os.path.getsize(self.path)} bytes)"
+        )
+
+
+def record(path: str, start_slot: int, start_hash: str, to_slot: int):
+    """
+    Records the blocks after (start_slot, start_hash) up to to_slot.
+    """
+    recorder = BlockRecorder(path, start_slot, start_hash)
+    try:
+        for item in ChainSyncClient().iterate_from(start_slot, start_hash):
+            if isinstance(item, BlockView) and item.slot > to_slot:
+                break
+            recorder.add(item)
+            if isinstance(item, BlockView) and item.slot == to_slot:
+                break
+            if recorder.blocks % 10000 == 0 and recorder.blocks:
+                _LOGGER.info(f"Recorded {recorder.blocks} blocks, at slot {item.slot}")
+    finally:
+        recorder.close()
+
+
+########################################################################################
+#                                       Replay                                         #
+########################################################################################
+
+
+def _read_index(f) -> Optional[dict]:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < len(_MAGIC) + 8 + len(_END):
+        return None
+    f.seek(size - len(_END) - 8)
+    (index_offset,) = struct.unpack(">Q", f.read(8))
+    if f.read() != _END:
+        return None
+    f.seek(index_offset)
+    return orjson.loads(zlib.decompress(f.read(size - len(_END) - 8 - index_offset)))
+
+
+class BlockReplay:
+    """
+    Replays a recording into BlockParser.run, as fast as the parser consumes it.
+    Same interface as the block buffer of the live querier.
+
+    Starts with the first block after `after_slot` and stops after `max_blocks`
+    blocks. With `preload`, all blocks are decoded before the replay, so that
+    reading the file is not part of the measured time.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        after_slot: int = None,
+        max_blocks: int = None,
+        preload: bool = False,
+    ):
+        self.path = path
+        self.after_slot = after_slot
+        self.max_blocks = max_blocks
+        self.should_exit = False
+        with open(path, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"{path} is not a block recording")
+            self.index = _read_index(f)
+        if self.index is None:
+            _LOGGER.warning(f"{path} has no index, the recording was interrupted")
+        self.items = list(self._read()) if preload else None
+
+        # statistics
+        self.blocks = 0
+        self.transactions = 0
+        self.read_time = 0.0
+
+    @property
+    def start(self) -> Optional[List]:
+        return self.index["start"] if self.index else None
+
+    def _first_offset(self) -> int:
+        if self.index is None or self.after_slot is None:
+            return len(_MAGIC)
+        for slot, offset in self.index["blocks"]:
+            if slot > self.after_slot:
+                return offset
+        return self._index_offset()
+
+    def _index_offset(self) -> int:
+        with open(self.path, "rb") as f:
+            f.seek(-len(_END) - 8, os.SEEK_END)
+            return struct.unpack(">Q", f.read(8))[0]
+
+    def _read(self) -> Iterator[Union[BlockView, ChainRollback]]:
+        end = self._index_offset() if self.index is not None else None
+        blocks = 0
+        with open(self.path, "rb") as f:
+            f.seek(self._first_offset())
+            while self.max_blocks is None or blocks < self.max_blocks:
+                if end is not None and f.tell() >= end:
+                    return
+                header = f.read(4)
+                if len(header) < 4:
+                    return
+                (length,) = struct.unpack(">I", header)
+                frame = f.read(length)
+                if len(frame) < length:
+                    _LOGGER.warning(f"Truncated frame at the end of {self.path}")
+                    return
+                item = orjson.loads(zlib.decompress(frame))
+                if "rollback" in item:
+                    point = item["rollback"]
+                    if blocks:
+                        yield ChainRollback(point["slot"], point["id"])
+                    continue
+                # only up to the start: blocks after a rollback may reuse earlier slots
+                if not blocks and self.after_slot is not None and item["slot"] <= self.after_slot:
+                    continue
+                blocks += 1
+                yield BlockView(item)
+
+    def iterate_blocks(self, timeout=None) -> Iterator[Union[BlockView, ChainRollback]]:
+        # never waits for blocks, so the timeout of the parser does not apply
+        items = iter(self.items) if self.items is not None else self._read()
+        while not self.should_exit:
+            start = time.monotonic()
+            item = next(items, None)
+            self.read_time += time.monotonic() - start
+            if item is None:
+                return
+            if isinstance(item, BlockView):
+                self.blocks += 1
+                self.transactions += len(item.transactions)
+            yield item
+
+    def stats(self) -> dict:
+        return {
+            "blocks": self.blocks,
+            "transactions": self.transactions,
+            "read_time": round(self.read_time, 3),
+        }
+
+
+########################################################################################
+#                                     Benchmark                                        #
+########################################################################################
+
+
+class DatabaseTimer:
+    """
+    Time the parser thread spends in the database: statement execution and
+    commits (including the flush of the session). COPY on the raw psycopg
+    cursor of the bulk write path is not covered.
+    """
+
+    def __init__(self, engine: sqla.Engine):
+        self.engine = engine
+        self.thread = threading.get_ident()
+        self.time = 0.0
+        self.statements = 0
+        self.statement_start = None
+        self.commit_start = None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread and self.commit_start is None:
+            self.statement_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() != self.thread:
+            return
+        self.statements += 1
+        if self.statement_start is not None:
+            self.time += time.perf_counter() - self.statement_start
+            self.statement_start = None
+
+    def _before_commit(self, session):
+        if threading.get_ident() == self.thread:
+            self.commit_start = time.perf_counter()
+
+    def _after_commit(self, session):
+        if threading.get_ident() == self.thread and self.commit_start is not None:
+            self.time += time.perf_counter() - self.commit_start
+            self.commit_start = None
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        event.listen(orm.Session, "before_commit", self._before_commit)
+        event.listen(orm.Session, "after_commit", self._after_commit)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+        event.remove(orm.Session, "before_commit", self._before_commit)
+        event.remove(orm.Session, "after_commit", self._after_commit)
+
+
+def benchmark(
+    path: str,
+    max_blocks: int = None,
+    preload: bool = False,
+    price_backend: str = "stub",
+    write_path: str = WRITE_PATH,
+    datum_workers: int = DATUM_WORKERS,
+    price_provider=None,
+    fallback: FallbackResolver = None,
+) -> dict:
+    """
+    Replays a recording into the database at DATABASE_URI and returns the
+    throughput. Continues after the chain cursor, so a fresh database replays the
+    whole file and the fallback cache makes reruns free of remote calls.
+    """
+    cursor = get_chain_cursor()
+    replay = BlockReplay(
+        path,
+        after_slot=cursor.slot if cursor is not None else None,
+        max_blocks=max_blocks,
+        preload=preload,
+    )
+    if cursor is None and replay.start is not None:
+        _LOGGER.info(f"Replaying {path} from slot {replay.start[0]} into an empty database")
+    datum_decoder = DatumDecoder(workers=datum_workers)
+    try:
+        parser = BlockParser(
+            iterator=replay,
+            input_resolver=make_resolver(INPUT_RESOLVER),
+            price_provider=price_provider or make_price_provider(price_backend),
+            datum_decoder=datum_decoder,
+            write_path=write_path,
+            fallback=fallback,
+        )
+        with DatabaseTimer(parser.engine) as timer:
+            start = time.perf_counter()
+            parser.run()
+            seconds = time.perf_counter() - start
+    finally:
+        datum_decoder.close()
+    result = {
+        "blocks": replay.blocks,
+        "transactions": replay.transactions,
+        "seconds": round(seconds, 3),
+        "blocks_per_s": round(replay.blocks / seconds, 1) if seconds else None,
+        "tx_per_s": round(replay.transactions / seconds, 1) if seconds else None,
+        "db_seconds": round(timer.time, 3),
+        "db_share": round(timer.time / seconds, 3) if seconds else None,
+        "statements": timer.statements,
+        "read_seconds": round(replay.read_time, 3),
+        "write_path": write_path,
+    }
+    _LOGGER.info(f"Replay benchmark: {result}")
+    return result
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(description="Record and replay block streams")
+    commands = argp.add_subparsers(dest="command", required=True)
+
+    record_args = commands.add_parser("record", help="Record blocks from Ogmios")
+    record_args.add_argument("path")
+    record_args.add_argument("--from-slot", type=int, required=True)
+    record_args.add_argument("--from-hash", required=True)
+    record_args.add_argument("--to-slot", type=int, required=True)
+
+    bench_args = commands.add_parser(
+        "bench", help="Replay a recording into the database at DATABASE_URI"
+    )
+    bench_args.add_argument("path")
+    bench_args.add_argument("--blocks", type=int, help="Stop after this many blocks")
+    bench_args.add_argument(
+        "--preload", action="store_true", help="Decode all blocks before the replay"
+    )
+    bench_args.add_argument("--prices", choices=["stub", "http"], default="stub")
+    bench_args.add_argument("--write-path", choices=["bulk", "orm"], default=WRITE_PATH)
+    bench_args.add_argument("--datum-workers", type=int, default=DATUM_WORKERS)
+
+    args = argp.parse_args()
+    if args.command == "record":
+        record(args.path, args.from_slot, args.from_hash, args.to_slot)
+    else:
+        result = benchmark(
+            args.path,
+            max_blocks=args.blocks,
+            preload=args.preload,
+            price_backend=args.prices,
+            write_path=args.write_path,
+            datum_workers=args.datum_workers,
+        )
+        print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
@@ -0,0 +1,52 @@
+import logging
+from typing import Dict, List
+
+from common.db import UTxO
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class InputResolver:
+    """
+    Resolves transaction inputs that are not stored in the database, before the
+    Blockfrost fallback (see querier/fallback.py) is asked for the rest.
+    Orders are always stored, so resolvers only return plain UTxOs.
+    """
+
+    def resolve(self, input_ids: List[str]) -> Dict[str, UTxO]:
+        raise NotImplementedError
+
+
+class StubResolver(InputResolver):
+    """
+    Resolves inputs from a local dictionary. Used for testing and replays.
+    """
+
+    def __init__(self, utxos: dict = None):
+        # id -> (owner, value)
+        self.utxos = dict(utxos or {})
+
+    def add(self, utxo_id: str, owner: str, value: dict):
+        self.utxos[utxo_id] = (owner, value)
+
+    def resolve(self, input_ids: List[str]) -> Dict[str, UTxO]:
+        resolved = {}
+        for input_id in input_ids:
+            if input_id in self.utxos:
+                owner, value = self.utxos[input_id]
+                resolved[input_id] = UTxO(
+                    id=input_id,
+                    owner=owner,
+                    value=value,
+                    created_slot=0,
+                    block_hash="",
+                )
+        return resolved
+
+
+def make_resolver(name: str) -> InputResolver:
+    if name == "stub":
+        return StubResolver()
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown input resolver: {name}")
@@ -1,60 +1,110 @@
 import logging
+from typing import List, Tuple
+
 import sqlalchemy as sqla
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import func
 import ipdb
 from common.db import (
     _ENGINE,
+    BlockHeader,
     UTxO,
     Order,
     Transaction,
     get_max_slot_block_and_index,
 )
+from . import rollups
+from .batchers import revert_changes
+from .config import SECURITY_PARAM
 
 
-# TODO: set this to cardano security parameter
-MAX_ALLOWED_ROLLBACK = 2 * 86400 / 20  # rollback at most 2 days of blocks
+# blocks deeper than the security parameter cannot be rolled back
+MAX_ALLOWED_ROLLBACK = SECURITY_PARAM
 _LOGGER = logging.getLogger(__name__)
 
 
+def recent_blocks(session: Session, limit: int = MAX_ALLOWED_ROLLBACK + 1) -> list:
+    """
+    (slot, hash) of the latest blocks, newest first.
+    Databases written before BlockHeader existed fall back to the blocks that created UTxOs.
+    """
+    blocks = session.execute(
+        sqla.select(BlockHeader.slot, BlockHeader.hash)
+        .order_by(BlockHeader.slot.desc())
+        .limit(limit)
+    ).all()
+    if not blocks:
+        blocks = session.execute(
+            sqla.select(UTxO.created_slot, UTxO.block_hash)
+            .distinct()
+            .order_by(UTxO.created_slot.desc())
+            .limit(limit)
+        ).all()
+    return [tuple(b) for b in blocks]
+
+
+def intersection_points(session: Session) -> List[Tuple[int, str]]:
+    """
+    Exponentially spaced recent blocks (the 1st, 2nd, 3rd, 5th, 9th, ... newest and
+    the oldest known one), so one find_intersection covers a fork of any depth up to k.
+    """
+    blocks = recent_blocks(session)
+    points = []
+    offset = 0
+    while offset < len(blocks):
+        points.append(blocks[offset])
+        offset = 2 * offset if offset else 1
+    if blocks and blocks[-1] not in points:
+        points.append(blocks[-1])
+    return points
+
+
+def revert_after(session: Session, slot: int):
+    """
+    Deletes everything newer than `slot` and marks UTxOs spent after it as unspent.
+    Orders linked to deleted transactions are unlinked by the foreign key, batcher
+    changes are reverted and the rollups of the affected buckets are recomputed.
+    """
+    session.execute(sqla.delete(UTxO).where(UTxO.created_slot > slot))
+    session.execute(sqla.delete(Transaction).where(Transaction.slot > slot))
+    revert_changes(session, slot)
+    session.execute(sqla.delete(Order).where(Order.slot > slot))
+    session.execute(
+        sqla.update(UTxO).where(UTxO.spent_slot > slot).values(spent_slot=None)
+    )
+    session.execute(sqla.delete(BlockHeader).where(BlockHeader.slot > slot))
+    rollups.rebuild(session, after_slot=slot)
+
+
 class RollbackHandler:
     def __init__(self):
         self.slot, self.block_hash = get_max_slot_block_and_index()
         self.original_slot = self.slot
         _LOGGER.warning(f"Starting rollback from {self.slot}.{self.block_hash}")
-        stmt = (
-            sqla.select(UTxO.created_slot, UTxO.block_hash)
-            .distinct()  # otherwise we'd revert to 1 block >1 times
-            .order_by(UTxO.created_slot.desc())
-        )
         self.session = Session(_ENGINE)
-        self.res = self.session.execute(stmt)
-        self.res.fetchone()  # do away with current block
+        self.blocks = recent_blocks(self.session)
+        self.rolled_back = 0
 
     def prev_block(self):
-        row = self.res.fetchone()
-        if (self.original_slot - self.slot) >= MAX_ALLOWED_ROLLBACK:
+        self.rolled_back += 1
+        if self.rolled_back > MAX_ALLOWED_ROLLBACK:
             raise Exception("Exceeded maximal rollback length - is the node synced?")
-        if row is None:
+        if self.rolled_back >= len(self.blocks):
             raise Exception("No more blocks to roll back!")
 
-        self.slot, self.block_hash = row
+        self.slot, self.block_hash = self.blocks[self.rolled_back]
         _LOGGER.warning(
-            f"Rolled back {self.original_slot - self.slot} blocks, now at {self.slot}.{self.block_hash}"
+            f"Rolled back {self.rolled_back} blocks, now at {self.slot}.{self.block_hash}"
         )
         return self.slot, self.block_hash
 
+    def rollback_to(self, slot: int, block_hash: str):
+        self.slot, self.block_hash = slot, block_hash
+        self.rollback()
+
     def rollback(self):
         # delete everything newer than the block that we roll back to
         _LOGGER.warning(f"Executing rollback to block {self.slot}.{self.block_hash}")
 
-        self.session.execute(sqla.delete(UTxO).where(UTxO.created_slot > self.slot))
-        self.session.execute(
-            sqla.delete(Transaction).where(Transaction.slot > self.slot)
-        )
-        self.session.execute(sqla.delete(Order).where(Order.slot > self.slot))
-        self.session.execute(
-            sqla.update(UTxO).where(UTxO.spent_slot > self.slot).values(spent_slot=None)
-        )
-
+        revert_after(self.session, self.slot)
         self.session.commit()
@@ -0,0 +1,150 @@
+import logging
+from collections import defaultdict
+from typing import Iterable, List, Tuple
+
+import sqlalchemy as sqla
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from common.db import ROLLUP_PERIODS, BatcherRollup, Transaction
+from common.util import slot_timestamp, timestamp_slot
+
+_LOGGER = logging.getLogger(__name__)
+
+_TABLE = BatcherRollup.__table__
+_COLUMNS = ["batcher_id", "period", "bucket_start", "count", "sum", "min", "max"]
+# profit of a transaction as aggregated by the rollups and server/crud.py
+_PROFIT = Transaction.ada_profit + Transaction.equivalent_ada
+
+
+def bucket_start(slot: int, period: int) -> int:
+    timestamp = slot_timestamp(slot)
+    return timestamp - timestamp % period
+
+
+def _bucket_expr(period: int):
+    # literal numbers, so that Postgres sees the same expression in SELECT and GROUP BY
+    timestamp = Transaction.slot + sqla.literal_column(str(slot_timestamp(0)))
+    return timestamp - timestamp % sqla.literal_column(str(period))
+
+
+def _upsert(session: Session):
+    """
+    INSERT that adds the counts and sums to existing buckets and widens their min and max.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(_TABLE)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(_TABLE)
+    else:
+        raise ValueError(f"Rollups do not support {dialect}")
+    new, old = stmt.excluded, _TABLE.c
+    return stmt.on_conflict_do_update(
+        index_elements=["batcher_id", "period", "bucket_start"],
+        set_={
+            "count": old["count"] + new["count"],
+            "sum": old["sum"] + new["sum"],
+            "min": sqla.case((new["min"] < old["min"], new["min"]), else_=old["min"]),
+            "max": sqla.case((new["max"] > old["max"], new["max"]), else_=old["max"]),
+        },
+    )
+
+
+def add_transactions(session: Session, transactions: Iterable[Tuple[int, int, float]]):
+    """
+    Adds (batcher id, slot, profit) of new transactions to the rollups of their buckets,
+    in the transaction of the session that inserts them. The profits must be those stored,
+    see writer.round_profits.
+    """
+    buckets = defaultdict(lambda: [0, 0, None, None])  # key -> count, sum, min, max
+    for batcher_id, slot, profit in transactions:
+        if batcher_id is None:
+            continue
+        for period in ROLLUP_PERIODS:
+            bucket = buckets[(batcher_id, period, bucket_start(slot, period))]
+            bucket[0] += 1
+            bucket[1] += profit
+            bucket[2] = profit if bucket[2] is None else min(bucket[2], profit)
+            bucket[3] = profit if bucket[3] is None else max(bucket[3], profit)
+    if not buckets:
+        return
+    session.execute(
+        _upsert(session),
+        [dict(zip(_COLUMNS, key + tuple(values))) for key, values in buckets.items()],
+    )
+
+
+def merge(session: Session, winner: int, absorbed: List[int]):
+    """
+    Folds the rollups of the absorbed batchers into those of the winner.
+    """
+    select = (
+        sqla.select(
+            sqla.literal(winner),
+            BatcherRollup.period,
+            BatcherRollup.bucket_start,
+            sqla.func.sum(BatcherRollup.count),
+            sqla.func.sum(BatcherRollup.sum),
+            sqla.func.min(BatcherRollup.min),
+            sqla.func.max(BatcherRollup.max),
+        )
+        .where(BatcherRollup.batcher_id.in_(absorbed))
+        .group_by(BatcherRollup.period, BatcherRollup.bucket_start)
+    )
+    session.execute(_upsert(session).from_select(_COLUMNS, select))
+    session.execute(sqla.delete(_TABLE).where(BatcherRollup.batcher_id.in_(absorbed)))
+
+
+def rebuild(session: Session, after_slot: int = None, batcher_ids: List[int] = None):
+    """
+    Recomputes the rollups from the Transaction table: those of the buckets containing
+    slots after `after_slot` (all if None), of the given batchers (all if None).
+    Used where rollups cannot be reverted incrementally, i.e. min and max on rollbacks.
+    """
+    for period in ROLLUP_PERIODS:
+        delete = sqla.delete(_TABLE).where(BatcherRollup.period == period)
+        bucket = _bucket_expr(period)
+        select = (
+            sqla.select(
+                Transaction.batcher_id,
+                sqla.literal(period),
+                bucket,
+                sqla.func.count(),
+                sqla.func.sum(_PROFIT),
+                sqla.func.min(_PROFIT),
+                sqla.func.max(_PROFIT),
+            )
+            .where(Transaction.batcher_id.is_not(None))
+            .group_by(Transaction.batcher_id, bucket)
+        )
+        if after_slot is not None:
+            first_bucket = bucket_start(after_slot + 1, period)
+            delete = delete.where(BatcherRollup.bucket_start >= first_bucket)
+            select = select.where(Transaction.slot >= timestamp_slot(first_bucket))
+        if batcher_ids is not None:
+            delete = delete.where(BatcherRollup.batcher_id.in_(batcher_ids))
+            select = select.where(Transaction.batcher_id.in_(batcher_ids))
+        session.execute(delete)
+        session.execute(sqla.insert(_TABLE).from_select(_COLUMNS, select))
+
+
+def ensure(engine: sqla.Engine):
+    """
+    Computes the rollups of databases written before they existed.
+    """
+    with Session(engine) as session:
+        if session.scalar(sqla.select(BatcherRollup.batcher_id).limit(1)) is not None:
+            return
+        if (
+            session.scalar(
+                sqla.select(Transaction.id)
+                .where(Transaction.batcher_id.is_not(None))
+                .limit(1)
+            )
+            is None
+        ):
+            return
+        _LOGGER.info("Computing the batcher rollups of the existing transactions")
+        rebuild(session)
+        session.commit()
@@ -0,0 +1,104 @@
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import Optional
+
+import orjson
+
+from .batchers import BatcherIndex
+from .cache import BloomFilter
+
+_LOGGER = logging.getLogger(__name__)
+
+_MAGIC = b"BATCHER-MONITORING-SNAPSHOT-1\n"
+
+
+class StateSnapshot:
+    """
+    In-memory parser state at a committed block (slot, hash).
+
+    On disk: a magic line followed by the zlib-compressed concatenation of
+    the length of the JSON metadata (4 bytes), the metadata (orjson) and the
+    raw bits of the bloom filter. Files are replaced atomically.
+    """
+
+    def __init__(
+        self,
+        slot: int,
+        block_hash: str,
+        open_orders: list,
+        batcher_index: BatcherIndex,
+        bloom: BloomFilter,
+    ):
+        self.slot = slot
+        self.block_hash = block_hash
+        self.open_orders = open_orders
+        self.batcher_index = batcher_index
+        self.bloom = bloom
+
+    def save(self, path: str):
+        start = time.monotonic()
+        meta = orjson.dumps(
+            {
+                "slot": self.slot,
+                "hash": self.block_hash,
+                "open_orders": self.open_orders,
+                "addresses": self.batcher_index.address_to_batcher,
+                "parent": list(self.batcher_index.parent.items()),
+                "bloom": [
+                    self.bloom.capacity,
+                    self.bloom.error_rate,
+                    self.bloom.count,
+                ],
+            }
+        )
+        payload = zlib.compress(
+            struct.pack(">I", len(meta)) + meta + bytes(self.bloom.bits), 1
+        )
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_MAGIC)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _LOGGER.info(
+            f"Wrote snapshot at slot {self.slot} ({len(payload)} bytes)"
+            f" in {(time.monotonic() - start) * 1000:.0f} ms"
+        )
+
+    @classmethod
+    def load(cls, path: str) -> Optional["StateSnapshot"]:
+        """
+        Returns None if there is no (valid) snapshot at path.
+        """
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(_MAGIC)) != _MAGIC:
+                    _LOGGER.warning(f"Ignoring snapshot {path} with unknown format")
+                    return None
+                payload = zlib.decompress(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, zlib.error):
+            _LOGGER.exception(f"Could not read snapshot {path}")
+            return None
+
+        (meta_length,) = struct.unpack(">I", payload[:4])
+        meta = orjson.loads(payload[4 : 4 + meta_length])
+
+        batcher_index = BatcherIndex()
+        batcher_index.restore(meta["addresses"], dict(meta["parent"]))
+
+        capacity, error_rate, count = meta["bloom"]
+        bloom = BloomFilter(capacity, error_rate)
+        bloom.bits = bytearray(payload[4 + meta_length :])
+        bloom.count = count
+
+        return cls(meta["slot"], meta["hash"], meta["open_orders"], batcher_index, bloom)
+
+    def matches(self, slot: int, block_hash: str) -> bool:
+        return self.slot == slot and self.block_hash == block_hash
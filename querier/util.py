@@ -1,21 +1,22 @@
-import requests
 from typing import List, Tuple
 from sqlalchemy.orm import Session
 import sqlalchemy
-from argparse import Namespace
 from collections import defaultdict
+from functools import lru_cache
 import pycardano
 import logging
 import ipdb
 
 from common.cardano_utils import datum_from_cborhex
 from common.classes import Token, LOVELACE, ShelleyAddress
-from common.db import Batcher, BatcherAddress, Order, Transaction, UTxO
+from common.db import AddressRole, Order, UTxO
 from common.util import parse_assets_to_list
+from . import metrics
+from .batchers import BatcherIndex
+from .prices import PriceProvider
 from .config import (
+    ADDRESS_ROLE_CACHE_SIZE,
     MUESLI_ADDR_TO_VERSION,
-    PRICE_EP,
-    BLOCKFROST,
     POOL_CONTRACTS,
     PROFIT_ADDRESSES,
 )
@@ -23,24 +24,6 @@ from .config import (
 _LOGGER = logging.getLogger(__name__)
 
 
-def get_price_in_ada(token: Token):
-    quote_policy_id = ""
-    quote_name = ""
-    base_policy_id = token.policy_id
-    base_name = token.name
-
-    # Base and quote are flipped because that is how the middleware expects it :(
-    params = {
-        "quote-policy-id": base_policy_id,
-        "quote-tokenname": base_name,
-        "base-policy-id": quote_policy_id,
-        "base-tokenname": quote_name,
-    }
-
-    response = requests.get(PRICE_EP, params=params)
-    return response.json()
-
-
 def initialise_open_orders(engine: sqlalchemy.engine) -> dict:
 
     open_orders = dict()
@@ -58,11 +41,17 @@ def parse_output(
     id: str,
     slot: int,
     block_hash: str,
+    parties: Tuple[str, str] = None,
 ) -> UTxO:
+    """
+    parties are the sender and recipient of an order output, if its datum was already decoded.
+    """
     contract_version = MUESLI_ADDR_TO_VERSION.get(output["address"], None)
     if contract_version:
         # Muesliswap order
-        sender, recipient = parse_datum(tx, output, contract_version)
+        if parties is None:
+            parties = parse_datum(tx, output, contract_version)
+        sender, recipient = parties
         return Order(
             id=id,
             sender=sender,
@@ -77,6 +66,7 @@ def parse_output(
             owner=output["address"],
             created_slot=slot,
             block_hash=block_hash,
+            role=address_role(output["address"]),
         )
 
 
@@ -97,6 +87,13 @@ def parse_datum(tx: dict, output: dict, contract_version: str):
         )
         raise Exception("No datum attached")
 
+    return parse_order_datum(datum, contract_version)
+
+
+def parse_order_datum(datum: dict, contract_version: str):
+    """
+    Returns the sender and recipient (payment key hash + stake key hash) of an order datum.
+    """
     if "lq" in contract_version:
         sender_pkh, sender_skh = parse_wallet_address(datum["fields"][0])
         recipient_pkh, recipient_skh = parse_wallet_address(datum["fields"][1])
@@ -109,23 +106,8 @@ def parse_datum(tx: dict, output: dict, contract_version: str):
         return sender, sender
 
 
-def parse_bf_datum(utxo: Namespace, contract_version: str):
-    if utxo.inline_datum:
-        datum = datum_from_cborhex(utxo.inline_datum)
-    else:
-        datum = BLOCKFROST.script_datum_cbor(utxo.data_hash)
-        datum = datum_from_cborhex(datum.cbor)
-
-    if "lq" in contract_version:
-        sender_pkh, sender_skh = parse_wallet_address(datum["fields"][0])
-        recipient_pkh, recipient_skh = parse_wallet_address(datum["fields"][1])
-        return sender_pkh + sender_skh, recipient_pkh + recipient_skh
-
-    if contract_version in ["v2", "v3", "v4"]:
-        datum = datum["fields"][0]["fields"]
-        sender_skh, sender_pkh = parse_wallet_address(datum[0])
-        sender = sender_pkh + sender_skh
-        return sender, sender
+def parse_bf_datum(datum_cbor: str, contract_version: str):
+    return parse_order_datum(datum_from_cborhex(datum_cbor), contract_version)
 
 
 def parse_wallet_address(datum: dict):
@@ -147,23 +129,52 @@ def address_hex_to_bech32(pkh: str = None, skh: str = None, full: str = None) ->
     return ShelleyAddress(mainnet=True, pubkeyhash=pkh, stakekeyhash=skh).bech32
 
 
-def parse_value_bf_to_ogmios(value: Namespace) -> dict:
+def parse_value_bf_to_ogmios(value: List[dict]) -> dict:
     ret = {}
     for asset in value:
-        token = Token.from_hex(asset.unit)
-        ret[token.policy_id] = {token.name: asset.quantity}
+        token = Token.from_hex(asset["unit"])
+        ret.setdefault(token.policy_id, {})[token.name] = asset["quantity"]
 
     return ret
 
 
+_POOL_CONTRACTS = frozenset(POOL_CONTRACTS)
+_PROFIT_ADDRESSES = frozenset(PROFIT_ADDRESSES)
+# bech32 characters of the first five header bits of Shelley addresses with a key hash
+# payment part (types 0, 2, 4 and 6 in CIP-19), these cannot be pool contracts
+_KEY_PAYMENT_CHARS = frozenset("qpy9gfvd")
+
+
+@lru_cache(maxsize=ADDRESS_ROLE_CACHE_SIZE)
+def address_role(address: str) -> AddressRole:
+    if address in MUESLI_ADDR_TO_VERSION:
+        return AddressRole.ORDER_CONTRACT
+    if address in _PROFIT_ADDRESSES:
+        return AddressRole.PROFIT_ADDRESS
+    hrp, _, data = address.partition("1")
+    if hrp.startswith("addr") and data[:1] in _KEY_PAYMENT_CHARS:
+        # most outputs, classified without decoding the address
+        return AddressRole.WALLET
+    try:
+        payment_part = str(pycardano.Address.decode(address).payment_part)
+    except Exception:
+        # e.g. Byron addresses
+        return AddressRole.WALLET
+    if payment_part in _POOL_CONTRACTS:
+        return AddressRole.POOL_CONTRACT
+    return AddressRole.WALLET
+
+
 def filter_utxos(outputs):
+    """
+    Drop orders and UTxOs of pool contracts and profit addresses.
+    """
     ret = []
     for o in outputs:
         if not isinstance(o, UTxO):
             continue
-        if str(pycardano.Address.decode(o.owner).payment_part) in POOL_CONTRACTS:
-            continue
-        if o.owner in PROFIT_ADDRESSES:
+        role = o.role if o.role is not None else address_role(o.owner)
+        if role == AddressRole.POOL_CONTRACT or role == AddressRole.PROFIT_ADDRESS:
             continue
         ret.append(o)
 
@@ -175,9 +186,11 @@ def calculate_analytics(
     outputs: List[UTxO],
     orders: List[Order],
     session: Session,
-) -> Tuple[Batcher, dict, int, int]:
+    price_provider: PriceProvider,
+    batcher_index: BatcherIndex,
+) -> Tuple[int, int, dict, int]:
     """
-    Returns the batcher, batcher's ADA revenue, a dictionary mapping non-ADA tokens to their revenue
+    Returns the batcher id, batcher's ADA revenue, a dictionary mapping non-ADA tokens to their revenue
     and a sum of the non-ADA amounts converted to ADA using the latest prices.
     """
 
@@ -212,58 +225,8 @@ def calculate_analytics(
     # Batchers should have at least one UTxO in the inputs and the outputs
     addresses = [address for address in input_addresses if address in output_addresses]
 
-    if len(addresses) == 0:
-        # Can happen for some cancellations
-        batcher = None
-
-    elif len(addresses) == 1:
-        try:
-            batcher = (
-                session.query(Batcher)
-                .join(BatcherAddress, Batcher.id == BatcherAddress.batcher_id)
-                .filter(BatcherAddress.address == addresses[0])
-            ).one_or_none()
-            if not batcher:
-                batcher = Batcher()
-                addr = BatcherAddress(address=addresses[0], batcher=batcher)
-                session.add(batcher)
-                session.add(addr)
-
-        except:
-            raise Exception(
-                f"Multiple batchers associated with address: {addresses[0]}"
-            )
-    else:
-        batcher_list = []
-        unassociated_addresses = []
-        for address in addresses:
-            try:
-                batcher = (
-                    session.query(Batcher)
-                    .join(BatcherAddress, Batcher.id == BatcherAddress.batcher_id)
-                    .filter(BatcherAddress.address == address)
-                ).one_or_none()
-                if batcher:
-                    batcher_list.append(batcher)
-                else:
-                    unassociated_addresses.append(address)
-            except:
-                raise Exception(f"Multiple batchers associated with address: {address}")
-        if len(batcher_list) == 0:
-            batcher = Batcher()
-            session.add(batcher)
-        if len(batcher_list) > 1:
-            for i in range(1, len(batcher_list)):
-                if batcher_list[0].id != batcher_list[i].id:
-                    for address in batcher_list[i].addresses:
-                        address.batcher_id = batcher_list[0].id
-                    for transaction in batcher_list[i].transactions:
-                        transaction.batcher_id = batcher_list[0].id
-                    session.delete(batcher_list[i])
-            batcher = batcher_list[0]
-        for unassociated_address in unassociated_addresses:
-            addr = BatcherAddress(address=unassociated_address, batcher=batcher)
-            session.add(addr)
+    # Can be empty for some cancellations
+    batcher_id = batcher_index.attribute(session, addresses)
 
     out_assets = defaultdict(int)
     for output_utxo in outputs:
@@ -288,6 +251,12 @@ def calculate_analytics(
         if token not in out_assets:
             differences[token] = -amount
 
+    # fetch the prices of all tokens at once
+    with metrics.PRICES.time():
+        prices = price_provider.get_prices(
+            token for token, amount in differences.items() if amount and token != LOVELACE
+        )
+
     ada_profit = 0
     equivalent_ada = 0
     zero_revenue_tokens = []
@@ -298,8 +267,7 @@ def calculate_analytics(
         if token == LOVELACE:
             ada_profit += amount
         else:
-            prices = get_price_in_ada(token)
-            equivalent_ada += amount * prices["price"]
+            equivalent_ada += amount * prices[token]
     for token in zero_revenue_tokens:
         del differences[token]
 
@@ -308,10 +276,10 @@ def calculate_analytics(
 
     differences = {k.to_hex(): v for k, v in differences.items()}
 
-    if not batcher and len(addresses) > 0:
+    if batcher_id is None and len(addresses) > 0:
         _LOGGER.error(
             f"No batcher created found for addresses: {addresses}\n"
             f"Transaction:{outputs[0].id[:-2]}"
         )
 
-    return (batcher, ada_profit, differences, equivalent_ada)
+    return (batcher_id, ada_profit, differences, equivalent_ada)
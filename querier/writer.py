@@ -0,0 +1,326 @@
+import logging
+import math
+from collections import defaultdict
+from typing import List
+
+import orjson
+import sqlalchemy as sqla
+from sqlalchemy import BigInteger, Integer, String
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from common.db import BlockHeader, Order, Transaction, UTxO
+from . import rollups
+from .batchers import BatcherIndex
+from .config import SECURITY_PARAM
+
+_LOGGER = logging.getLogger(__name__)
+
+
+UTXO_COLUMNS = (
+    "id",
+    "owner",
+    "value",
+    "created_slot",
+    "spent_slot",
+    "block_hash",
+    "role",
+)
+# rows per UPDATE ... FROM (VALUES ...), Postgres allows at most 65535 parameters
+VALUES_CHUNK_SIZE = 10000
+
+
+def round_profits(session: Session, transaction: Transaction):
+    """
+    Postgres stores the profits in BigInteger columns. They are rounded here, half away
+    from zero, instead of by the cast, so that the rollups add up the stored values.
+    SQLite stores them as they are.
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return
+    for column in ("ada_profit", "equivalent_ada"):
+        value = getattr(transaction, column)
+        setattr(transaction, column, int(math.copysign(math.floor(abs(value) + 0.5), value)))
+
+
+def write_block_headers(session: Session, headers: list):
+    """
+    Insert the headers of the processed blocks and drop those more than k blocks deep.
+    """
+    if not headers:
+        return
+    session.execute(sqla.insert(BlockHeader), headers)
+    session.execute(
+        sqla.delete(BlockHeader).where(
+            BlockHeader.height <= headers[-1]["height"] - SECURITY_PARAM
+        )
+    )
+
+
+def update_by_id(
+    session: Session, model, column: str, type_, rows: list, is_postgres: bool
+):
+    """
+    Set `column` of the rows of `model` with one statement per chunk.
+    rows is a list of (id, value) tuples, ids that do not exist are ignored.
+    """
+    if not is_postgres:
+        table = model.__table__
+        session.execute(
+            sqla.update(table)
+            .where(table.c.id == sqla.bindparam("_id"))
+            .values({column: sqla.bindparam("_value")}),
+            [{"_id": i, "_value": value} for i, value in rows],
+        )
+        return
+    for start in range(0, len(rows), VALUES_CHUNK_SIZE):
+        values = sqla.values(
+            sqla.column("id", String), sqla.column(column, type_), name="v"
+        ).data(rows[start : start + VALUES_CHUNK_SIZE])
+        session.execute(
+            sqla.update(model)
+            .where(model.id == values.c.id)
+            .values({column: values.c[column]})
+            .execution_options(synchronize_session=False)
+        )
+
+
+class OrmWriter:
+    """
+    Writes outputs and transactions through the ORM unit of work.
+    Spend marks are collected and written with one UPDATE per slot.
+    Transactions are added to the session on flush, once their batchers are final.
+    """
+
+    def __init__(self, batcher_index: BatcherIndex):
+        self.batcher_index = batcher_index
+        # slot -> ids of UTxOs spent in that slot
+        self.spends = defaultdict(list)
+        self.transactions = []  # (Transaction, batcher id, orders)
+        self.headers = []
+
+    def add_block(self, slot: int, block_hash: str, height: int):
+        self.headers.append({"slot": slot, "hash": block_hash, "height": height})
+
+    def add_outputs(self, session: Session, outputs: list):
+        session.add_all(outputs)
+
+    def mark_spent(self, utxo_id: str, slot: int):
+        self.spends[slot].append(utxo_id)
+
+    def get_utxo(self, utxo_id: str) -> UTxO:
+        # pending outputs are flushed by the session before each query
+        return None
+
+    def get_orders(self, session: Session, order_ids: List[str]) -> List[Order]:
+        return session.query(Order).filter(Order.id.in_(order_ids)).all()
+
+    def add_transaction(
+        self,
+        session: Session,
+        transaction: Transaction,
+        batcher_id: int,
+        orders: List[Order],
+    ):
+        round_profits(session, transaction)
+        self.transactions.append((transaction, batcher_id, orders))
+
+    def flush(self, session: Session):
+        for transaction, batcher_id, orders in self.transactions:
+            transaction.batcher_id = self.batcher_index.find(batcher_id)
+            transaction.orders = orders
+            session.add(transaction)
+        rollups.add_transactions(
+            session,
+            (
+                (t.batcher_id, t.slot, t.ada_profit + t.equivalent_ada)
+                for t, _, _ in self.transactions
+            ),
+        )
+        self.transactions.clear()
+        write_block_headers(session, self.headers)
+        self.headers.clear()
+        session.flush()
+        for slot, utxo_ids in self.spends.items():
+            session.execute(
+                sqla.update(UTxO)
+                .where(UTxO.id.in_(utxo_ids))
+                .values(spent_slot=slot)
+                .execution_options(synchronize_session=False)
+            )
+        self.spends.clear()
+
+
+class BulkWriter:
+    """
+    Collects the rows of a batch of blocks and writes them with Core statements,
+    bypassing the identity map and unit of work:
+
+    - outputs with COPY on Postgres and multi-row INSERTs otherwise
+    - all spend marks with a single UPDATE ... FROM (VALUES ...) on Postgres
+      and a bulk UPDATE by primary key otherwise
+    - transactions with a multi-row INSERT ... RETURNING, then the links
+      of their orders in the same way as the spend marks, and one upsert
+      of the rollups of their batchers
+
+    Rows are kept until the next flush, so pending outputs and orders
+    can be looked up before they are written.
+    """
+
+    def __init__(self, engine: sqla.Engine, batcher_index: BatcherIndex):
+        self.batcher_index = batcher_index
+        # COPY and UPDATE ... FROM (VALUES ...) AS v (columns) are Postgres only
+        self.is_postgres = engine.dialect.name == "postgresql"
+        self.utxos = {}  # id -> row
+        self.orders = {}  # id -> row
+        self.spends = {}  # id -> slot
+        self.transactions = []  # (Transaction, batcher id, order ids)
+        self.headers = []
+
+    def add_block(self, slot: int, block_hash: str, height: int):
+        self.headers.append({"slot": slot, "hash": block_hash, "height": height})
+
+    def add_outputs(self, session: Session, outputs: list):
+        for output in outputs:
+            if isinstance(output, Order):
+                self.orders[output.id] = {
+                    "id": output.id,
+                    "sender": output.sender,
+                    "recipient": output.recipient,
+                    "slot": output.slot,
+                    "transaction_id": None,
+                }
+            else:
+                self.utxos[output.id] = {
+                    "id": output.id,
+                    "owner": output.owner,
+                    "value": output.value,
+                    "created_slot": output.created_slot,
+                    "spent_slot": None,
+                    "block_hash": output.block_hash,
+                    "role": output.role,
+                }
+
+    def mark_spent(self, utxo_id: str, slot: int):
+        if utxo_id in self.utxos:
+            self.utxos[utxo_id]["spent_slot"] = slot
+        else:
+            self.spends[utxo_id] = slot
+
+    def get_utxo(self, utxo_id: str) -> UTxO:
+        row = self.utxos.get(utxo_id)
+        return UTxO(**row) if row is not None else None
+
+    def get_orders(self, session: Session, order_ids: List[str]) -> List[Order]:
+        orders = [Order(**self.orders[i]) for i in order_ids if i in self.orders]
+        for order in orders:
+            # copies of pending rows, which a flush before a merge may write meanwhile,
+            # are not transient like orders resolved from Blockfrost, see add_transaction
+            make_transient_to_detached(order)
+        stored_ids = [i for i in order_ids if i not in self.orders]
+        if stored_ids:
+            orders.extend(
+                session.query(Order).filter(Order.id.in_(stored_ids)).all()
+            )
+        return orders
+
+    def add_transaction(
+        self,
+        session: Session,
+        transaction: Transaction,
+        batcher_id: int,
+        orders: List[Order],
+    ):
+        for order in orders:
+            if order.id not in self.orders and sqla.inspect(order).transient:
+                # order resolved from Blockfrost, not stored yet
+                self.add_outputs(session, [order])
+        round_profits(session, transaction)
+        self.transactions.append((transaction, batcher_id, [o.id for o in orders]))
+
+    def _insert_utxos(self, session: Session):
+        rows = list(self.utxos.values())
+        if not rows:
+            return
+        if not self.is_postgres:
+            session.execute(sqla.insert(UTxO), rows)
+            return
+        cursor = session.connection().connection.cursor()
+        columns = ", ".join(UTXO_COLUMNS)
+        with cursor.copy(f'COPY "UTxO" ({columns}) FROM STDIN') as copy:
+            for row in rows:
+                copy.write_row(
+                    [
+                        orjson.dumps(row[c]).decode() if c == "value" else row[c]
+                        for c in UTXO_COLUMNS
+                    ]
+                )
+
+    def _insert_transactions(self, session: Session):
+        if not self.transactions:
+            return
+        rows = [
+            {
+                # the batcher may have been merged into another one since
+                "batcher_id": self.batcher_index.find(batcher_id),
+                "ada_profit": transaction.ada_profit,
+                "network_fee": transaction.network_fee,
+                "equivalent_ada": transaction.equivalent_ada,
+                "net_assets": transaction.net_assets,
+                "slot": transaction.slot,
+                "tx_hash": transaction.tx_hash,
+            }
+            for transaction, batcher_id, _ in self.transactions
+        ]
+        transaction_ids = session.scalars(
+            sqla.insert(Transaction).returning(
+                Transaction.id, sort_by_parameter_order=True
+            ),
+            rows,
+        ).all()
+        rollups.add_transactions(
+            session,
+            (
+                (row["batcher_id"], row["slot"], row["ada_profit"] + row["equivalent_ada"])
+                for row in rows
+            ),
+        )
+
+        links = []
+        for transaction_id, (_, _, order_ids) in zip(
+            transaction_ids, self.transactions
+        ):
+            for order_id in order_ids:
+                if order_id in self.orders:
+                    self.orders[order_id]["transaction_id"] = transaction_id
+                else:
+                    links.append((order_id, transaction_id))
+        if links:
+            self._update_by_id(session, Order, "transaction_id", Integer, links)
+
+    def _update_by_id(self, session: Session, model, column: str, type_, rows: list):
+        update_by_id(session, model, column, type_, rows, self.is_postgres)
+
+    def flush(self, session: Session):
+        write_block_headers(session, self.headers)
+        self._insert_utxos(session)
+        self._insert_transactions(session)
+        if self.orders:
+            session.execute(sqla.insert(Order), list(self.orders.values()))
+        if self.spends:
+            self._update_by_id(
+                session, UTxO, "spent_slot", BigInteger, list(self.spends.items())
+            )
+
+        self.utxos.clear()
+        self.orders.clear()
+        self.spends.clear()
+        self.transactions.clear()
+        self.headers.clear()
+
+
+def make_writer(name: str, engine: sqla.Engine, batcher_index: BatcherIndex):
+    if name == "bulk":
+        return BulkWriter(engine, batcher_index)
+    if name == "orm":
+        return OrmWriter(batcher_index)
+    raise ValueError(f"Unknown write path: {name}")
@@ -1,8 +1,17 @@
+from typing import List, Optional, Tuple
+
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
+from sqlalchemy import and_, func, or_, select, tuple_
 import ipdb
 
-from common.db import Batcher, BatcherAddress, Transaction
+from common.db import (
+    ROLLUP_DAY,
+    ROLLUP_HOUR,
+    Batcher,
+    BatcherAddress,
+    BatcherRollup,
+    Transaction,
+)
 
 
 def get_batchers(session: Session):
@@ -27,54 +36,106 @@ def get_batchers(session: Session):
     return result
 
 
-def batcher_stats(session: Session, address: str):
-    result = (
-        session.query(
-            func.max(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.min(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.avg(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.sum(Transaction.ada_profit + Transaction.equivalent_ada),
+def _rollup_window(from_time: Optional[int], to_time: Optional[int]):
+    """
+    Condition on BatcherRollup selecting the fewest buckets that cover the hours from
+    the one containing `from_time` to the one containing `to_time`: whole days inside
+    the window and hours at its edges.
+    """
+    if from_time is None and to_time is None:
+        return BatcherRollup.period == ROLLUP_DAY
+    hour_start = from_time - from_time % ROLLUP_HOUR if from_time is not None else None
+    hour_end = to_time - to_time % ROLLUP_HOUR + ROLLUP_HOUR if to_time is not None else None
+    day_start = -(-hour_start // ROLLUP_DAY) * ROLLUP_DAY if hour_start is not None else None
+    day_end = hour_end - hour_end % ROLLUP_DAY if hour_end is not None else None
+    if day_start is not None and day_end is not None and day_start >= day_end:
+        # no whole day in the window
+        return and_(
+            BatcherRollup.period == ROLLUP_HOUR,
+            BatcherRollup.bucket_start >= hour_start,
+            BatcherRollup.bucket_start < hour_end,
+        )
+
+    days = [BatcherRollup.period == ROLLUP_DAY]
+    hours = []
+    if day_start is not None:
+        days.append(BatcherRollup.bucket_start >= day_start)
+        hours.append(
+            and_(
+                BatcherRollup.period == ROLLUP_HOUR,
+                BatcherRollup.bucket_start >= hour_start,
+                BatcherRollup.bucket_start < day_start,
+            )
         )
-        .join(Batcher, Batcher.id == Transaction.batcher_id)
-        .join(BatcherAddress, BatcherAddress.batcher_id == Batcher.id)
-        .filter(BatcherAddress.address == address)
+    if day_end is not None:
+        days.append(BatcherRollup.bucket_start < day_end)
+        hours.append(
+            and_(
+                BatcherRollup.period == ROLLUP_HOUR,
+                BatcherRollup.bucket_start >= day_end,
+                BatcherRollup.bucket_start < hour_end,
+            )
+        )
+    return or_(and_(*days), *hours)
+
+
+# Profit statistics are read from the hourly and daily rollups of the querier,
+# so they cost O(buckets) instead of O(transactions)
+_ROLLUP_AGGREGATES = (
+    func.max(BatcherRollup.max),
+    func.min(BatcherRollup.min),
+    func.sum(BatcherRollup.sum),
+    func.sum(BatcherRollup.count),
+)
+
+
+def batcher_stats(
+    session: Session,
+    address: str,
+    from_time: Optional[int] = None,
+    to_time: Optional[int] = None,
+):
+    batcher_id = session.scalar(
+        select(BatcherAddress.batcher_id).where(BatcherAddress.address == address)
     )
+    if batcher_id is None:
+        return None
 
-    max_profit, min_profit, avg_profit, total = result.first()
+    max_profit, min_profit, total, count = session.execute(
+        select(*_ROLLUP_AGGREGATES).where(
+            BatcherRollup.batcher_id == batcher_id, _rollup_window(from_time, to_time)
+        )
+    ).one()
 
-    if max_profit is None:
+    if not count:
         return None
 
     return {
         "max_profit": max_profit,
         "min_profit": min_profit,
-        "avg_profit": avg_profit,
+        "avg_profit": total / count,
         "total": total,
     }
 
 
-def all_batcher_stats(session: Session):
+def all_batcher_stats(
+    session: Session, from_time: Optional[int] = None, to_time: Optional[int] = None
+):
     result = (
-        session.query(
-            func.max(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.min(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.avg(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.sum(Transaction.ada_profit + Transaction.equivalent_ada),
-            func.count(Transaction.id),
-            Batcher,
-        )
-        .join(Batcher, Batcher.id == Transaction.batcher_id)
+        session.query(*_ROLLUP_AGGREGATES, Batcher)
+        .join(Batcher, Batcher.id == BatcherRollup.batcher_id)
+        .filter(_rollup_window(from_time, to_time))
         .options(joinedload(Batcher.addresses))
         .group_by(Batcher.id)
     )
 
     response = []
-    for max_profit, min_profit, avg_profit, total, num_transactions, batcher in result:
+    for max_profit, min_profit, total, num_transactions, batcher in result:
         response.append(
             {
                 "max_profit": max_profit,
                 "min_profit": min_profit,
-                "avg_profit": avg_profit,
+                "avg_profit": total / num_transactions,
                 "total": total,
                 "num_transactions": num_transactions,
                 "addresses": [address.address for address in batcher.addresses],
@@ -83,24 +144,62 @@ def all_batcher_stats(session: Session):
     return response
 
 
+# rows fetched per round trip when streaming transactions
+TRANSACTIONS_YIELD_PER = 500
+
+
 # List of transactions per batcher
-def batcher_transactions(session: Session, address: str):
-    batcher = (
-        session.query(Batcher)
-        .options(joinedload(Batcher.transactions))  # Eager load transactions
-        .filter(Batcher.addresses.any(address=address))
-        .first()
+def batcher_transactions(
+    session: Session,
+    address: str,
+    from_slot: Optional[int] = None,
+    to_slot: Optional[int] = None,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[int, int]] = None,
+) -> Optional[Tuple[List[dict], Optional[Tuple[int, int]]]]:
+    """
+    One page of the transactions of the batcher owning `address` in (slot, id) order,
+    starting after the keyset cursor `after`, and the cursor of the next page.
+    Without a limit, all transactions after the cursor are returned as one page.
+    Returns None if the address belongs to no batcher.
+    """
+    batcher_id = session.scalar(
+        select(BatcherAddress.batcher_id).where(BatcherAddress.address == address)
     )
+    if batcher_id is None:
+        return None
+
+    query = select(
+        Transaction.id,
+        Transaction.slot,
+        Transaction.tx_hash,
+        Transaction.ada_profit,
+        Transaction.equivalent_ada,
+        Transaction.net_assets,
+    ).where(Transaction.batcher_id == batcher_id)
+    if from_slot is not None:
+        query = query.where(Transaction.slot >= from_slot)
+    if to_slot is not None:
+        query = query.where(Transaction.slot <= to_slot)
+    if after is not None:
+        query = query.where(tuple_(Transaction.slot, Transaction.id) > tuple_(*after))
+    query = query.order_by(Transaction.slot, Transaction.id)
+    if limit is not None:
+        query = query.limit(limit)
 
     result = []
-    for transaction in batcher.transactions:
+    last = None
+    # plain rows streamed from a server-side cursor, no ORM objects
+    for row in session.execute(query.execution_options(yield_per=TRANSACTIONS_YIELD_PER)):
         result.append(
             {
-                "tx_hash": transaction.tx_hash,
-                "ada_profit": transaction.ada_profit,
-                "non_ada_profit": transaction.equivalent_ada,
-                "other_assets": transaction.net_assets,
+                "tx_hash": row.tx_hash,
+                "slot": row.slot,
+                "ada_profit": row.ada_profit,
+                "non_ada_profit": row.equivalent_ada,
+                "other_assets": row.net_assets,
             }
         )
+        last = (row.slot, row.id)
 
-    return result
+    return result, last if limit is not None and len(result) == limit else None
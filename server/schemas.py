@@ -21,6 +21,7 @@ class ExpandedBatcherStatsResponse(BatcherStatsResponse):
 
 class TransactionResponse(BaseModel):
     tx_hash: str
+    slot: int
     ada_profit: int
     non_ada_profit: float
     other_assets: dict
@@ -1,10 +1,10 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Response
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
 from fastapi_cache.decorator import cache
 from sqlalchemy.orm import sessionmaker, Session
 from contextlib import asynccontextmanager
-from typing import List
+from typing import List, Optional
 
 from . import crud
 from common.db import Batcher, _ENGINE
@@ -30,6 +30,8 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(lifespan=lifespan)
 
+_WINDOW_DESCRIPTION = "Unix timestamp, the window is extended to whole hours"
+
 
 @app.get("/", response_model=dict)
 async def root():
@@ -44,8 +46,13 @@ async def batchers(session: Session = Depends(get_session)):
 
 @cache(expire=60)
 @app.get("/stats", response_model=BatcherStatsResponse)
-async def batcher_stats(address: str, session: Session = Depends(get_session)):
-    response = crud.batcher_stats(session, address)
+async def batcher_stats(
+    address: str,
+    from_time: Optional[int] = Query(None, description=_WINDOW_DESCRIPTION),
+    to_time: Optional[int] = Query(None, description=_WINDOW_DESCRIPTION),
+    session: Session = Depends(get_session),
+):
+    response = crud.batcher_stats(session, address, from_time, to_time)
     if response is None:
         raise HTTPException(status_code=404, detail="Batcher not found")
     return response
@@ -53,14 +60,40 @@ async def batcher_stats(address: str, session: Session = Depends(get_session)):
 
 @cache(expire=60)
 @app.get("/all-stats", response_model=List[ExpandedBatcherStatsResponse])
-async def all_batcher_stats(session: Session = Depends(get_session)):
-    return crud.all_batcher_stats(session)
+async def all_batcher_stats(
+    from_time: Optional[int] = Query(None, description=_WINDOW_DESCRIPTION),
+    to_time: Optional[int] = Query(None, description=_WINDOW_DESCRIPTION),
+    session: Session = Depends(get_session),
+):
+    return crud.all_batcher_stats(session, from_time, to_time)
 
 
 @cache(expire=60)
 @app.get("/transactions", response_model=List[TransactionResponse])
-async def batcher_transactions(address: str, session: Session = Depends(get_session)):
-    response = crud.batcher_transactions(session, address)
-    if not response:
+async def batcher_transactions(
+    address: str,
+    response: Response,
+    from_slot: Optional[int] = None,
+    to_slot: Optional[int] = None,
+    limit: Optional[int] = Query(
+        None, ge=1, le=1000, description="Page size, all transactions if omitted"
+    ),
+    cursor: Optional[str] = Query(
+        None, description="X-Next-Cursor header of the previous page"
+    ),
+    session: Session = Depends(get_session),
+):
+    after = None
+    if cursor is not None:
+        try:
+            slot, transaction_id = cursor.split(".")
+            after = (int(slot), int(transaction_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    page = crud.batcher_transactions(session, address, from_slot, to_slot, limit, after)
+    if page is None:
         raise HTTPException(status_code=404, detail="Batcher not found")
-    return response
+    transactions, next_cursor = page
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = f"{next_cursor[0]}.{next_cursor[1]}"
+    return transactions
@@ -0,0 +1,352 @@
+"""
+Microbenchmarks of the per-transaction hot paths of the querier, on generated
+fixtures, without a node or database.
+
+    python -m test.bench                           # writes bench_results/<commit>.json
+    python -m test.bench --compare bench_results/<other commit>.json
+    python -m test.bench --filter analytics
+
+Fixtures are generated from a fixed seed, so results of different commits on the
+same machine are comparable. --compare exits with status 1 if a benchmark got
+slower than --threshold times its previous time.
+"""
+
+import argparse
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+from typing import Callable, Dict, List
+
+import cbor2
+import orjson
+from cbor2 import CBORTag
+
+# the benchmarks never query the database, importing common.db must not create one
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+from common.cardano_utils import bech32_encode, datum_from_cborhex
+from common.classes import ShelleyAddress, Token
+from common.db import Order, UTxO
+from common.util import parse_assets_to_list
+from querier import util
+from querier.batchers import BatcherIndex
+from querier.config import MUESLI_ADDR_TO_VERSION
+from querier.prices import StubPriceProvider
+
+_SEED = 42
+_RESULTS_DIR = "bench_results"
+# versions whose orders carry a datum, v1 orders are reconstructed from metadata
+_DATUM_VERSIONS = ["v2", "v3", "v4", "v1_lq", "v2_lq", "clp_lq"]
+_ORDERS_PER_BATCH = [1, 10, 50]
+
+
+########################################################################################
+#                                     Fixtures                                         #
+########################################################################################
+
+
+class Fixtures:
+    """
+    Realistic inputs: multi-asset values, order datums of every version and batch
+    transactions with 1-50 orders.
+    """
+
+    def __init__(self, seed: int = _SEED):
+        self.rnd = random.Random(seed)
+        self.policies = [self.hex(28) for _ in range(200)]
+        self.tokens = [
+            Token(self.rnd.choice(self.policies), self.hex(self.rnd.randint(0, 16)))
+            for _ in range(500)
+        ]
+        self.version_address = {v: a for a, v in MUESLI_ADDR_TO_VERSION.items()}
+        self.batcher = self.wallet()
+
+    def hex(self, num_bytes: int) -> str:
+        return (
+            self.rnd.getrandbits(8 * num_bytes).to_bytes(num_bytes, "big").hex()
+            if num_bytes
+            else ""
+        )
+
+    def key_hashes(self, stake: bool = True):
+        return self.hex(28), self.hex(28) if stake else ""
+
+    def wallet(self, stake: bool = True) -> ShelleyAddress:
+        pkh, skh = self.key_hashes(stake)
+        return ShelleyAddress(mainnet=True, pubkeyhash=pkh, stakekeyhash=skh)
+
+    def value(self, num_tokens: int) -> dict:
+        value = {"ada": {"lovelace": self.rnd.randint(1_000_000, 1_000_000_000)}}
+        for token in self.rnd.sample(self.tokens, num_tokens):
+            value.setdefault(token.policy_id, {})[token.name] = self.rnd.randint(
+                1, 10**12
+            )
+        return value
+
+    @staticmethod
+    def _address_datum(address: ShelleyAddress):
+        stake = (
+            CBORTag(
+                121,
+                [CBORTag(121, [CBORTag(121, [bytes.fromhex(address.stakekeyhash)])])],
+            )
+            if address.stakekeyhash
+            else CBORTag(122, [])
+        )
+        return CBORTag(121, [CBORTag(121, [bytes.fromhex(address.pubkeyhash)]), stake])
+
+    def datum(
+        self, version: str, sender: ShelleyAddress, recipient: ShelleyAddress
+    ) -> str:
+        token = self.rnd.choice(self.tokens)
+        if "lq" in version:
+            fields = [
+                self._address_datum(sender),
+                self._address_datum(recipient),
+                CBORTag(122, []),  # no receiver datum hash
+                CBORTag(
+                    121,
+                    [bytes.fromhex(token.policy_id), bytes.fromhex(token.name), 10**6],
+                ),
+                2_000_000,
+                2_000_000,
+            ]
+            return cbor2.dumps(CBORTag(121, fields)).hex()
+        fields = [
+            self._address_datum(sender),
+            bytes.fromhex(token.policy_id),
+            bytes.fromhex(token.name),
+            self.rnd.randint(1, 10**9),
+            CBORTag(122, []),  # allow partial: False
+            2_650_000,
+        ]
+        return cbor2.dumps(CBORTag(121, [CBORTag(121, fields)])).hex()
+
+    def order_output(self, version: str) -> dict:
+        user = self.wallet()
+        return {
+            "address": self.version_address[version],
+            "value": self.value(1),
+            "datum": self.datum(version, user, user),
+        }
+
+    def batch(self, num_orders: int) -> dict:
+        """
+        Inputs, outputs and orders of a batch transaction filling `num_orders` orders.
+        """
+        tx_id = self.hex(32)
+        orders = []
+        outputs = []
+        in_value = self.value(5)
+        for i in range(num_orders):
+            user = self.wallet()
+            hashes = user.pubkeyhash + user.stakekeyhash
+            orders.append(
+                Order(id=f"{self.hex(32)}#0", sender=hashes, recipient=hashes, slot=0)
+            )
+            outputs.append(
+                UTxO(
+                    id=f"{tx_id}#{i}",
+                    owner=user.bech32,
+                    value=self.value(2),
+                    created_slot=1,
+                    block_hash="",
+                )
+            )
+        inputs = [
+            UTxO(
+                id=f"{self.hex(32)}#1",
+                owner=self.batcher.bech32,
+                value=in_value,
+                created_slot=0,
+                block_hash="",
+            )
+        ]
+        outputs.append(
+            UTxO(
+                id=f"{tx_id}#{num_orders}",
+                owner=self.batcher.bech32,
+                value=self.value(6),
+                created_slot=1,
+                block_hash="",
+            )
+        )
+        return {"inputs": inputs, "outputs": outputs, "orders": orders}
+
+
+########################################################################################
+#                                    Benchmarks                                        #
+########################################################################################
+
+
+def _benchmarks(fx: Fixtures) -> Dict[str, Callable[[], object]]:
+    """
+    Name -> zero-argument callable, one call is one measured operation.
+    """
+    benchmarks = {}
+
+    for version in _DATUM_VERSIONS:
+        output = fx.order_output(version)
+        tx = {"id": fx.hex(32), "datums": {}}
+        benchmarks[f"datum_from_cborhex[{version}]"] = lambda datum=output[
+            "datum"
+        ]: datum_from_cborhex(datum)
+        benchmarks[f"parse_output[order {version}]"] = (
+            lambda tx=tx, output=output: util.parse_output(
+                tx, output, f"{tx['id']}#0", 1, ""
+            )
+        )
+    for num_tokens in (0, 5, 20):
+        output = {"address": fx.wallet().bech32, "value": fx.value(num_tokens)}
+        benchmarks[f"parse_output[utxo {num_tokens} tokens]"] = (
+            lambda output=output: util.parse_output({"id": ""}, output, "x#0", 1, "")
+        )
+        benchmarks[f"parse_assets_to_list[{num_tokens} tokens]"] = lambda value=output[
+            "value"
+        ]: parse_assets_to_list(value)
+
+    batches = {n: fx.batch(n) for n in _ORDERS_PER_BATCH}
+    mixed_outputs = batches[50]["outputs"] + batches[50]["orders"]
+    fx.rnd.shuffle(mixed_outputs)
+    benchmarks["filter_utxos[101 outputs]"] = lambda: util.filter_utxos(mixed_outputs)
+
+    price_provider = StubPriceProvider(default=0.5)
+    batcher_index = BatcherIndex()
+    batcher_index._add_address(fx.batcher.bech32, 1)
+    for num_orders, batch in batches.items():
+        benchmarks[f"calculate_analytics[{num_orders} orders]"] = (
+            lambda batch=batch: util.calculate_analytics(
+                inputs=batch["inputs"],
+                outputs=batch["outputs"],
+                orders=batch["orders"],
+                session=None,
+                price_provider=price_provider,
+                batcher_index=batcher_index,
+            )
+        )
+
+    addresses = [fx.wallet(stake=i % 4 != 0) for i in range(1000)]
+    hex_addresses = [a.hex for a in addresses]
+    uncached = iter(range(10**12))
+    benchmarks["bech32_encode[cached]"] = lambda h=hex_addresses[0]: bech32_encode(h)
+    benchmarks["bech32_encode[uncached]"] = lambda: bech32_encode.__wrapped__(
+        hex_addresses[next(uncached) % 1000]
+    )
+    benchmarks["ShelleyAddress.from_hex[base]"] = lambda h=hex_addresses[
+        1
+    ]: ShelleyAddress.from_hex(h)
+    benchmarks["ShelleyAddress.from_hex[enterprise]"] = lambda h=hex_addresses[
+        0
+    ]: ShelleyAddress.from_hex(h)
+
+    token = fx.tokens[0]
+    same = Token(token.policy_id, token.name)
+    other = fx.tokens[1]
+    amounts = {t: 1 for t in fx.tokens[:50]}
+    benchmarks["Token.__hash__"] = lambda: hash(token)
+    benchmarks["Token.__eq__[equal]"] = lambda: token == same
+    benchmarks["Token.__eq__[different]"] = lambda: token == other
+    benchmarks["Token dict lookup[50 tokens]"] = lambda: same in amounts
+    benchmarks["Token sort[500 tokens]"] = lambda: sorted(fx.tokens)
+    return benchmarks
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+    """
+    Best of `repeat` runs of as many calls as fit into about 0.2 seconds.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = timer.repeat(repeat=repeat, number=number)
+    return {
+        "us_per_call": round(min(times) / number * 1e6, 4),
+        "calls": number,
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(name_filter: str = None, repeat: int = 5) -> dict:
+    benchmarks = _benchmarks(Fixtures())
+    results = {}
+    for name, fn in benchmarks.items():
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(fn, repeat)
+        print(f"{name:45} {results[name]['us_per_call']:12.3f} us")
+    return {
+        "commit": _commit(),
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Prints the speedup of each benchmark, returns the names of the regressions.
+    """
+    regressions = []
+    print(f"\n{baseline['commit']} -> {current['commit']}")
+    for name, result in current["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        ratio = result["us_per_call"] / previous["us_per_call"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:45} {previous['us_per_call']:10.3f} -> {result['us_per_call']:10.3f} us ({1 / ratio:5.2f}x){flag}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(
+        description="Microbenchmarks of the querier hot paths"
+    )
+    argp.add_argument("--filter", help="Only run benchmarks whose name contains this")
+    argp.add_argument("--repeat", type=int, default=5)
+    argp.add_argument(
+        "--output", help=f"Results file, default {_RESULTS_DIR}/<commit>.json"
+    )
+    argp.add_argument(
+        "--compare", help="Results file of an earlier run to compare with"
+    )
+    argp.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Slowdown factor reported as a regression",
+    )
+    args = argp.parse_args()
+
+    current = run(args.filter, args.repeat)
+    output = args.output or os.path.join(_RESULTS_DIR, f"{current['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "wb") as f:
+        f.write(orjson.dumps(current, option=orjson.OPT_INDENT_2))
+    print(f"\nWrote {output}")
+    if args.compare:
+        with open(args.compare, "rb") as f:
+            baseline = orjson.loads(f.read())
+        if compare(current, baseline, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,288 @@
+"""
+Synthetic chains for the tests: users place v2 orders and batchers fill them,
+with random profits, in blocks as the chain sync delivers them.
+"""
+
+import copy
+import hashlib
+import random
+from collections import defaultdict
+from typing import List
+
+import cbor2
+from cbor2 import CBORTag
+
+from common.classes import ShelleyAddress
+from querier.chainsync import BlockView
+from querier.config import MUESLI_ADDR_TO_VERSION
+
+ORDER_ADDRESS = next(a for a, v in MUESLI_ADDR_TO_VERSION.items() if v == "v2")
+TOKEN = hashlib.blake2b(b"policy", digest_size=28).hexdigest()
+
+
+def _hash(*parts, size: int = 32) -> str:
+    return hashlib.blake2b(repr(parts).encode(), digest_size=size).hexdigest()
+
+
+def _wallet(*parts) -> ShelleyAddress:
+    return ShelleyAddress(
+        mainnet=True,
+        pubkeyhash=_hash("pkh", *parts, size=28),
+        stakekeyhash=_hash("skh", *parts, size=28),
+    )
+
+
+def _v2_datum(user: ShelleyAddress) -> str:
+    address = CBORTag(
+        121,
+        [
+            CBORTag(121, [bytes.fromhex(user.pubkeyhash)]),
+            CBORTag(121, [CBORTag(121, [CBORTag(121, [bytes.fromhex(user.stakekeyhash)])])]),
+        ],
+    )
+    fields = [address, b"", b"", 10, 2_000_000, CBORTag(122, [])]
+    return cbor2.dumps(CBORTag(121, [CBORTag(121, fields)])).hex()
+
+
+def _value(lovelace: int, tokens: int = 0) -> dict:
+    value = {"ada": {"lovelace": lovelace}}
+    if tokens:
+        value[TOKEN] = {"4d": tokens}
+    return value
+
+
+def _input(utxo_id: str) -> dict:
+    tx_id, index = utxo_id.split("#")
+    return {"transaction": {"id": tx_id}, "index": int(index)}
+
+
+class Chain:
+    """
+    Builds blocks one by one. `fork` copies the builder, so that the copy continues
+    with other transactions from the same state.
+    """
+
+    def __init__(self, num_batchers: int = 3, seed: int = 1, slot: int = 125879200, step: int = 20):
+        self.rnd = random.Random(seed)
+        self.slot = slot
+        self.step = step
+        self.height = 1000
+        self.branch = ""
+        self.num_txs = 0
+        self.users = [_wallet("user", i) for i in range(5)]
+        self.batchers = [_wallet("batcher", i) for i in range(num_batchers)]
+        self.batcher_utxos = [None] * num_batchers
+        self.open_orders = []  # (order output id, user)
+
+    @property
+    def batcher_addresses(self) -> List[str]:
+        return [b.bech32 for b in self.batchers]
+
+    def fork(self, branch: str) -> "Chain":
+        chain = copy.deepcopy(self)
+        chain.branch = branch
+        return chain
+
+    def _tx_id(self) -> str:
+        self.num_txs += 1
+        return _hash("tx", self.branch, self.num_txs)
+
+    def block(self, transactions: List[dict]) -> BlockView:
+        self.slot += self.step
+        self.height += 1
+        return BlockView(
+            {
+                "id": _hash("block", self.branch, self.slot),
+                "slot": self.slot,
+                "height": self.height,
+                "size": {"bytes": 1000},
+                "transactions": transactions,
+            }
+        )
+
+    def fund_batchers(self) -> dict:
+        tx_id = self._tx_id()
+        for i in range(len(self.batchers)):
+            self.batcher_utxos[i] = f"{tx_id}#{i}"
+        return {
+            "id": tx_id,
+            "inputs": [_input(f"{_hash('genesis')}#0")],
+            "outputs": [
+                {"address": b.bech32, "value": _value(100_000_000)} for b in self.batchers
+            ],
+            "fee": {"ada": {"lovelace": 170000}},
+            "datums": {},
+        }
+
+    def place_order(self) -> dict:
+        tx_id = self._tx_id()
+        user = self.rnd.choice(self.users)
+        self.open_orders.append((f"{tx_id}#0", user))
+        return {
+            "id": tx_id,
+            "inputs": [_input(f"{_hash('wallet', tx_id)}#1")],
+            "outputs": [
+                {
+                    "address": ORDER_ADDRESS,
+                    "value": _value(self.rnd.randint(3, 9) * 1_000_000),
+                    "datum": _v2_datum(user),
+                }
+            ],
+            "fee": {"ada": {"lovelace": 170000}},
+            "datums": {},
+        }
+
+    def fill_order(self, batchers: List[int] = None) -> dict:
+        """
+        The oldest open order, filled by the given batchers (a random one by default).
+        """
+        if batchers is None:
+            batchers = [self.rnd.randrange(len(self.batchers))]
+        order_id, user = self.open_orders.pop(0)
+        tx_id = self._tx_id()
+        inputs = [_input(order_id)]
+        outputs = [{"address": user.bech32, "value": _value(2_000_000, 10)}]
+        for n, i in enumerate(batchers):
+            inputs.append(_input(self.batcher_utxos[i]))
+            outputs.append(
+                {
+                    "address": self.batchers[i].bech32,
+                    "value": _value(
+                        100_000_000 + self.rnd.randint(-3_000_000, 3_000_000),
+                        self.rnd.randint(0, 9),
+                    ),
+                }
+            )
+            self.batcher_utxos[i] = f"{tx_id}#{n + 1}"
+        return {
+            "id": tx_id,
+            "inputs": inputs,
+            "outputs": outputs,
+            "fee": {"ada": {"lovelace": 300000}},
+            "datums": {},
+        }
+
+    def transfer(self, spend: str = None) -> dict:
+        """
+        A transaction unrelated to orders and batchers, spending the given output
+        (an unknown one by default).
+        """
+        tx_id = self._tx_id()
+        return {
+            "id": tx_id,
+            "inputs": [_input(spend or f"{_hash('wallet', tx_id)}#0")],
+            "outputs": [{"address": _wallet("other", tx_id).bech32, "value": _value(1_500_000)}],
+            "fee": {"ada": {"lovelace": 170000}},
+            "datums": {},
+        }
+
+    def blocks(self, n: int, merge_at: int = None) -> List[BlockView]:
+        """
+        n blocks with an order, a fill of an older order and a transfer each,
+        batchers 1 and 2 fill together in the block `merge_at` (counted from 0).
+        """
+        blocks = []
+        for i in range(n):
+            transactions = [self.place_order(), self.transfer()]
+            if len(self.open_orders) > 1:
+                transactions.append(self.fill_order([1, 2] if i == merge_at else None))
+            blocks.append(self.block(transactions))
+        return blocks
+
+
+class ListIterator:
+    """
+    Hands a list of blocks and rollbacks to BlockParser.run.
+    """
+
+    def __init__(self, items: list):
+        self.items = items
+        self.should_exit = False
+
+    def iterate_blocks(self, timeout=None):
+        yield from self.items
+
+    def stats(self) -> dict:
+        return {}
+
+
+def make_parser(iterator, write_path: str = "bulk", **kwargs):
+    """
+    A BlockParser on the test database with fixed prices, inline datum decoding and
+    a fallback that never calls Blockfrost.
+    """
+    from querier.block_parser import BlockParser
+    from querier.decode import DatumDecoder
+    from querier.fallback import FakeBlockfrostBackend, FallbackResolver
+    from querier.prices import StubPriceProvider
+
+    kwargs.setdefault("price_provider", StubPriceProvider(default=0.5))
+    kwargs.setdefault("datum_decoder", DatumDecoder(workers=0))
+    if "fallback" not in kwargs:
+        kwargs["fallback"] = FallbackResolver(backend=FakeBlockfrostBackend())
+    return BlockParser(iterator=iterator, write_path=write_path, **kwargs)
+
+
+def process(parser, blocks: list):
+    """
+    Processes and commits the blocks one by one, without BlockParser.run.
+    """
+    from sqlalchemy import orm
+
+    for block in blocks:
+        session = orm.Session(parser.engine)
+        parser.process_block(block, session)
+        parser.commit(session)
+
+
+def empty_database(engine):
+    """
+    Deletes all rows, as the db fixture does after each test.
+    """
+    from common.db import Base
+
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+
+
+def database_state(engine, parser=None) -> dict:
+    """
+    Database and in-memory state (if a parser is given), with batchers identified
+    by their addresses since ids are not reused.
+    """
+    import sqlalchemy as sqla
+    from sqlalchemy import orm
+
+    from common.db import Batcher, BatcherAddress, BatcherRollup, Order, Transaction, UTxO
+
+    with orm.Session(engine) as session:
+        members = defaultdict(set)
+        for address, batcher_id in session.execute(
+            sqla.select(BatcherAddress.address, BatcherAddress.batcher_id)
+        ).all():
+            members[batcher_id].add(address)
+        batcher = {batcher_id: tuple(sorted(addresses)) for batcher_id, addresses in members.items()}
+        assert set(session.scalars(sqla.select(Batcher.id))) == set(batcher)
+        state = {
+            "transactions": sorted(
+                (t.tx_hash, batcher[t.batcher_id], t.ada_profit, t.equivalent_ada)
+                for t in session.scalars(sqla.select(Transaction))
+            ),
+            "utxos": sorted(session.execute(sqla.select(UTxO.id, UTxO.spent_slot)).all()),
+            "orders": sorted(
+                session.execute(
+                    sqla.select(Order.id, Transaction.tx_hash).outerjoin(Order.transaction)
+                ).all()
+            ),
+            "rollups": sorted(
+                (batcher[r.batcher_id], r.period, r.bucket_start, r.count, r.sum, r.min, r.max)
+                for r in session.scalars(sqla.select(BatcherRollup))
+            ),
+        }
+        if parser is not None:
+            state["open_orders"] = sorted(parser.open_orders)
+            state["index"] = {
+                a: batcher[parser.batcher_index.batcher_of(a)] for a in parser.batcher_index
+            }
+        return state
@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+import pytest
+
+# a fresh database file, created when common.db is first imported
+_DB_DIR = tempfile.mkdtemp(prefix="batcher-monitoring-test-")
+os.environ.setdefault("DATABASE_URI", f"sqlite+pysqlite:///{_DB_DIR}/test.sqlite")
+os.environ.setdefault("SNAPSHOT_PATH", "")
+os.environ.setdefault("FALLBACK_CACHE_PATH", f"{_DB_DIR}/fallback.sqlite")
+os.environ.setdefault("PRICE_BACKEND", "stub")
+
+
+@pytest.fixture
+def db():
+    """
+    The test database, emptied after the test.
+    """
+    import common.db
+    from test.chain import empty_database
+
+    yield common.db._ENGINE
+    empty_database(common.db._ENGINE)
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from querier.aio import AsyncRuntime
+from test.chain import Chain, ListIterator, database_state, empty_database, make_parser
+
+
+class _Client:
+    """
+    Chain sync client streaming the given blocks.
+    """
+
+    def __init__(self, items: list):
+        self.items = items
+
+    async def iterate_blocks(self, start_slot_no: int, start_block_hash: str):
+        for item in self.items:
+            await asyncio.sleep(0)
+            yield item
+
+    def stats(self) -> dict:
+        return {}
+
+
+async def _run_with_heartbeat(runtime: AsyncRuntime) -> float:
+    """
+    Runs the runtime and returns the longest time the event loop was blocked.
+    """
+    gaps = []
+
+    async def heartbeat():
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(0.005)
+            now = time.monotonic()
+            gaps.append(now - last)
+            last = now
+
+    task = asyncio.create_task(heartbeat())
+    try:
+        await runtime.run(0, "start")
+    finally:
+        task.cancel()
+    return max(gaps)
+
+
+def test_the_parser_does_not_block_the_loop(db, monkeypatch):
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(10, merge_at=6)
+    parser = make_parser(ListIterator([]))
+    decode_block = parser.datum_decoder.decode_block
+
+    def slow_decode_block(block):
+        # like waiting for the decoder processes, a price or Blockfrost
+        time.sleep(0.05)
+        return decode_block(block)
+
+    monkeypatch.setattr(parser.datum_decoder, "decode_block", slow_decode_block)
+    runtime = AsyncRuntime(parser, _Client(blocks))
+    assert asyncio.run(_run_with_heartbeat(runtime)) < 0.04
+    assert runtime.parser_time >= 0.05 * len(blocks)
+    streamed = database_state(db, parser)
+
+    empty_database(db)
+    parser = make_parser(ListIterator(blocks))
+    parser.run()
+    assert streamed == database_state(db, parser)
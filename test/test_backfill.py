@@ -0,0 +1,123 @@
+import pytest
+
+from common.db import get_chain_cursor
+from querier import block_parser
+from querier.backfill import BackfillMerger, Chunk, ChunkFacts
+from querier.decode import DatumDecoder
+from querier.fallback import FakeBlockfrostBackend, FallbackResolver
+from querier.prices import StubPriceProvider
+from querier.resolver import StubResolver
+from test.chain import Chain, ListIterator, database_state, empty_database, make_parser
+
+
+def _blocks():
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers(), chain.place_order()])]
+    blocks += chain.blocks(16, merge_at=10)
+    blocks.append(chain.block([chain.transfer(spend=chain.batcher_utxos[0])]))
+    return blocks
+
+
+def _facts(directory, blocks: list, bounds: list) -> list:
+    """
+    The facts files of the chunks blocks[a:b] for (a, b) in bounds, as fetch_chunk
+    would store them.
+    """
+    directory.mkdir(exist_ok=True)
+    decoder = DatumDecoder(workers=0)
+    paths = []
+    for a, b in bounds:
+        start = blocks[a - 1] if a > 0 else None
+        chunk = Chunk(
+            start.slot if start else blocks[0].slot - 1,
+            start.id if start else "origin",
+            blocks[b - 1].slot,
+            blocks[b - 1].id,
+        )
+        facts = ChunkFacts(chunk.path(str(directory)))
+        facts.reset(chunk)
+        for block in blocks[a:b]:
+            facts.add_block(block, decoder)
+        facts.set_meta("complete", 1)
+        facts.commit()
+        facts.close()
+        paths.append(chunk.path(str(directory)))
+    return paths
+
+
+def _merge(db, paths: list, ingest_mode: str, backend: FakeBlockfrostBackend, cache_path: str):
+    merger = BackfillMerger(
+        paths,
+        engine=db,
+        ingest_mode=ingest_mode,
+        price_provider=StubPriceProvider(default=0.5),
+        fallback=FallbackResolver(backend=backend, cache_path=cache_path),
+    )
+    try:
+        merger.merge()
+    finally:
+        merger.close()
+    return merger
+
+
+def _stored(db) -> dict:
+    state = database_state(db)
+    cursor = get_chain_cursor()
+    state["cursor"] = (cursor.slot, cursor.hash, cursor.height)
+    return state
+
+
+@pytest.mark.parametrize("ingest_mode", ["full", "relevant"])
+def test_backfill_matches_the_parser(db, tmp_path, monkeypatch, ingest_mode):
+    monkeypatch.setattr(block_parser, "INGEST_MODE", ingest_mode)
+    blocks = _blocks()
+    # the merge falls into the third chunk, the last block spends a batcher output
+    paths = _facts(tmp_path, blocks, [(0, 5), (5, 9), (9, 14), (14, len(blocks))])
+    backend = FakeBlockfrostBackend()
+    cache_path = str(tmp_path / "fallback.sqlite")
+    merger = _merge(db, paths, ingest_mode, backend, cache_path)
+    assert merger.batcher_index.merges == 1
+    assert backend.calls == 0
+    backfilled = _stored(db)
+
+    # merging again changes nothing
+    _merge(db, paths, ingest_mode, backend, cache_path)
+    assert _stored(db) == backfilled
+
+    empty_database(db)
+    # in "relevant" mode the parser resolves the inputs it did not store, the
+    # backfill finds them in the facts
+    resolver = StubResolver()
+    for block in blocks:
+        for tx in block.transactions:
+            for i, output in enumerate(tx["outputs"]):
+                resolver.add(f"{tx['id']}#{i}", output["address"], output["value"])
+    parser = make_parser(ListIterator(blocks), input_resolver=resolver)
+    parser.run()
+    parsed = _stored(db)
+    if ingest_mode == "relevant":
+        # the backfill also keeps the outputs sent to batchers before they were known
+        utxos = set(backfilled.pop("utxos"))
+        assert set(parsed.pop("utxos")) < utxos
+    assert backfilled == parsed
+
+
+def test_overlapping_chunks_after_the_cursor(db, tmp_path):
+    blocks = _blocks()
+    backend = FakeBlockfrostBackend()
+    cache_path = str(tmp_path / "fallback.sqlite")
+    # the database already holds the first chunk, the next ones overlap it and each other
+    _merge(db, _facts(tmp_path / "a", blocks, [(0, 6)]), "full", backend, cache_path)
+    paths = _facts(tmp_path / "b", blocks, [(0, 8), (4, 12), (10, len(blocks))])
+    merger = _merge(db, paths, "full", backend, cache_path)
+    assert [after_slot for _, after_slot in merger.windows] == [
+        blocks[5].slot,
+        blocks[7].slot,
+        blocks[11].slot,
+    ]
+    backfilled = _stored(db)
+
+    empty_database(db)
+    parser = make_parser(ListIterator(blocks))
+    parser.run()
+    assert backfilled == _stored(db)
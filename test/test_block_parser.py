@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import event, orm, select
+
+from common.db import Transaction, UTxO, get_chain_cursor
+from querier import block_parser
+from querier.buffer import SynchronizedIterator
+from test.chain import Chain, ListIterator, make_parser, process
+
+
+def _wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_pending_blocks_are_committed_when_the_buffer_runs_dry(db, monkeypatch):
+    monkeypatch.setattr(block_parser, "GROUP_COMMIT_MS", 200)
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(3)
+    iterator = SynchronizedIterator()
+    parser = make_parser(iterator)
+    thread = threading.Thread(target=parser.run)
+    thread.start()
+    try:
+        for block in blocks:
+            iterator.submit_block(block)
+        # the blocks are old, so only the deadline commits them while no block arrives
+        assert _wait_for(
+            lambda: (cursor := get_chain_cursor()) is not None
+            and cursor.slot == blocks[-1].slot
+        )
+    finally:
+        iterator.should_exit = True
+        thread.join()
+
+
+def test_a_failing_block_is_not_committed(db, monkeypatch):
+    monkeypatch.setattr(block_parser, "GROUP_COMMIT_BLOCKS", 100)
+    monkeypatch.setattr(block_parser, "GROUP_COMMIT_MS", 60000)
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(5)
+    parser = make_parser(ListIterator(blocks))
+    decode_block = parser.datum_decoder.decode_block
+
+    def decode_or_fail(block):
+        if block.slot == blocks[4].slot:
+            raise ValueError("broken block")
+        return decode_block(block)
+
+    monkeypatch.setattr(parser.datum_decoder, "decode_block", decode_or_fail)
+    with pytest.raises(ValueError):
+        parser.run()
+    # the first block is committed on its own, the batch of the broken one is dropped
+    assert get_chain_cursor().slot == blocks[0].slot
+    with orm.Session(db) as session:
+        assert session.scalars(select(Transaction)).all() == []
+        assert session.scalar(select(UTxO.created_slot).order_by(UTxO.created_slot.desc())) == (
+            blocks[0].slot
+        )
+
+
+def test_plain_transactions_mark_spent_without_lookups(db):
+    chain = Chain()
+    funding = chain.fund_batchers()
+    parser = make_parser(ListIterator([]))
+    process(parser, [chain.block([funding])])
+    # evicted from the cache, only the bloom filter knows it
+    parser.utxo_cache.entries.clear()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db, "before_cursor_execute", record)
+    try:
+        spending = chain.block([chain.transfer(spend=f"{funding['id']}#0")])
+        process(parser, [spending])
+    finally:
+        event.remove(db, "before_cursor_execute", record)
+
+    assert not [s for s in statements if s.startswith("SELECT") and '"UTxO"' in s]
+    with orm.Session(db) as session:
+        assert session.get(UTxO, f"{funding['id']}#0").spent_slot == spending.slot
+        assert session.get(UTxO, f"{funding['id']}#1").spent_slot is None
+
+
+def test_orders_filled_in_the_block_that_places_them(db, monkeypatch):
+    monkeypatch.setattr(block_parser, "INGEST_MODE", "full")
+    chain = Chain()
+    parser = make_parser(ListIterator([]))
+    process(parser, [chain.block([chain.fund_batchers()])])
+    # the batcher is not known yet, only the order created before links the fill to it
+    placed = chain.place_order()
+    filled = chain.fill_order([0])
+    process(parser, [chain.block([placed, filled])])
+
+    assert parser.open_orders == {}
+    with orm.Session(db) as session:
+        transaction = session.scalars(select(Transaction)).one()
+        assert transaction.tx_hash == filled["id"]
+        assert transaction.batcher_id is not None
+
+
+def test_bloom_filter_grows_with_the_unspent_utxos(db, monkeypatch):
+    monkeypatch.setattr(block_parser, "UTXO_BLOOM_CAPACITY", 4)
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers(), chain.place_order()])] + chain.blocks(4)
+    parser = make_parser(ListIterator(blocks))
+    parser.run()
+    cache = parser.utxo_cache
+    assert cache.bloom.is_saturated
+
+    with orm.Session(db) as session:
+        cache.load(session)
+        unspent = session.scalars(select(UTxO.id).where(UTxO.spent_slot == None)).all()
+    # sized from the database, not reloaded again on the next housekeeping
+    assert len(unspent) > 4
+    assert cache.bloom.capacity == 2 * len(unspent) and cache.bloom_capacity == 4
+    assert not cache.bloom.is_saturated
+    assert all(utxo_id in cache.bloom for utxo_id in unspent)
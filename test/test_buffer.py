@@ -0,0 +1,48 @@
+import threading
+
+from querier.buffer import SynchronizedIterator
+
+
+class _Block:
+    def __init__(self, slot: int, size: int = 100):
+        self.slot = slot
+        self.size = {"bytes": size}
+        self.transactions = []
+
+
+def _produce(iterator: SynchronizedIterator, blocks: list):
+    for block in blocks:
+        if not iterator.submit_block(block):
+            return
+    iterator.should_exit = True
+
+
+def test_blocks_arrive_in_order():
+    iterator = SynchronizedIterator(max_blocks=10, max_bytes=10**6, batch_blocks=3)
+    blocks = [_Block(slot) for slot in range(500)]
+    producer = threading.Thread(target=_produce, args=(iterator, blocks))
+    producer.start()
+    received = [block.slot for block in iterator.iterate_blocks()]
+    producer.join()
+    # the consumer may stop as soon as the exit flag is set
+    assert received == list(range(len(received)))
+
+
+def test_drained_batch_counts_against_capacity():
+    iterator = SynchronizedIterator(max_blocks=10, max_bytes=650, batch_blocks=4)
+    blocks = [_Block(slot) for slot in range(300)]
+    producer = threading.Thread(target=_produce, args=(iterator, blocks))
+    producer.start()
+    peak_blocks = peak_bytes = 0
+    for _ in iterator.iterate_blocks():
+        with iterator.lock:
+            peak_blocks = max(peak_blocks, len(iterator.queue) + iterator.drained_blocks)
+            peak_bytes = max(peak_bytes, iterator.num_bytes + iterator.drained_bytes)
+    producer.join()
+    assert peak_blocks <= 6
+    assert peak_bytes <= 650
+
+
+def test_get_blocks_times_out_on_an_empty_buffer():
+    iterator = SynchronizedIterator()
+    assert iterator.get_blocks(timeout=0.01) == []
@@ -0,0 +1,85 @@
+import cbor2
+import pytest
+from cbor2 import CBORTag
+
+from common.cardano_utils import datum_from_cborhex
+from querier.datum import DatumMemo, extract_parties
+from querier.util import parse_order_datum
+
+SENDER = (
+    "a37f22772712606a0484f5c25f204aad5872aad821aa16a36a64cc5b"
+    "877966f8285fee31dd309ad0289511c0c0bf3147ca9325d14740c78f"
+)
+NO_STAKE = "2f44db199ff4e965702eb240551c0db23fdb0dec1f2527d2bca736bb"
+RECIPIENT = "3d623ea9c8cd545b5a76ab523967cd816b09ca08bc185d3d4adc7d81"
+
+# In the encoding of the chain: constructors as indefinite-length arrays.
+# Order: creator, buy policy, buy token name, buy amount, partial fills, lovelace attached
+ORDER = (
+    "d8799fd8799fd8799fd8799f581ca37f22772712606a0484f5c25f204aad5872aad821aa16a36a64cc5b"
+    "ffd8799fd8799fd8799f581c877966f8285fee31dd309ad0289511c0c0bf3147ca9325d14740c78fffff"
+    "ffff581c0c14d603cbe508f88d8348db01c27acbc09a255ce6d0d7edddde073c444d494c4b1a0012d687"
+    "d87a801a00286f90ffff"
+)
+# Order of a wallet without stake key, buying ada
+ORDER_NO_STAKE = (
+    "d8799fd8799fd8799fd8799f581c2f44db199ff4e965702eb240551c0db23fdb0dec1f2527d2bca736bb"
+    "ffd87a80ff40401a047868c0d879801a00286f90ffff"
+)
+# Liquidity order: sender, recipient, datum, step, batcher fee, output ada
+LIQUIDITY = (
+    "d8799fd8799fd8799f581ca37f22772712606a0484f5c25f204aad5872aad821aa16a36a64cc5bffd879"
+    "9fd8799fd8799f581c877966f8285fee31dd309ad0289511c0c0bf3147ca9325d14740c78fffffffffd8"
+    "799fd8799f581c3d623ea9c8cd545b5a76ab523967cd816b09ca08bc185d3d4adc7d81ffd87a80ffd87a"
+    "80d8799f0103ff1a001e84801a001e8480ff"
+)
+
+
+def _general(datum_hex: str) -> str:
+    """
+    The same datum with the general constructor encoding (tag 102).
+    """
+
+    def convert(cbor):
+        if isinstance(cbor, CBORTag) and 121 <= cbor.tag <= 127:
+            return CBORTag(102, [cbor.tag - 121, [convert(field) for field in cbor.value]])
+        return cbor
+
+    return cbor2.dumps(convert(cbor2.loads(bytes.fromhex(datum_hex)))).hex()
+
+
+DATUMS = [
+    (ORDER, version, (SENDER, SENDER)) for version in ["v2", "v3", "v4"]
+] + [
+    (ORDER_NO_STAKE, "v2", (NO_STAKE, NO_STAKE)),
+    (ORDER_NO_STAKE, "v4", (NO_STAKE, NO_STAKE)),
+    (LIQUIDITY, "v1_lq", (SENDER, RECIPIENT)),
+    (LIQUIDITY, "v2_lq", (SENDER, RECIPIENT)),
+    (LIQUIDITY, "clp_lq", (SENDER, RECIPIENT)),
+    (_general(LIQUIDITY), "v1_lq", (SENDER, RECIPIENT)),
+    (_general(ORDER), "v3", (SENDER, SENDER)),
+    # contract versions without parties
+    (ORDER, "v1", None),
+]
+
+
+@pytest.mark.parametrize("datum_hex,version,parties", DATUMS)
+def test_extract_parties_matches_parse_order_datum(datum_hex, version, parties):
+    expected = parse_order_datum(datum_from_cborhex(datum_hex), version)
+    assert expected == parties
+    assert extract_parties(bytes.fromhex(datum_hex), version) == expected
+
+
+def test_memo_returns_the_extracted_parties():
+    memo = DatumMemo(max_size=2)
+    for _ in range(2):
+        for datum_hex, version, parties in DATUMS[:3]:
+            assert memo.parties(datum_hex, version) == parties
+    # the third key evicts the first one on each round
+    assert memo.stats()["size"] == 2
+    assert memo.hits == 0 and memo.misses == 6
+
+    memo = DatumMemo(max_size=10)
+    memo.parties(ORDER, "v2", datum_hash="ab" * 32)
+    assert memo.parties(ORDER, "v2", datum_hash="ab" * 32) == (SENDER, SENDER)
+    assert memo.hits == 1
@@ -0,0 +1,54 @@
+import pytest
+
+from querier.decode import DatumDecoder
+from test.chain import Chain, _v2_datum
+
+
+def _block():
+    """
+    Orders with inline datums, one with its datum in the witness set, one with
+    an invalid datum, a fill and a transfer.
+    """
+    chain = Chain()
+    transactions = [chain.fund_batchers()] + [chain.place_order() for _ in range(10)]
+    witness = chain.place_order()
+    output = witness["outputs"][0]
+    output["datumHash"] = "ab" * 32
+    witness["datums"] = {output["datumHash"]: output.pop("datum")}
+    invalid = chain.place_order()
+    invalid["outputs"][0]["datum"] = "d87980"
+    orders = list(chain.open_orders)
+    transactions += [witness, invalid, chain.fill_order(), chain.transfer()]
+    return orders, chain.block(transactions)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_decode_block(workers):
+    orders, block = _block()
+    decoder = DatumDecoder(workers=workers, min_parallel=1)
+    try:
+        parties = decoder.decode_block(block)
+    finally:
+        decoder.close()
+
+    # all orders placed in the block but the invalid one
+    expected = {
+        order_id: (user.pubkeyhash + user.stakekeyhash,) * 2 for order_id, user in orders[:-1]
+    }
+    assert parties == expected
+    assert decoder.stats()["decoded"] == 12
+
+
+def test_decoded_datums_are_memoized():
+    chain = Chain()
+    user = chain.users[0]
+    transactions = [chain.place_order() for _ in range(3)]
+    for tx in transactions:
+        tx["outputs"][0]["datum"] = _v2_datum(user)
+    decoder = DatumDecoder(workers=0)
+    parties = decoder.decode_block(chain.block(transactions))
+    assert set(parties.values()) == {(user.pubkeyhash + user.stakekeyhash,) * 2}
+    # the memo is filled after the block, so the second one is not decoded again
+    decoder.decode_block(chain.block(transactions))
+    assert decoder.memo.hits == 3
+    assert decoder.stats()["decoded"] == 3
@@ -0,0 +1,109 @@
+import threading
+import time
+
+from common.db import Order, UTxO
+from querier import util
+from querier.fallback import DiskCache, FakeBlockfrostBackend, FallbackResolver, TokenBucket
+from test.chain import ORDER_ADDRESS, _v2_datum, _wallet
+
+TX = "aa" * 32
+ORDER_TX = "bb" * 32
+DATUM_HASH = "cc" * 32
+USER = _wallet("user", 0)
+
+
+def _backend(cls=FakeBlockfrostBackend) -> FakeBlockfrostBackend:
+    inputs = [
+        {
+            "tx_hash": "dd" * 32,
+            "output_index": 1,
+            "address": USER.bech32,
+            "amount": [{"unit": "lovelace", "quantity": "5000000"}],
+            "inline_datum": None,
+            "data_hash": None,
+        },
+        {
+            "tx_hash": ORDER_TX,
+            "output_index": 0,
+            "address": ORDER_ADDRESS,
+            "amount": [{"unit": "lovelace", "quantity": "4000000"}],
+            "inline_datum": None,
+            "data_hash": DATUM_HASH,
+        },
+    ]
+    return cls(
+        tx_utxos={TX: {"inputs": inputs, "outputs": []}},
+        datums={DATUM_HASH: _v2_datum(USER)},
+    )
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_disk_cache_persists(tmp_path):
+    path = str(tmp_path / "cache" / "fallback.sqlite")
+    DiskCache(path).put("datums", "a", "d87980")
+    cache = DiskCache(path)
+    assert cache.get("datums", "a") == "d87980"
+    assert cache.get("datums", "b") is None
+    assert cache.get("tx_utxos", "a") is None
+
+
+def test_missing_inputs_from_the_backend_then_the_cache(tmp_path):
+    path = str(tmp_path / "fallback.sqlite")
+    input_ids = [f"{'dd' * 32}#1", f"{ORDER_TX}#0", f"{'ee' * 32}#0"]
+    stored_ids = [f"{'ee' * 32}#0"]
+
+    backend = _backend()
+    resolver = FallbackResolver(backend=backend, cache_path=path, rate=100, burst=10)
+    utxos, orders = resolver.missing_inputs(TX, input_ids, stored_ids, [])
+    assert [type(u) for u in utxos] == [UTxO]
+    assert utxos[0].id == input_ids[0]
+    assert utxos[0].value == util.parse_value_bf_to_ogmios(
+        [{"unit": "lovelace", "quantity": "5000000"}]
+    )
+    assert [type(o) for o in orders] == [Order]
+    assert orders[0].id == input_ids[1]
+    assert orders[0].sender == USER.pubkeyhash + USER.stakekeyhash
+    # the transaction and the datum
+    assert backend.calls == 2
+
+    # known orders are left out
+    utxos, orders = resolver.missing_inputs(TX, input_ids, stored_ids, [input_ids[1]])
+    assert len(utxos) == 1 and orders == []
+
+    backend = _backend()
+    resolver = FallbackResolver(backend=backend, cache_path=path)
+    utxos, orders = resolver.missing_inputs(TX, input_ids, stored_ids, [])
+    assert len(utxos) == 1 and len(orders) == 1
+    assert backend.calls == 0
+    assert resolver.stats() == {"hits": 2, "remote_calls": 0}
+
+
+def test_concurrent_lookups_share_a_call(tmp_path):
+    class SlowBackend(FakeBlockfrostBackend):
+        def transaction_utxos(self, tx_hash: str) -> dict:
+            time.sleep(0.1)
+            return super().transaction_utxos(tx_hash)
+
+    backend = _backend(SlowBackend)
+    resolver = FallbackResolver(backend=backend, cache_path=str(tmp_path / "fallback.sqlite"))
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(resolver.transaction_utxos(TX)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and all(r == results[0] for r in results)
+    assert backend.calls == 1
@@ -0,0 +1,86 @@
+import orjson
+import sqlalchemy as sqla
+from sqlalchemy import orm
+
+from common.db import BlockHeader
+from querier import writer
+from querier.chainsync import ChainSyncClient
+from querier.ogmios import ChainRollback
+from querier.rollback import intersection_points, recent_blocks
+from test.chain import Chain, ListIterator, make_parser, process
+
+
+class _Node:
+    """
+    Answers findIntersection with the newest given point on its chain, and the
+    first nextBlock with the rollback to it.
+    """
+
+    def __init__(self, chain: set):
+        self.chain = chain
+        self.responses = []
+        self.requests = []
+
+    def send(self, frame: bytes):
+        request = orjson.loads(frame)
+        self.requests.append(request)
+        if request["method"] == "findIntersection":
+            points = [p for p in request["params"]["points"] if (p["slot"], p["id"]) in self.chain]
+            self.point = max(points, key=lambda p: p["slot"])
+            result = {"intersection": self.point, "tip": self.point}
+        else:
+            result = {"direction": "backward", "point": self.point, "tip": self.point}
+        self.responses.append(orjson.dumps({"jsonrpc": "2.0", "result": result}))
+
+    def recv(self, timeout=None, decode=True):
+        return self.responses.pop(0)
+
+
+def _blocks(db, monkeypatch, n: int, k: int):
+    monkeypatch.setattr(writer, "SECURITY_PARAM", k)
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(n - 1)
+    process(make_parser(ListIterator([])), blocks)
+    return blocks
+
+
+def test_only_the_last_k_headers_are_kept(db, monkeypatch):
+    blocks = _blocks(db, monkeypatch, 30, 20)
+    with orm.Session(db) as session:
+        headers = session.execute(
+            sqla.select(BlockHeader.slot, BlockHeader.hash, BlockHeader.height).order_by(
+                BlockHeader.slot
+            )
+        ).all()
+        assert headers == [(b.slot, b.id, b.height) for b in blocks[-20:]]
+
+        newest_first = [(b.slot, b.id) for b in reversed(blocks[-20:])]
+        assert recent_blocks(session) == newest_first
+        # the 1st, 2nd, 3rd, 5th, 9th and 17th newest and the oldest
+        assert intersection_points(session) == [
+            newest_first[i] for i in [0, 1, 2, 4, 8, 16, 19]
+        ]
+
+        # databases without headers fall back to the blocks that created UTxOs
+        session.execute(sqla.delete(BlockHeader))
+        assert recent_blocks(session, limit=3) == newest_first[:3]
+
+
+def test_resume_after_a_fork_yields_the_rollback(db, monkeypatch):
+    blocks = _blocks(db, monkeypatch, 10, 20)
+    # the node switched to a fork after the 5th newest block, one of the candidates
+    node = _Node({(b.slot, b.id) for b in blocks[:-4]})
+    client = ChainSyncClient(url="ws://unused")
+    client.connection = node
+    rollback = client._init_connection(blocks[-1].slot, blocks[-1].id)
+
+    assert isinstance(rollback, ChainRollback)
+    assert (rollback.slot, rollback.id) == (blocks[-5].slot, blocks[-5].id)
+    assert [r["method"] for r in node.requests] == ["findIntersection", "nextBlock"]
+    # nothing was reverted yet, that is up to the parser
+    with orm.Session(db) as session:
+        assert recent_blocks(session)[0] == (blocks[-1].slot, blocks[-1].id)
+
+    node = _Node({(b.slot, b.id) for b in blocks})
+    client.connection = node
+    assert client._init_connection(blocks[-1].slot, blocks[-1].id) is None
@@ -0,0 +1,78 @@
+import pytest
+from prometheus_client import REGISTRY, generate_latest
+from prometheus_client.parser import text_string_to_metric_families
+
+from querier import metrics
+from querier.buffer import SynchronizedIterator
+from test.chain import Chain, ListIterator, make_parser
+
+STAGES = ["decode", "resolve", "analytics", "prices", "commit"]
+
+
+@pytest.fixture
+def collector():
+    collector = metrics._ParserCollector()
+    REGISTRY.register(collector)
+    yield collector
+    REGISTRY.unregister(collector)
+
+
+def _scrape() -> dict:
+    """
+    Samples of the default registry as {(name, sorted labels): value}.
+    """
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(generate_latest(REGISTRY).decode())
+        for sample in family.samples
+    }
+
+
+def test_scrape(db, collector):
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(10, merge_at=6)
+    # counters and histograms are global, compare with a scrape before the run
+    before = _scrape()
+    parser = make_parser(ListIterator(blocks))
+    parser.run()
+    after = _scrape()
+
+    def delta(name: str, **labels) -> float:
+        key = (name, tuple(sorted(labels.items())))
+        return after[key] - before.get(key, 0.0)
+
+    assert delta("querier_blocks_total") == len(blocks)
+    assert delta("querier_transactions_total") == sum(len(b.transactions) for b in blocks)
+    assert after[("querier_slot", ())] == blocks[-1].slot
+    assert delta("querier_stage_seconds_count", stage="decode") == len(blocks)
+    for stage in STAGES:
+        assert delta("querier_stage_seconds_count", stage=stage) > 0
+        assert delta("querier_stage_seconds_sum", stage=stage) > 0
+
+    # hit rates as kept by the components
+    utxos = parser.utxo_cache.stats()
+    memo = parser.datum_decoder.memo.stats()
+    expected = {
+        "utxo": (utxos["hits"] + utxos["skipped"], utxos["misses"]),
+        "datum": (memo["hits"], memo["misses"]),
+        "blockfrost": (parser.fallback.hits, parser.fallback.remote_calls),
+    }
+    assert utxos["hits"] > 0 and memo["hits"] > 0
+    for cache, (hits, misses) in expected.items():
+        labels = (("cache", cache),)
+        assert after[("querier_cache_hits_total", labels)] == hits
+        assert after[("querier_cache_misses_total", labels)] == misses
+        ratio = after[("querier_cache_hit_ratio", labels)]
+        assert ratio == pytest.approx(hits / (hits + misses) if hits + misses else 0.0)
+    # the stub price provider keeps no statistics
+    assert ("querier_cache_hit_ratio", (("cache", "price"),)) not in after
+    # nor does a list of blocks have a buffer
+    assert ("querier_queue_blocks", ()) not in after
+
+    # blocks waiting in the buffer of the chain sync
+    parser.iterator = SynchronizedIterator()
+    for block in blocks[:3]:
+        assert parser.iterator.submit_block(block)
+    samples = _scrape()
+    assert samples[("querier_queue_blocks", ())] == 3
+    assert samples[("querier_queue_bytes", ())] == parser.iterator.stats()["bytes"] > 0
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from common.classes import Token
+from querier.prices import HttpPriceProvider, PriceProvider
+
+TOKENS = [Token("aa" * 28, f"{i:02x}") for i in range(4)]
+
+
+class _Response:
+    def __init__(self, price: float):
+        self.price = price
+
+    def raise_for_status(self):
+        if self.price is None:
+            raise requests.HTTPError("503 Service Unavailable")
+
+    def json(self) -> dict:
+        return {"price": self.price}
+
+
+class _Session:
+    """
+    Answers price requests with the token name as the price, or fails for the
+    tokens in `failing`. Requests wait for `release` if it is given.
+    """
+
+    def __init__(self, release: threading.Event = None):
+        self.release = release
+        self.failing = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get(self, url: str, params: dict, timeout: float) -> _Response:
+        with self.lock:
+            self.requests.append(params["quote-tokenname"])
+        if self.release is not None:
+            self.release.wait(5)
+        name = params["quote-tokenname"]
+        return _Response(None if name in self.failing else int(name, 16) / 10)
+
+
+def _provider(session: _Session, **kwargs) -> HttpPriceProvider:
+    provider = HttpPriceProvider(url="http://prices.invalid/price", **kwargs)
+    provider.session = session
+    return provider
+
+
+def test_price_provider_is_abstract():
+    with pytest.raises(TypeError):
+        PriceProvider()
+
+
+def test_prices_expire_after_the_ttl():
+    session = _Session()
+    provider = _provider(session, ttl=0.1)
+    assert provider.get_prices(TOKENS[:2]) == {TOKENS[0]: 0.0, TOKENS[1]: 0.1}
+    assert provider.get_price(TOKENS[1]) == 0.1
+    assert len(session.requests) == 2
+    time.sleep(0.15)
+    assert provider.get_price(TOKENS[1]) == 0.1
+    assert sorted(session.requests) == ["00", "01", "01"]
+    assert provider.stats() == {"size": 2, "hits": 1, "requests": 3}
+
+
+def test_least_recently_used_prices_are_evicted():
+    session = _Session()
+    provider = _provider(session, max_size=2)
+    provider.get_prices(TOKENS[:2])
+    # token 0 is used again, so token 1 is the least recently used one
+    provider.get_price(TOKENS[0])
+    provider.get_price(TOKENS[2])
+    assert list(provider.cache) == [TOKENS[0], TOKENS[2]]
+    provider.get_price(TOKENS[1])
+    # the first two are fetched concurrently
+    assert sorted(session.requests[:2]) == ["00", "01"]
+    assert session.requests[2:] == ["02", "01"]
+
+
+def test_concurrent_lookups_share_a_request():
+    release = threading.Event()
+    session = _Session(release)
+    provider = _provider(session)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(provider.get_prices(TOKENS[:2])))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    # all threads wait for the requests started by the first one
+    deadline = time.monotonic() + 5
+    while len(session.requests) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(session.requests) == ["00", "01"]
+    assert results == [{TOKENS[0]: 0.0, TOKENS[1]: 0.1}] * 4
+    assert provider.in_flight == {}
+
+
+def test_failed_requests_are_not_cached():
+    session = _Session()
+    session.failing.add("03")
+    provider = _provider(session)
+    with pytest.raises(requests.HTTPError):
+        provider.get_prices([TOKENS[3]])
+    assert provider.in_flight == {}
+    assert TOKENS[3] not in provider.cache
+
+    session.failing.clear()
+    assert provider.get_price(TOKENS[3]) == 0.3
+    assert session.requests == ["03", "03"]
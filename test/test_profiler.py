@@ -0,0 +1,76 @@
+import threading
+import time
+
+from querier.profiler import SamplingProfiler
+
+
+def _busy(done: threading.Event):
+    while not done.is_set():
+        sum(range(1000))
+
+
+def _read(path) -> dict:
+    stacks = {}
+    with open(path) as f:
+        for line in f:
+            stack, count = line.rsplit(" ", 1)
+            stacks[stack] = int(count)
+    return stacks
+
+
+def test_dump_collapsed_stacks(tmp_path):
+    profiler = SamplingProfiler(interval=0.001, directory=str(tmp_path))
+    done = threading.Event()
+    thread = threading.Thread(target=_busy, args=(done,))
+    thread.start()
+    try:
+        profiler.watch_thread("busy", thread.ident)
+        profiler.start()
+        deadline = time.monotonic() + 5
+        while profiler.samples < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        path = profiler.dump("test")
+    finally:
+        profiler.stop()
+        done.set()
+        thread.join()
+        profiler.thread.join()
+
+    assert path.startswith(str(tmp_path)) and path.endswith("-test.collapsed")
+    stacks = _read(path)
+    assert sum(stacks.values()) >= 20
+    for stack in stacks:
+        # only the watched thread, outside of the querier stages, root frame first
+        frames = stack.split(";")
+        assert frames[:3] == ["busy", "[other]", "threading:_bootstrap"]
+        assert "test_profiler:_busy" in frames
+
+
+def test_toggle_while_stopping(tmp_path):
+    profiler = SamplingProfiler(interval=0.001, directory=str(tmp_path))
+    profiler.watch_thread("main")
+    release = threading.Event()
+    dump = profiler.dump
+
+    def slow_dump(tag):
+        # the stopping sampler is still writing its samples
+        release.wait(5)
+        return dump(tag)
+
+    profiler.dump = slow_dump
+    profiler.toggle()
+    first = profiler.thread
+    profiler.toggle()
+    assert first.is_alive() and profiler.stop_event.is_set()
+
+    # the signal starts a new sampler instead of being ignored
+    profiler.toggle()
+    assert profiler.thread is not first and profiler.running
+    assert not profiler.stop_event.is_set()
+    release.set()
+    first.join()
+    assert profiler.running
+
+    profiler.toggle()
+    profiler.thread.join()
+    assert not profiler.running
@@ -0,0 +1,81 @@
+from querier.fallback import FakeBlockfrostBackend, FallbackResolver
+from querier.ogmios import ChainRollback
+from querier.prices import StubPriceProvider
+from querier.replay import BlockRecorder, BlockReplay, benchmark
+from test.chain import Chain, ListIterator, database_state, empty_database, make_parser
+
+
+def _record(path, items: list, start_slot: int):
+    recorder = BlockRecorder(str(path), start_slot, "start")
+    # the stream starts with the rollback to the intersection
+    for item in [ChainRollback(start_slot, "start")] + items:
+        recorder.add(item)
+    recorder.close()
+
+
+def _stream():
+    """
+    Blocks of fork a, a rollback to the common blocks and the blocks of fork b,
+    which reuse the slots of fork a.
+    """
+    chain = Chain()
+    common = [chain.block([chain.fund_batchers(), chain.place_order()])] + chain.blocks(4)
+    fork_a = chain.fork("a").blocks(4, merge_at=1)
+    fork_b = chain.fork("b").blocks(5)
+    rollback = ChainRollback(common[-1].slot, common[-1].id)
+    return common + fork_a + [rollback] + fork_b, common + fork_b
+
+
+def _points(items) -> list:
+    return [
+        ("rollback", i.slot, i.id)
+        if isinstance(i, ChainRollback)
+        else (i.slot, i.id, i.transactions)
+        for i in items
+    ]
+
+
+def test_record_and_replay(tmp_path):
+    stream, _ = _stream()
+    path = tmp_path / "blocks.rec"
+    _record(path, stream, stream[0].slot - 1)
+
+    replay = BlockReplay(str(path))
+    assert replay.start == [stream[0].slot - 1, "start"]
+    assert _points(replay.iterate_blocks()) == _points(stream)
+    assert replay.stats()["blocks"] == len(stream) - 1
+    preloaded = BlockReplay(str(path), preload=True)
+    assert _points(preloaded.iterate_blocks()) == _points(stream)
+
+    # from the middle of the recording, fork b reuses slots before the start
+    replay = BlockReplay(str(path), after_slot=stream[6].slot, max_blocks=3)
+    assert _points(replay.iterate_blocks()) == _points(stream[7:11])
+
+    # without the index of an interrupted recording the frames are scanned
+    content = path.read_bytes()
+    interrupted = tmp_path / "interrupted.rec"
+    interrupted.write_bytes(content[: replay._index_offset()])
+    replay = BlockReplay(str(interrupted), after_slot=stream[6].slot)
+    assert replay.start is None
+    assert _points(replay.iterate_blocks()) == _points(stream[7:])
+
+
+def test_replay_into_the_parser(db, tmp_path):
+    stream, chain = _stream()
+    path = tmp_path / "blocks.rec"
+    _record(path, stream, stream[0].slot - 1)
+
+    # stops in fork a, the second run continues after the chain cursor
+    options = dict(
+        datum_workers=0,
+        price_provider=StubPriceProvider(default=0.5),
+        fallback=FallbackResolver(backend=FakeBlockfrostBackend()),
+    )
+    results = [benchmark(str(path), max_blocks=7, **options), benchmark(str(path), **options)]
+    assert [r["blocks"] for r in results] == [7, len(stream) - 1 - 7]
+    replayed = database_state(db)
+
+    empty_database(db)
+    parser = make_parser(ListIterator(chain))
+    parser.run()
+    assert replayed == database_state(db)
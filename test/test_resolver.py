@@ -0,0 +1,55 @@
+import sqlalchemy as sqla
+from sqlalchemy import orm
+
+from common.db import Transaction, UTxO
+from querier import block_parser
+from querier.resolver import StubResolver, make_resolver
+from test.chain import Chain, ListIterator, make_parser, process
+
+
+class _NoFallback:
+    """
+    Fails the transaction if any input is left for Blockfrost.
+    """
+
+    hits = remote_calls = 0
+
+    def missing_inputs(self, tx_id, input_ids, utxo_ids, order_ids):
+        raise AssertionError(f"Inputs of {tx_id} left for the fallback")
+
+
+def test_stub_resolver_returns_known_inputs_only():
+    resolver = StubResolver({"a#0": ("addr_a", {"ada": {"lovelace": 5}})})
+    resolver.add("b#1", "addr_b", {"ada": {"lovelace": 7}})
+    resolved = resolver.resolve(["a#0", "b#1", "c#0"])
+    assert set(resolved) == {"a#0", "b#1"}
+    assert resolved["b#1"].owner == "addr_b"
+    assert resolved["b#1"].value == {"ada": {"lovelace": 7}}
+
+
+def test_make_resolver():
+    assert isinstance(make_resolver("stub"), StubResolver)
+    assert make_resolver("none") is None
+
+
+def test_relevant_mode_resolves_unstored_batcher_inputs(db, monkeypatch):
+    monkeypatch.setattr(block_parser, "INGEST_MODE", "relevant")
+    chain = Chain()
+    funding = chain.fund_batchers()
+    resolver = StubResolver()
+    for i, output in enumerate(funding["outputs"]):
+        resolver.add(f"{funding['id']}#{i}", output["address"], output["value"])
+    parser = make_parser(ListIterator([]), input_resolver=resolver, fallback=_NoFallback())
+    blocks = [chain.block([funding, chain.place_order()])]
+    fill = chain.fill_order([0])
+    blocks.append(chain.block([fill]))
+    process(parser, blocks)
+
+    with orm.Session(db) as session:
+        # the batchers were unknown, so their funding outputs were not stored
+        assert session.get(UTxO, f"{funding['id']}#0") is None
+        transaction = session.scalars(sqla.select(Transaction)).one()
+    assert transaction.tx_hash == fill["id"]
+    assert transaction.batcher_id is not None
+    # change minus the funding output
+    assert transaction.ada_profit == fill["outputs"][1]["value"]["ada"]["lovelace"] - 100_000_000
@@ -0,0 +1,57 @@
+import pytest
+import sqlalchemy as sqla
+from sqlalchemy import orm
+
+from common.db import BatcherChange
+from querier.ogmios import ChainRollback
+from test.chain import Chain, ListIterator, database_state, empty_database, make_parser, process
+
+
+def _fork():
+    chain = Chain()
+    common = [chain.block([chain.fund_batchers(), chain.place_order()])]
+    # every batcher fills an order on its own first
+    for i in range(3):
+        common.append(chain.block([chain.place_order(), chain.fill_order([i])]))
+    # fork a merges batchers 1 and 2, the chain continues with fork b
+    fork_a = chain.fork("a").blocks(4, merge_at=1)
+    fork_b = chain.fork("b").blocks(4)
+    return common, fork_a, fork_b
+
+
+@pytest.mark.parametrize("restart", [False, True])
+def test_rollback_of_a_fork_with_a_merge(db, restart):
+    common, fork_a, fork_b = _fork()
+    parser = make_parser(ListIterator([]))
+    process(parser, common + fork_a)
+    assert parser.batcher_index.merges == 1
+    if restart:
+        # the journal is lost, the rollback comes through the stream at startup
+        rollback = ChainRollback(common[-1].slot, common[-1].id)
+        parser = make_parser(ListIterator([rollback] + fork_b))
+        parser.run()
+    else:
+        parser.rollback(common[-1].slot, common[-1].id)
+        process(parser, fork_b)
+    assert parser.batcher_index.merges == 0
+    rolled_back = database_state(db, parser)
+
+    empty_database(db)
+    parser = make_parser(ListIterator([]))
+    process(parser, common + fork_b)
+    assert rolled_back == database_state(db, parser)
+
+
+def test_batcher_changes_are_recorded_per_block(db):
+    common, fork_a, _ = _fork()
+    parser = make_parser(ListIterator([]))
+    process(parser, common + fork_a)
+    with orm.Session(db) as session:
+        changes = session.execute(
+            sqla.select(BatcherChange.slot, BatcherChange.change).order_by(BatcherChange.id)
+        ).all()
+    journaled = [
+        (undo.slot, list(change)) for undo in parser.journal.blocks for change in undo.batchers
+    ]
+    assert [(slot, change) for slot, change in changes] == journaled
+    assert [change[0] for _, change in changes].count("merge") == 1
@@ -0,0 +1,147 @@
+from collections import defaultdict
+
+import pytest
+import sqlalchemy as sqla
+from fastapi.testclient import TestClient
+from sqlalchemy import orm
+
+from common.db import ROLLUP_DAY, ROLLUP_HOUR, BatcherAddress, Transaction
+from common.util import slot_timestamp
+from server import crud
+from server.serve import app
+from test.chain import Chain, ListIterator, make_parser
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+def _fills(db) -> tuple:
+    """
+    Batcher 0 fills three orders in each of four blocks, returns its address and
+    the (slot, tx hash) of its transactions in chain order.
+    """
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()] + [chain.place_order() for _ in range(13)])]
+    fills = []
+    for _ in range(4):
+        transactions = [chain.fill_order([0]) for _ in range(3)]
+        blocks.append(chain.block(transactions))
+        fills += [(blocks[-1].slot, tx["id"]) for tx in transactions]
+    make_parser(ListIterator(blocks)).run()
+    return chain.batcher_addresses[0], fills
+
+
+def _pages(client, params: dict) -> list:
+    pages = []
+    while True:
+        response = client.get("/transactions", params=params)
+        assert response.status_code == 200
+        pages.append([(t["slot"], t["tx_hash"]) for t in response.json()])
+        if "X-Next-Cursor" not in response.headers:
+            return pages
+        params = {**params, "cursor": response.headers["X-Next-Cursor"]}
+
+
+def test_transactions_without_a_limit(db, client):
+    address, fills = _fills(db)
+    response = client.get("/transactions", params={"address": address})
+    assert [(t["slot"], t["tx_hash"]) for t in response.json()] == fills
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_transactions_by_slot(db, client):
+    address, fills = _fills(db)
+    slots = sorted({slot for slot, _ in fills})
+    params = {"address": address, "from_slot": slots[1], "to_slot": slots[2]}
+    assert _pages(client, params) == [fills[3:9]]
+    assert _pages(client, {"address": address, "from_slot": slots[-1] + 1}) == [[]]
+
+
+def test_transactions_in_pages(db, client):
+    address, fills = _fills(db)
+    # pages end in the middle of the fills of a block, the short last one has no cursor
+    pages = _pages(client, {"address": address, "limit": 5})
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert sum(pages, []) == fills
+    # a full last page still has a cursor, the page after it is empty
+    pages = _pages(client, {"address": address, "limit": 3, "from_slot": fills[4][0]})
+    assert pages == [fills[3:6], fills[6:9], fills[9:], []]
+
+
+def test_transactions_errors(db, client):
+    address, _ = _fills(db)
+    for cursor in ["1", "a.b", "1.2.3"]:
+        response = client.get("/transactions", params={"address": address, "cursor": cursor})
+        assert response.status_code == 400
+    assert client.get("/transactions", params={"address": "addr1unknown"}).status_code == 404
+    assert client.get("/transactions", params={"address": address, "limit": 0}).status_code == 422
+
+
+def _scan(session, from_time, to_time) -> dict:
+    """
+    Profit statistics per batcher from the transactions, with the window extended to
+    whole hours like the rollups.
+    """
+    start = from_time - from_time % ROLLUP_HOUR if from_time is not None else None
+    end = to_time - to_time % ROLLUP_HOUR + ROLLUP_HOUR if to_time is not None else None
+    profits = defaultdict(list)
+    for t in session.scalars(sqla.select(Transaction)):
+        timestamp = slot_timestamp(t.slot)
+        if (start is None or timestamp >= start) and (end is None or timestamp < end):
+            profits[t.batcher_id].append(t.ada_profit + t.equivalent_ada)
+    return {
+        batcher_id: {
+            "max_profit": max(p),
+            "min_profit": min(p),
+            "avg_profit": pytest.approx(sum(p) / len(p)),
+            "total": pytest.approx(sum(p)),
+            "num_transactions": len(p),
+        }
+        for batcher_id, p in profits.items()
+    }
+
+
+def test_stats_windows(db):
+    chain = Chain(step=500)
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(8)
+    chain.step = 13_000
+    blocks += chain.blocks(20)
+    make_parser(ListIterator(blocks)).run()
+    times = sorted(slot_timestamp(b.slot) for b in blocks[2:])
+    day = times[10] - times[10] % ROLLUP_DAY
+    windows = [
+        (None, None),
+        # inside one hour
+        (times[1] + 1, times[1] + 1),
+        # inside one day
+        (day + 2 * ROLLUP_HOUR + 17, day + 20 * ROLLUP_HOUR + 5),
+        # several days with partial days at both edges
+        (times[3] + 100, times[-3] - 100),
+        (times[12], None),
+        (None, times[12]),
+        (times[12], times[3]),
+    ]
+    with orm.Session(db) as session:
+        addresses = dict(
+            session.execute(sqla.select(BatcherAddress.address, BatcherAddress.batcher_id)).all()
+        )
+        counts = []
+        for from_time, to_time in windows:
+            expected = _scan(session, from_time, to_time)
+            counts.append(sum(e["num_transactions"] for e in expected.values()))
+            for address, batcher_id in addresses.items():
+                stats = crud.batcher_stats(session, address, from_time, to_time)
+                if batcher_id in expected:
+                    stats["num_transactions"] = expected[batcher_id]["num_transactions"]
+                assert stats == expected.get(batcher_id)
+            all_stats = {
+                addresses[s.pop("addresses")[0]]: s
+                for s in crud.all_batcher_stats(session, from_time, to_time)
+            }
+            assert all_stats == expected
+    # all, one hour, one day, several days, from, to, empty
+    assert counts[1] < counts[2] < counts[3] < counts[0]
+    assert counts[4] + counts[5] > counts[0] and counts[6] == 0
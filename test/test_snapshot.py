@@ -0,0 +1,79 @@
+from querier import block_parser
+from querier.snapshot import StateSnapshot
+from test.chain import Chain, ListIterator, database_state, empty_database, make_parser, process
+
+
+def _blocks():
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(14, merge_at=8)
+    return blocks[:10], blocks[10:]
+
+
+def test_save_and_load(db, tmp_path):
+    blocks, _ = _blocks()
+    parser = make_parser(ListIterator([]))
+    process(parser, blocks)
+    assert parser.batcher_index.merges == 1
+
+    path = str(tmp_path / "state" / "state.snapshot")
+    slot, block_hash, _ = parser.last_block
+    StateSnapshot(
+        slot, block_hash, list(parser.open_orders), parser.batcher_index, parser.utxo_cache.bloom
+    ).save(path)
+    snapshot = StateSnapshot.load(path)
+
+    assert snapshot.matches(blocks[-1].slot, blocks[-1].id)
+    assert snapshot.open_orders == list(parser.open_orders)
+    index = snapshot.batcher_index
+    assert index.address_to_batcher == parser.batcher_index.address_to_batcher
+    assert index.parent == parser.batcher_index.parent
+    # the members of the merged batchers are rebuilt from the parent links
+    assert index.members == parser.batcher_index.members
+    assert {a: index.batcher_of(a) for a in index} == {
+        a: parser.batcher_index.batcher_of(a) for a in parser.batcher_index
+    }
+    bloom = parser.utxo_cache.bloom
+    assert (snapshot.bloom.bits, snapshot.bloom.count) == (bloom.bits, bloom.count)
+    assert (snapshot.bloom.capacity, snapshot.bloom.error_rate) == (
+        bloom.capacity,
+        bloom.error_rate,
+    )
+
+
+def test_invalid_snapshots_are_ignored(tmp_path):
+    assert StateSnapshot.load(str(tmp_path / "missing.snapshot")) is None
+    path = tmp_path / "other.snapshot"
+    path.write_bytes(b"something else")
+    assert StateSnapshot.load(str(path)) is None
+
+
+def test_restart_from_a_snapshot(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(block_parser, "SNAPSHOT_PATH", str(tmp_path / "state.snapshot"))
+    before, after = _blocks()
+    parser = make_parser(ListIterator([]))
+    process(parser, before)
+    parser.save_snapshot()
+    stale = (tmp_path / "state.snapshot").read_bytes()
+
+    loaded = []
+    load_snapshot = block_parser.BlockParser.load_snapshot
+
+    def spy(self):
+        loaded.append(load_snapshot(self))
+        return loaded[-1]
+
+    monkeypatch.setattr(block_parser.BlockParser, "load_snapshot", spy)
+    parser = make_parser(ListIterator(after))
+    assert loaded[-1] is not None
+    parser.run()
+    restarted = database_state(db, parser)
+
+    # a snapshot behind the chain cursor is not used
+    (tmp_path / "state.snapshot").write_bytes(stale)
+    parser = make_parser(ListIterator([]))
+    assert loaded[-1] is None
+
+    empty_database(db)
+    parser = make_parser(ListIterator(before + after))
+    parser.run()
+    assert restarted == database_state(db, parser)
@@ -0,0 +1,25 @@
+import pycardano
+import pytest
+
+from common.db import AddressRole
+from querier import util
+from querier.config import MUESLI_ADDR_TO_VERSION, POOL_CONTRACTS, PROFIT_ADDRESSES
+
+_KEY = pycardano.VerificationKeyHash(bytes(range(28)))
+_SCRIPT = pycardano.ScriptHash(bytes(range(28, 56)))
+
+
+@pytest.mark.parametrize("network", [pycardano.Network.MAINNET, pycardano.Network.TESTNET])
+def test_address_role(network):
+    pool = pycardano.ScriptHash(bytes.fromhex(POOL_CONTRACTS[0]))
+    for staking_part in [None, _KEY, _SCRIPT, pycardano.PointerAddress(1, 2, 3)]:
+        address = pycardano.Address(pool, staking_part, network)
+        assert util.address_role(str(address)) == AddressRole.POOL_CONTRACT
+        for payment_part in [_KEY, _SCRIPT]:
+            address = pycardano.Address(payment_part, staking_part, network)
+            assert util.address_role(str(address)) == AddressRole.WALLET
+
+    assert util.address_role(next(iter(MUESLI_ADDR_TO_VERSION))) == AddressRole.ORDER_CONTRACT
+    assert util.address_role(PROFIT_ADDRESSES[0]) == AddressRole.PROFIT_ADDRESS
+    byron = "Ae2tdPwUPEZ4YjgvykNpoFeYUxoyhNj2kg8KfKWN2FizsSpLUPv68MpTVDo"
+    assert util.address_role(byron) == AddressRole.WALLET
@@ -0,0 +1,77 @@
+import pytest
+import sqlalchemy as sqla
+from sqlalchemy import orm
+
+from common.db import Batcher, BatcherAddress, BatcherRollup, Transaction
+from querier import rollups
+from querier.writer import round_profits
+from test.chain import Chain, ListIterator, database_state, empty_database, make_parser
+
+
+def _rollups(session) -> set:
+    return set(session.execute(sqla.select(BatcherRollup.__table__)).all())
+
+
+@pytest.mark.parametrize("write_path", ["orm", "bulk"])
+def test_merge_within_a_batch(db, write_path):
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(12, merge_at=8)
+    # the first block is committed on its own, the others in one batch
+    parser = make_parser(ListIterator(blocks), write_path=write_path)
+    parser.run()
+    assert parser.batcher_index.merges == 1
+
+    batcher_1, batcher_2 = chain.batcher_addresses[1:]
+    with orm.Session(db) as session:
+        addresses = dict(
+            session.execute(sqla.select(BatcherAddress.address, BatcherAddress.batcher_id)).all()
+        )
+        batchers = set(session.scalars(sqla.select(Batcher.id)))
+        transactions = session.scalars(sqla.select(Transaction)).all()
+
+        assert addresses[batcher_1] == addresses[batcher_2]
+        assert set(addresses.values()) == batchers
+        # transactions written before the merge point to the winner too
+        assert len(transactions) == 11
+        assert {t.batcher_id for t in transactions} <= batchers
+        assert parser.batcher_index.batcher_of(batcher_1) == addresses[batcher_1]
+
+        # the rollups folded by the merge equal those computed from the transactions
+        folded = _rollups(session)
+        rollups.rebuild(session)
+        assert _rollups(session) == folded
+        session.rollback()
+
+
+def test_write_paths_store_the_same_rows(db):
+    chain = Chain()
+    blocks = [chain.block([chain.fund_batchers()])] + chain.blocks(12, merge_at=8)
+    blocks.append(chain.block([chain.transfer(spend=chain.batcher_utxos[0])]))
+    states = []
+    for write_path in ["orm", "bulk"]:
+        parser = make_parser(ListIterator(blocks), write_path=write_path)
+        parser.run()
+        states.append(database_state(db, parser))
+        empty_database(db)
+    assert states[0] == states[1]
+    assert len(states[0]["transactions"]) == 11
+    assert any(spent_slot == blocks[-1].slot for _, spent_slot in states[0]["utxos"])
+
+
+def test_profits_are_rounded_half_away_from_zero_for_postgres(db):
+    engine = sqla.create_engine("postgresql+psycopg://localhost/unused")
+    for ada_profit, equivalent_ada, expected in [
+        (1, 0.5, (1, 1)),
+        (2, 2.5, (2, 3)),
+        (-3, -0.5, (-3, -1)),
+        (0, -2.4999, (0, -2)),
+    ]:
+        transaction = Transaction(ada_profit=ada_profit, equivalent_ada=equivalent_ada)
+        round_profits(orm.Session(engine), transaction)
+        assert (transaction.ada_profit, transaction.equivalent_ada) == expected
+        assert type(transaction.equivalent_ada) is int
+
+    # SQLite stores them as they are
+    transaction = Transaction(ada_profit=1, equivalent_ada=0.5)
+    round_profits(orm.Session(db), transaction)
+    assert transaction.equivalent_ada == 0.5